@@ -1,7 +1,7 @@
 from typing import *
 
 import numpy as np
-from pydantic import BaseModel
+from pydantic import BaseModel, root_validator
 
 
 class HashableBaseModel(BaseModel):
@@ -17,3 +17,35 @@ class ImagesPayload(HashableBaseModel):
     case_study: str
     image_ids: List[str]
     score_fn: str
+    image_format: str = 'base64'
+    polygon_format: str = 'text'
+    lod: int = 0
+
+
+class BinScoresPayload(HashableBaseModel):
+    """Selects the images to bin either by image_ids or, if image_ids is
+    omitted, by the same prediction_fn and label_filter as get-images."""
+    case_study: str
+    score_fn: str
+    image_ids: Optional[List[str]] = None
+    prediction_fn: str = 'all_images'
+    label_filter: str = ''
+
+
+class RegionPayload(HashableBaseModel):
+    """A query region, given as polygon strings in the format of the bbox
+    field or as a 2D 0/1 mask of any size, and how to sort the re-scored
+    images. Exactly one of region and mask must be given."""
+    case_study: str
+    region: Optional[List[str]] = None
+    mask: Optional[List[List[int]]] = None
+    score_fn: str = 'iou'
+    sort_by: int = -1
+    prediction_fn: str = 'all_images'
+    label_filter: str = ''
+
+    @root_validator(skip_on_failure=True)
+    def check_one_region(cls, values):
+        if (values.get('region') is None) == (values.get('mask') is None):
+            raise ValueError('Give exactly one of region and mask.')
+        return values
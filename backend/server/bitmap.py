@@ -0,0 +1,114 @@
+"""Packed bitmap index over the filter predicates of a case study.
+
+Every predicate the API can filter on (a label, a prediction, correct or
+incorrect) is stored as a bitset of 64-bit words with bit `i` set when image
+`i` satisfies it. Filters combine with bitwise AND/OR over n/64 words and
+counts come from a popcount, without materializing any rows.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+WORD_BITS = 64
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(bits: np.ndarray) -> int:
+        """The number of set bits in bits."""
+        return int(np.bitwise_count(bits).sum())
+
+    def row_popcount(bits: np.ndarray) -> np.ndarray:
+        """The number of set bits in each row of a 2D array of words."""
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.int64)
+else:
+    _BYTE_COUNTS = np.array([bin(i).count('1') for i in range(256)],
+                            dtype=np.uint8)
+
+    def popcount(bits: np.ndarray) -> int:
+        """The number of set bits in bits."""
+        return int(_BYTE_COUNTS[bits.view(np.uint8)].sum(dtype=np.int64))
+
+    def row_popcount(bits: np.ndarray) -> np.ndarray:
+        """The number of set bits in each row of a 2D array of words."""
+        bytes_ = np.ascontiguousarray(bits).view(np.uint8)
+        return _BYTE_COUNTS[bytes_].sum(axis=1, dtype=np.int64)
+
+
+class BitmapIndex:
+    """One packed bitset per label, per prediction, plus correct/incorrect.
+
+    Attributes:
+        size: The number of images indexed.
+        labels: (num_categories, num_words) bitsets, one per label code.
+        predictions: (num_categories, num_words) bitsets, one per prediction
+                     code.
+        correct: Bitset of images whose label equals their prediction.
+        incorrect: Bitset of images whose label differs from their prediction.
+    """
+
+    def __init__(self, label_codes: np.ndarray, prediction_codes: np.ndarray,
+                 num_categories: int):
+        self.size = len(label_codes)
+        self.num_words = -(-self.size // WORD_BITS)
+        self.labels = self._pack_codes(label_codes, num_categories)
+        self.predictions = self._pack_codes(prediction_codes, num_categories)
+        self.correct = self.pack(label_codes == prediction_codes)
+        self._all = self.pack(np.ones(self.size, dtype=bool))
+        self.incorrect = self._all & ~self.correct
+
+    @classmethod
+    def from_bitsets(cls, size: int, labels: np.ndarray,
+                     predictions: np.ndarray,
+                     correct: np.ndarray) -> 'BitmapIndex':
+        """Wraps bitsets built by another index, e.g. memory-mapped ones."""
+        index = cls.__new__(cls)
+        index.size = size
+        index.num_words = -(-size // WORD_BITS)
+        index.labels = labels
+        index.predictions = predictions
+        index.correct = correct
+        index._all = index.pack(np.ones(size, dtype=bool))
+        index.incorrect = index._all & ~correct
+        return index
+
+    def all(self) -> np.ndarray:
+        """A bitset with every image set."""
+        return self._all
+
+    def none(self) -> np.ndarray:
+        """A bitset with no image set."""
+        return np.zeros(self.num_words, dtype=np.uint64)
+
+    def label(self, code: Optional[int]) -> np.ndarray:
+        """The bitset of images with label code, or none if code is None."""
+        return self.none() if code is None else self.labels[code]
+
+    def prediction(self, code: Optional[int]) -> np.ndarray:
+        """The bitset of images with prediction code, or none if code is
+        None."""
+        return self.none() if code is None else self.predictions[code]
+
+    def pack(self, mask: np.ndarray) -> np.ndarray:
+        """Packs a boolean mask into a bitset of little-endian words."""
+        packed = np.zeros(self.num_words * 8, dtype=np.uint8)
+        packed[:-(-self.size // 8)] = np.packbits(mask, bitorder='little')
+        return packed.view('<u8').astype(np.uint64, copy=False)
+
+    def unpack(self, bits: np.ndarray) -> np.ndarray:
+        """Unpacks a bitset into a boolean mask with one entry per image."""
+        packed = bits.astype('<u8', copy=False).view(np.uint8)
+        return np.unpackbits(packed, count=self.size,
+                             bitorder='little').view(bool)
+
+    @staticmethod
+    def count(bits: np.ndarray) -> int:
+        """The number of images set in bits."""
+        return popcount(bits)
+
+    def _pack_codes(self, codes: np.ndarray, num_categories: int) -> np.ndarray:
+        rows = np.arange(self.size, dtype=np.uint64)
+        word_bits = np.uint64(WORD_BITS)
+        bits = np.zeros((num_categories, self.num_words), dtype=np.uint64)
+        np.bitwise_or.at(bits, (codes, rows // word_bits),
+                         np.left_shift(np.uint64(1), rows % word_bits))
+        return bits
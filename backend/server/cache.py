@@ -0,0 +1,162 @@
+"""Bounded, thread-safe cache of API query results.
+
+Unlike `utils.memoize`, the `QueryCache` evicts least-recently-used results
+once their estimated size exceeds a byte budget, can be invalidated per case
+study, and coalesces concurrent identical misses so the result is computed
+once while the other callers wait for it.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+
+def make_key(endpoint: str, case_study: str, **params) -> Tuple:
+    """Normalizes query parameters into a cache key.
+
+    Args:
+        endpoint: The name of the endpoint computing the result.
+        case_study: The name of the case study queried. Keys are invalidated
+                    per case study.
+        **params: The remaining query parameters. Their order does not matter.
+
+    Returns:
+        A hashable key of the form (endpoint, case_study, params).
+    """
+    return endpoint, case_study, tuple(sorted(params.items()))
+
+
+def sizeof(value: Any) -> int:
+    """Estimates the memory held by a query result in bytes."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v)
+                                          for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class _Flight:
+    """A computation in progress that identical queries wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QueryCache:
+    """LRU cache of query results bounded by their estimated size in bytes.
+
+    Attributes:
+        max_bytes: The byte budget. Results larger than it are never stored.
+        hits: Number of lookups answered from the cache.
+        misses: Number of lookups that computed their result.
+        coalesced: Number of lookups that waited on an identical computation.
+        evictions: Number of results evicted to stay within max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Tuple, compute: Callable[[], Any]) -> Any:
+        """Returns the cached result for key, computing it on a miss.
+
+        If an identical query is already being computed, waits for it and
+        shares its result (or its exception) instead of computing again.
+
+        Args:
+            key: A key built by `make_key`.
+            compute: Computes the result when it is not cached.
+
+        Returns:
+            The query result. Callers must not mutate it.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                generation = self._generations.get(key[1], 0)
+                self.misses += 1
+                owner = True
+            else:
+                self.coalesced += 1
+                owner = False
+
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            self._store(key, flight.value, generation)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, case_study: Optional[str] = None):
+        """Drops the cached results of case_study, or of every case study.
+
+        Results still being computed against the old data are not stored.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if case_study is None or key[1] == case_study:
+                    self._bytes -= self._entries.pop(key)[1]
+            studies = self._generations if case_study is None else [case_study]
+            for study in list(studies):
+                self._generations[study] = self._generations.get(study, 0) + 1
+
+    def stats(self) -> dict:
+        """Hit/miss statistics and current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes,
+                    'hit_rate': (self.hits + self.coalesced) / lookups
+                    if lookups else 0.0}
+
+    def _store(self, key: Tuple, value: Any, generation: int):
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if self._generations.get(key[1], 0) != generation:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
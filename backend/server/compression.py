@@ -0,0 +1,209 @@
+"""Negotiated gzip and brotli compression of API responses.
+
+`CompressionMiddleware` compresses responses of compressible media types that
+are at least `minimum_size` bytes long, with the encoding the client prefers
+in its Accept-Encoding header. Streamed responses are flushed chunk by chunk,
+so newline-delimited JSON still reaches the client incrementally.
+
+Results that are requested repeatedly are compressed once instead:
+`precompress` encodes a body with every supported encoding at the highest
+compression level, and `precompressed_response` picks the variant for a
+request. The middleware leaves responses that already have a Content-Encoding
+untouched.
+
+Brotli support requires the optional `brotli` package.
+"""
+
+import gzip
+import zlib
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IDENTITY = 'identity'
+# Supported encodings in order of server preference, used to break ties
+# between encodings the client accepts with equal quality.
+ENCODINGS = (['br'] if brotli is not None else []) + ['gzip']
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson',
+                      'application/javascript', 'image/svg+xml', 'text/')
+
+
+def negotiate(accept_encoding: Optional[str]) -> str:
+    """The supported encoding the client prefers, or 'identity' for none.
+
+    Args:
+        accept_encoding: The value of the request's Accept-Encoding header,
+                         e.g. 'gzip, deflate, br' or 'br;q=1.0, gzip;q=0.5'.
+    """
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().lower().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip()] = quality
+
+    best, best_quality = IDENTITY, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    """Compresses body with encoding ('br', 'gzip' or 'identity').
+
+    Args:
+        body: The bytes to compress.
+        encoding: The content coding.
+        level: The brotli quality (0-11) or gzip level (1-9). Defaults to the
+               highest.
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if level is None else level)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9 if level is None else level)
+    return body
+
+
+def precompress(body: bytes) -> Dict[str, bytes]:
+    """Mapping from 'identity' and each supported encoding that shrinks body
+    to body encoded with it."""
+    bodies = {IDENTITY: body}
+    for encoding in ENCODINGS:
+        compressed = compress(body, encoding)
+        if len(compressed) < len(body):
+            bodies[encoding] = compressed
+    return bodies
+
+
+def precompressed_response(bodies: Dict[str, bytes],
+                           accept_encoding: Optional[str],
+                           media_type: str = 'application/json') -> Response:
+    """A response with the variant of `precompress` the client prefers."""
+    encoding = negotiate(accept_encoding)
+    if encoding not in bodies:
+        encoding = IDENTITY
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding != IDENTITY:
+        headers['Content-Encoding'] = encoding
+    return Response(bodies[encoding], media_type=media_type, headers=headers)
+
+
+class _StreamCompressor:
+    """Compresses a body chunk by chunk, flushing after each chunk."""
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk: bytes, last: bool) -> bytes:
+        if self.encoding == 'br':
+            data = self._compressor.process(chunk)
+            return data + (self._compressor.finish() if last
+                           else self._compressor.flush())
+        data = self._compressor.compress(chunk)
+        return data + self._compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses with the negotiated encoding.
+
+    Attributes:
+        minimum_size: Responses with a smaller complete body are sent as is.
+        levels: The level each encoding compresses dynamic responses with.
+                They favor speed, unlike `precompress`.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024,
+                 levels: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = dict({'br': 4, 'gzip': 6}, **(levels or {}))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'http':
+            encoding = negotiate(Headers(scope=scope).get('accept-encoding'))
+            if encoding != IDENTITY:
+                responder = _CompressionResponder(
+                    self.app, encoding, self.levels[encoding],
+                    self.minimum_size)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class _CompressionResponder:
+    """Compresses the response to a single request."""
+
+    def __init__(self, app: ASGIApp, encoding: str, level: int,
+                 minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.send = None
+        self.start_message: Message = {}
+        self.compressor: Optional[_StreamCompressor] = None
+        self.started = False
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        if message['type'] == 'http.response.start':
+            # Held back until the first body chunk decides the headers.
+            self.start_message = message
+            headers = Headers(raw=message['headers'])
+            self.passthrough = 'content-encoding' in headers or not headers.get(
+                'content-type', '').startswith(COMPRESSIBLE_TYPES)
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            if not self.started and self.start_message:
+                self.started = True
+                await self.send(self.start_message)
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if not self.started:
+            self.started = True
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            self.compressor = _StreamCompressor(self.encoding, self.level)
+            body = self.compressor.compress(body, last=not more_body)
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+            else:
+                headers['Content-Length'] = str(len(body))
+            await self.send(self.start_message)
+        else:
+            body = self.compressor.compress(body, last=not more_body)
+        await self.send({'type': 'http.response.body', 'body': body,
+                         'more_body': more_body})
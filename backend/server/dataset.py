@@ -0,0 +1,507 @@
+"""Columnar, categorical-coded storage for a single case study.
+
+A `CaseStudy` is built once from the dataframe produced by
+`data/generate_datasets.py` and answers every API query from contiguous NumPy
+arrays. Labels and predictions share a single vocabulary and are stored as
+integer category codes, so equality tests become integer comparisons.
+"""
+
+import base64
+import hashlib
+import threading
+import traceback
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from backend.server.bitmap import BitmapIndex
+from backend.server.cache import sizeof
+from backend.server.masks import (DEFAULT_RESOLUTION, SaliencyMaskStore,
+                                  ThresholdHistograms)
+from backend.server.polygons import PolygonColumn
+
+# Columns written by `generate_datasets.py` that are not score functions.
+RECORD_COLUMNS = ['image', 'bbox', 'saliency', 'label', 'prediction']
+# Object columns stored as binary-encoded `polygons.PolygonColumn`s.
+POLYGON_COLUMNS = ['bbox', 'saliency']
+# Data files comparing explanation methods suffix the saliency and score
+# columns of every method but the first with '.<method>', e.g. 'saliency.lime'
+# and 'iou.lime'.
+METHOD_SEPARATOR = '.'
+# Optional columns of cumulative saliency histograms (see
+# `masks.ThresholdHistograms`), inside and outside the ground truth. Like the
+# score columns, they are suffixed with the method for all but the first.
+HISTOGRAM_COLUMNS = ['saliency_inside', 'saliency_outside']
+PREDICTION_FNS = ['all_images', 'correct_only', 'incorrect_only']
+
+
+def is_polygon_column(column: str) -> bool:
+    """Whether column holds polygons, including other methods' saliency."""
+    return column in POLYGON_COLUMNS or column.startswith(
+        'saliency' + METHOD_SEPARATOR)
+
+
+def histogram_columns(method: str = '') -> List[str]:
+    """The histogram columns of an explanation method, '' for the first."""
+    suffix = METHOD_SEPARATOR + method if method else ''
+    return [column + suffix for column in HISTOGRAM_COLUMNS]
+
+
+def sort_order(values: np.ndarray, ascending: bool) -> np.ndarray:
+    """Stable permutation sorting values, with NaNs last in both directions.
+
+    The descending order is not the reverse of the ascending one: ties must
+    stay in dataset order, as in a pandas mergesort.
+    """
+    return np.argsort(values if ascending else -values, kind='stable')
+
+
+class CaseStudy:
+    """A case study dataset stored as columnar arrays.
+
+    Attributes:
+        name: The name of the case study, e.g. 'data_dogs'.
+        ids: Object array of image IDs (the `fname` column).
+        categories: Object array of every label and prediction value. Label and
+                    prediction codes index into this array.
+        label_codes: Integer category code of each image's label.
+        prediction_codes: Integer category code of each image's prediction.
+        correct: Boolean array, True where the label equals the prediction.
+        bitmaps: Packed bitsets of the label, prediction and correctness
+                 filter predicates.
+        scores: Mapping from score function name to its float64 score array.
+        columns: Mapping from image to its object array (or lazily decoded
+                 `storage.BlobColumn`), and from bbox and the saliency of each
+                 explanation method to their `PolygonColumn`s.
+        sort_orders: Mapping from score function name to its stable ascending
+                     and descending row permutations.
+        id_order: Row permutation sorting the image IDs.
+        sorted_ids: The image IDs in sorted order.
+        threshold_histograms: Mapping from explanation method ('' for the
+                              first) to its cumulative saliency histograms
+                              for scoring at any saliency threshold. Methods
+                              the data file has no histograms of are missing.
+    """
+
+    def __init__(self, name: str, ids: np.ndarray, categories: np.ndarray,
+                 label_codes: np.ndarray, prediction_codes: np.ndarray,
+                 scores: Dict[str, np.ndarray],
+                 columns: Dict[str, np.ndarray],
+                 sort_orders: Optional[Dict[str, Tuple[np.ndarray,
+                                                       np.ndarray]]] = None,
+                 bitmaps: Optional[BitmapIndex] = None,
+                 id_order: Optional[np.ndarray] = None,
+                 saliency_masks: Optional[SaliencyMaskStore] = None,
+                 threshold_histograms: Optional[
+                     Dict[str, ThresholdHistograms]] = None,
+                 sorted_ids: Optional[np.ndarray] = None,
+                 correct: Optional[np.ndarray] = None):
+        self.name = name
+        self.ids = ids
+        self.categories = categories
+        self.label_codes = label_codes
+        self.prediction_codes = prediction_codes
+        # Derived arrays are passed in when they are memory-mapped, so every
+        # process shares them instead of computing its own copy.
+        self.correct = correct if correct is not None else \
+            label_codes == prediction_codes
+        self.scores = scores
+        self.columns = columns
+        self.threshold_histograms = dict(threshold_histograms or {})
+
+        self._image_hashes: Dict[int, str] = {}
+        self._contingency: Dict[Optional[str], np.ndarray] = {}
+        self._saliency_masks: Dict[int, SaliencyMaskStore] = {}
+        self._mask_builds: Dict[int, threading.Thread] = {}
+        self._mask_lock = threading.Lock()
+        if saliency_masks is not None:
+            self._saliency_masks[saliency_masks.resolution] = saliency_masks
+        self._category_index = {c: i for i, c in enumerate(categories)}
+        self._labels = self._unique_in_order(label_codes)
+        self._predictions = self._unique_in_order(prediction_codes)
+
+        # Rank of each category in alphabetical order, used to reproduce the
+        # sorted group order of pandas' groupby.
+        self.category_rank = np.empty(len(categories), dtype=np.int64)
+        self.category_rank[np.argsort(categories.astype(str),
+                                      kind='stable')] = np.arange(
+            len(categories))
+
+        # IDs are looked up by binary search rather than a dict, so the
+        # index can be memory-mapped and shared like the other arrays.
+        self.id_order = id_order if id_order is not None else np.argsort(
+            ids, kind='stable')
+        self.sorted_ids = sorted_ids if sorted_ids is not None else \
+            ids[self.id_order]
+
+        self.bitmaps = bitmaps or BitmapIndex(label_codes, prediction_codes,
+                                              len(categories))
+        self.sort_orders = dict(sort_orders or {})
+        for score_fn, values in scores.items():
+            if score_fn not in self.sort_orders:
+                self.sort_orders[score_fn] = self._sort_orders(values)
+
+    @classmethod
+    def from_dataframe(cls, name: str, df: pd.DataFrame) -> 'CaseStudy':
+        """Builds a case study from a dataframe indexed by image ID."""
+        n = len(df)
+        codes, categories = pd.factorize(
+            np.concatenate([df.label.to_numpy(dtype=object),
+                            df.prediction.to_numpy(dtype=object)]))
+        codes = codes.astype(np.int32)
+        scores = {column: np.ascontiguousarray(df[column], dtype=np.float64)
+                  for column in df.columns
+                  if column not in RECORD_COLUMNS
+                  and pd.api.types.is_numeric_dtype(df[column])}
+        columns = {'image': df['image'].to_numpy(dtype=object)}
+        for column in df.columns:
+            if is_polygon_column(column):
+                columns[column] = PolygonColumn.from_strings(
+                    df[column].to_numpy(dtype=object))
+        threshold_histograms = {}
+        methods = [''] + [
+            column.partition(METHOD_SEPARATOR)[2] for column in df.columns
+            if column.startswith(HISTOGRAM_COLUMNS[0] + METHOD_SEPARATOR)]
+        for method in methods:
+            if all(column in df.columns
+                   for column in histogram_columns(method)):
+                threshold_histograms[method] = ThresholdHistograms(
+                    *[np.array(df[column].tolist(), dtype=np.int32)
+                      for column in histogram_columns(method)])
+        return cls(name, df.index.to_numpy(dtype=object),
+                   np.asarray(categories, dtype=object), codes[:n], codes[n:],
+                   scores, columns, threshold_histograms=threshold_histograms)
+
+    @classmethod
+    def from_json(cls, name: str, path: str) -> 'CaseStudy':
+        """Loads a case study from a `generate_datasets.py` JSON file."""
+        return cls.from_dataframe(name,
+                                  pd.read_json(path).set_index('fname'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self) -> int:
+        """Estimated memory held by the case study's columns and indexes."""
+        arrays = [self.ids, self.label_codes, self.prediction_codes,
+                  self.correct, self.id_order, self.sorted_ids,
+                  self.bitmaps.labels, self.bitmaps.predictions,
+                  self.bitmaps.correct, self.bitmaps.incorrect]
+        arrays += list(self.scores.values())
+        arrays += [order for orders in self.sort_orders.values()
+                   for order in orders]
+        for histograms in self.threshold_histograms.values():
+            arrays += [histograms.inside, histograms.outside]
+        total = sum(array.nbytes for array in arrays)
+        for values in self.columns.values():
+            if isinstance(values, np.ndarray):
+                total += sizeof(values) + sum(sizeof(v) for v in values)
+            else:  # A BlobColumn or PolygonColumn
+                total += values.blob.nbytes + values.offsets.nbytes
+        return total
+
+    def labels(self) -> List[str]:
+        """The unique labels in order of first appearance."""
+        return list(self._labels)
+
+    def predictions(self) -> List[str]:
+        """The unique predictions in order of first appearance."""
+        return list(self._predictions)
+
+    def category_code(self, value: str) -> Optional[int]:
+        """The category code of a label or prediction, or None if unknown."""
+        return self._category_index.get(value)
+
+    def score(self, score_fn: str) -> np.ndarray:
+        """The score array for score_fn. Raises KeyError if it is unknown."""
+        return self.scores[score_fn]
+
+    def filter_bits(self, prediction_fn: str,
+                    label_filter: str) -> np.ndarray:
+        """Bitset of the images passing the prediction and label filter.
+
+        Args:
+            prediction_fn: 'all_images', 'correct_only', 'incorrect_only', or
+                           any prediction value.
+            label_filter: Any label value or '' for all labels.
+
+        Returns:
+            A packed bitset from the case study's `BitmapIndex`.
+        """
+        if prediction_fn == 'all_images':
+            bits = self.bitmaps.all()
+        elif prediction_fn == 'correct_only':
+            bits = self.bitmaps.correct
+        elif prediction_fn == 'incorrect_only':
+            bits = self.bitmaps.incorrect
+        else:  # Assume prediction_fn is a label
+            bits = self.bitmaps.prediction(self.category_code(prediction_fn))
+
+        if label_filter != '':
+            bits = bits & self.bitmaps.label(self.category_code(label_filter))
+        return bits
+
+    def filter_mask(self, prediction_fn: str, label_filter: str) -> np.ndarray:
+        """Boolean mask of the images passing the prediction and label filter.
+
+        See `filter_bits` for the arguments.
+        """
+        return self.bitmaps.unpack(self.filter_bits(prediction_fn,
+                                                    label_filter))
+
+    def count(self, prediction_fn: str, label_filter: str) -> int:
+        """The number of images passing the prediction and label filter."""
+        return self.bitmaps.count(self.filter_bits(prediction_fn,
+                                                   label_filter))
+
+    def sort_rows(self, mask: np.ndarray, score_fn: str,
+                  ascending: bool) -> np.ndarray:
+        """Row positions passing mask, stably sorted by the score_fn score.
+
+        Walks the presorted permutation of score_fn, so the cost is linear in
+        the dataset size rather than a sort per query. Ties keep dataset order
+        and NaN scores sort last in both directions, matching a pandas
+        mergesort.
+        """
+        ascending_order, descending_order = self.sort_orders[score_fn]
+        order = ascending_order if ascending else descending_order
+        return order[mask[order]]
+
+    def histograms(self, selection: np.ndarray, score_fns: Sequence[str],
+                   bins: np.ndarray) -> Dict[str, np.ndarray]:
+        """Histograms of several score functions over the same images.
+
+        The bin index of every score is found in one vectorized pass, with the
+        same semantics as `np.histogram`: bins are half-open except the last,
+        and scores outside the bins or NaN are not counted.
+
+        Args:
+            selection: A boolean mask or row positions of the images.
+            score_fns: The score functions to bin.
+            bins: The monotonically increasing bin edges.
+
+        Returns:
+            Mapping from score function to its len(bins) - 1 counts.
+        """
+        num_bins = len(bins) - 1
+        values = np.stack([self.scores[score_fn][selection]
+                           for score_fn in score_fns])
+        indices = np.searchsorted(bins, values, side='right') - 1
+        indices[values == bins[-1]] = num_bins - 1
+        with np.errstate(invalid='ignore'):
+            valid = (values >= bins[0]) & (values <= bins[-1])
+        offsets = np.arange(len(score_fns))[:, None] * num_bins
+        counts = np.bincount((indices + offsets)[valid],
+                             minlength=len(score_fns) * num_bins)
+        return dict(zip(score_fns, counts.reshape(len(score_fns), num_bins)))
+
+    def contingency(self, score_fn: Optional[str] = None) -> np.ndarray:
+        """Dense label x prediction tables, built once per score function.
+
+        Args:
+            score_fn: The score function to aggregate, or None for the image
+                      counts only.
+
+        Returns:
+            The (num_categories, num_categories) count matrix if score_fn is
+            None. Otherwise a (3, num_categories, num_categories) array of the
+            count of non-NaN scores, their sum and their sum of squares.
+        """
+        tables = self._contingency.get(score_fn)
+        if tables is None:
+            k = len(self.categories)
+            cells = self.label_codes.astype(np.int64) * k \
+                + self.prediction_codes
+            if score_fn is None:
+                tables = np.bincount(cells, minlength=k * k).reshape(k, k)
+            else:
+                scores = self.scores[score_fn]
+                valid = ~np.isnan(scores)
+                cells, scores = cells[valid], scores[valid]
+                tables = np.stack([
+                    np.bincount(cells, minlength=k * k),
+                    np.bincount(cells, weights=scores, minlength=k * k),
+                    np.bincount(cells, weights=scores ** 2,
+                                minlength=k * k)]).reshape(3, k, k)
+            self._contingency[score_fn] = tables
+        return tables
+
+    def confusion_matrix(self, label_filter: str, score_fn: str,
+                         n: int) -> List[dict]:
+        """The confusion matrix cells of the top n confused labels.
+
+        Sliced from the precomputed `contingency` tables, so the cost depends
+        on the number of categories rather than the number of images.
+
+        Args:
+            label_filter: Any label value or '' for all labels.
+            score_fn: The score function to average in each cell.
+            n: The maximum number of confused labels and predictions.
+
+        Returns:
+            A list of dictionaries with the label, prediction, count, mean and
+            variance of the scores of every non-empty cell, sorted by label
+            then prediction. NaN scores are not counted.
+        """
+        counts = self.contingency()
+        incorrect = counts.sum(axis=1) - np.diagonal(counts)
+        if label_filter != '':
+            label_code = self.category_code(label_filter)
+            incorrect = np.where(np.arange(len(incorrect)) == label_code,
+                                 incorrect, 0)
+        confused_labels = self._top_codes(incorrect, n)
+        top_predictions = self._top_codes(
+            counts[confused_labels].sum(axis=0), n)
+        matrix_codes = np.union1d(confused_labels, top_predictions)
+
+        # Order the matrix codes alphabetically so cells come out sorted.
+        matrix_codes = matrix_codes[np.argsort(
+            self.category_rank[matrix_codes])]
+        cells = np.ix_(matrix_codes, matrix_codes)
+        labels, predictions = np.nonzero(counts[cells])
+        num_scores, sums, squares = (
+            table[cells][labels, predictions]
+            for table in self.contingency(score_fn))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / num_scores
+            variances = np.maximum(squares / num_scores - means ** 2, 0)
+        return [{'label': self.categories[matrix_codes[label]],
+                 'prediction': self.categories[matrix_codes[prediction]],
+                 'count': int(count),
+                 'mean': float(mean),
+                 'variance': float(variance)}
+                for label, prediction, count, mean, variance in zip(
+                    labels, predictions, num_scores, means, variances)]
+
+    def rows(self, image_ids: Sequence[str]) -> np.ndarray:
+        """Row positions of image_ids. Raises KeyError for unknown IDs."""
+        query = np.array(image_ids, dtype=object
+                         if self.sorted_ids.dtype == object else str)
+        positions = np.searchsorted(self.sorted_ids, query, side='right') - 1
+        found = positions >= 0
+        found[found] = self.sorted_ids[positions[found]] == query[found]
+        if not found.all():
+            raise KeyError(query[~found][0])
+        return self.id_order[positions].astype(np.int64)
+
+    def records(self, rows: np.ndarray, score_fn: str,
+                polygon_format: str = 'text', lod: int = 0) -> List[dict]:
+        """The saliency image records at rows with 'score' set to score_fn.
+
+        Args:
+            rows: The row positions of the images.
+            score_fn: The score function to set as the 'score' key. The
+                      'saliency' key is that of the score's explanation
+                      method, see `saliency_column`.
+            polygon_format: The format of the bbox and saliency polygons, see
+                            `PolygonColumn.values`.
+            lod: The level of detail of the polygons.
+        """
+        score = self.scores[score_fn][rows].tolist()
+        columns = {'image': self.columns['image'][rows].tolist()}
+        for column, source in [('bbox', 'bbox'),
+                               ('saliency', self.saliency_column(score_fn))]:
+            columns[column] = self.columns[source].values(
+                rows, polygon_format, lod)
+        columns['label'] = self.categories[self.label_codes[rows]].tolist()
+        columns['prediction'] = self.categories[
+            self.prediction_codes[rows]].tolist()
+        return [dict({column: values[i] for column, values in columns.items()},
+                     score=score[i]) for i in range(len(rows))]
+
+    def saliency_column(self, score_fn: str) -> str:
+        """The saliency column of the explanation method scored by score_fn.
+
+        'iou.lime' selects 'saliency.lime' if the case study has it; scores
+        without a method suffix select the first method's 'saliency'.
+        """
+        _, separator, method = score_fn.partition(METHOD_SEPARATOR)
+        column = 'saliency' + separator + method
+        return column if column in self.columns else 'saliency'
+
+    def image_bytes(self, row: int) -> bytes:
+        """The JPEG bytes of the image at row."""
+        return base64.b64decode(self.columns['image'][row])
+
+    def image_hash(self, row: int) -> str:
+        """A content hash of the image at row, computed once per image."""
+        image_hash = self._image_hashes.get(row)
+        if image_hash is None:
+            image_hash = hashlib.sha1(
+                self.columns['image'][row].encode()).hexdigest()
+            self._image_hashes[row] = image_hash
+        return image_hash
+
+    def saliency_masks(self, resolution: int = DEFAULT_RESOLUTION,
+                       timeout: Optional[float] = None
+                       ) -> Optional[SaliencyMaskStore]:
+        """The rasterized saliency masks, built once on first use.
+
+        Binary case studies store their masks. Otherwise the first call starts
+        rasterizing them in a background thread, and concurrent calls wait for
+        that single build rather than starting their own.
+
+        Args:
+            resolution: The side of the masks in pixels.
+            timeout: The maximum number of seconds to wait for the build, or
+                     None to wait until it is done.
+
+        Returns:
+            The masks, or None if they are still being built after timeout.
+
+        Raises:
+            RuntimeError: If the build failed. The next call retries it.
+        """
+        store = self._saliency_masks.get(resolution)
+        if store is not None:
+            return store
+        with self._mask_lock:
+            build = self._mask_builds.get(resolution)
+            if build is None and resolution not in self._saliency_masks:
+                build = threading.Thread(target=self._build_saliency_masks,
+                                         args=(resolution,), daemon=True)
+                self._mask_builds[resolution] = build
+                build.start()
+        if build is not None:
+            build.join(timeout)
+            if build.is_alive():
+                return None
+        store = self._saliency_masks.get(resolution)
+        if store is None:
+            raise RuntimeError('Rasterizing the saliency masks of %s failed' %
+                               self.name)
+        return store
+
+    def _build_saliency_masks(self, resolution: int):
+        try:
+            saliency = self.columns['saliency']
+            points, points_per_polygon, polygons_per_row = saliency.decode(
+                np.arange(len(saliency)))
+            polygons = np.split(points, np.cumsum(points_per_polygon)[:-1]) \
+                if len(points_per_polygon) else []
+            row_ends = np.cumsum(polygons_per_row).tolist()
+            self._saliency_masks[resolution] = SaliencyMaskStore.from_polygons(
+                [polygons[end - count:end] for end, count in
+                 zip(row_ends, polygons_per_row.tolist())], resolution)
+        except Exception:
+            # Reported to the waiting callers as a RuntimeError.
+            traceback.print_exc()
+        finally:
+            with self._mask_lock:
+                del self._mask_builds[resolution]
+
+    @staticmethod
+    def _sort_orders(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Stable ascending and descending permutations of values."""
+        return sort_order(values, True), sort_order(values, False)
+
+    def _top_codes(self, counts: np.ndarray, n: int) -> np.ndarray:
+        """The n codes with the highest counts, ties broken alphabetically."""
+        present = np.flatnonzero(counts)
+        present = present[np.argsort(self.category_rank[present])]
+        return present[np.argsort(-counts[present], kind='stable')][:n]
+
+    def _unique_in_order(self, codes: np.ndarray) -> List[str]:
+        unique, first = np.unique(codes, return_index=True)
+        return self.categories[unique[np.argsort(first)]].tolist()
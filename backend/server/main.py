@@ -1,17 +1,32 @@
 import argparse
+import hashlib
 import os
+import re
+import warnings
+from urllib.parse import quote
 from typing import *
 
 import numpy as np
-import pandas as pd
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, RedirectResponse
-from pydantic import BaseModel
+from fastapi.responses import (FileResponse, RedirectResponse, Response,
+                               StreamingResponse)
+from pydantic import BaseModel, ValidationError, parse_obj_as
+from starlette.concurrency import run_in_threadpool
 
 import backend.server.api as api
+import backend.server.compression as compression
 import backend.server.path_fixes as pf
+from backend.server.cache import QueryCache, make_key
+from backend.server.dataset import METHOD_SEPARATOR, CaseStudy, sort_order
+from backend.server.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from backend.server.metrics import (Metrics, MetricsMiddleware, cache_metrics,
+                                    dataset_metrics)
+from backend.server.registry import DatasetRegistry
+from backend.server.responses import FastJSONResponse, dumps
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -26,6 +41,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresses JSON responses of at least COMPRESSION_MIN_BYTES with the gzip or
+# brotli (if installed) encoding the client accepts.
+app.add_middleware(
+    compression.CompressionMiddleware,
+    minimum_size=int(os.environ.get('COMPRESSION_MIN_BYTES', 1024)),
+)
+# Request, cache and dataset metrics served on /metrics. Set
+# METRICS_STAGE_TIMERS=1 to also time the stages of the handlers. Added last,
+# so it measures the compressed responses.
+metrics = Metrics(
+    stage_timers=os.environ.get('METRICS_STAGE_TIMERS', '0') != '0')
+app.add_middleware(MetricsMiddleware, metrics=metrics,
+                   routes=lambda: app.routes)
 
 prefix = os.environ.get('CLIENT_PREFIX', 'client')
 
@@ -62,8 +90,9 @@ def send_static_client(file_path: str):
 # ======================================================================
 class SaliencyImage(BaseModel):
     image: str
-    bbox: list
-    saliency: list
+    # Lists of polygon strings, or base64 strings with polygon_format='binary'
+    bbox: Union[list, str]
+    saliency: Union[list, str]
     label: str
     prediction: str
     score: str
@@ -80,14 +109,150 @@ class ConfusionMatrix(BaseModel):
     prediction: str
     count: int
     mean: float
+    variance: float
+
+
+class ImageScores(BaseModel):
+    image_id: str
+    iou: Optional[float]
+    ground_truth_coverage: Optional[float]
+    explanation_coverage: Optional[float]
+
+
+class ThresholdCurve(BaseModel):
+    thresholds: List[float]
+    iou: List[Optional[float]]
+    ground_truth_coverage: List[Optional[float]]
+    explanation_coverage: List[Optional[float]]
+
+
+class CaseStudyInfo(BaseModel):
+    name: str
+    loaded: bool
+    num_images: Optional[int]
+    nbytes: Optional[int]
+    load_seconds: Optional[float]
+
+
+class ImagesPage(BaseModel):
+    image_ids: List[str]
+    total: int
+    next_offset: Optional[int]
+
 
+class Dashboard(BaseModel):
+    image_ids: List[str]
+    total: int
+    next_offset: Optional[int]
+    bins: List[Bins]
+    confusion_matrix: List[ConfusionMatrix]
+    labels: List[str]
+    predictions: List[str]
 
-# Load case study datasets
-datasets = ['data_dogs', 'data_vehicle', 'data_melanoma']
-dataframes = {}
-for dataset in datasets:
-    dataframe = pd.read_json("./data/examples/%s.json" % dataset)
-    dataframes[dataset] = dataframe.set_index('fname')
+
+# Set FAST_JSON=1 to send results with FastJSONResponse, skipping their
+# validation against the response_model, which then only documents the API.
+FAST_JSON = os.environ.get('FAST_JSON', '0') != '0'
+
+
+def respond(content: Any, endpoint: str) -> Any:
+    """Returns content, as a FastJSONResponse if FAST_JSON is set.
+
+    Otherwise FastAPI validates and serializes content after the handler
+    returns, outside of endpoint's 'serialize' stage timer.
+    """
+    if not FAST_JSON:
+        return content
+    with metrics.stage(endpoint, 'serialize'):
+        return FastJSONResponse(content)
+
+
+# Results of the filter endpoints, bounded by QUERY_CACHE_BYTES (256MB).
+query_cache = QueryCache(
+    int(os.environ.get('QUERY_CACHE_BYTES', 256 * 1024 * 1024)))
+
+
+async def cached_query(key: tuple, query: Callable[[], Any]) -> Any:
+    """Runs query in a worker thread through the query cache.
+
+    Concurrent requests with the same key share a single computation.
+    """
+
+    def lookup():
+        with metrics.stage(key[0], 'query'):
+            # Reloads the case study, invalidating its results, if it changed.
+            case_studies[key[1]]
+            return query_cache.get_or_compute(key, query)
+
+    return await run_in_threadpool(lookup)
+
+
+async def precompressed_query(key: tuple, query: Callable[[], Any],
+                              request: Request,
+                              response_model: Any) -> Response:
+    """Runs query through the query cache, caching its compressed JSON.
+
+    The result is serialized and compressed with every supported encoding
+    once, so repeated requests only pick the encoding the client accepts.
+    Unless FAST_JSON is set, it is first validated and coerced against the
+    endpoint's response_model, as FastAPI does for the other endpoints.
+    """
+    def compressed_query():
+        result = query()
+        with metrics.stage(key[0], 'serialize'):
+            if not FAST_JSON:
+                result = jsonable_encoder(parse_obj_as(response_model, result))
+            body = dumps(result)
+        with metrics.stage(key[0], 'compress'):
+            return compression.precompress(body)
+
+    # The validated and the FAST_JSON bodies are cached separately.
+    endpoint, case_study, params = key
+    bodies = await cached_query(
+        (endpoint, case_study, params + (('fast_json', FAST_JSON),)),
+        compressed_query)
+    return compression.precompressed_response(
+        bodies, request.headers.get('accept-encoding'))
+
+
+# Case study datasets discovered in DATA_DIR, each loaded on first access and
+# reloaded when its file changes. Binary `.si` datasets converted with
+# `python -m backend.server.storage` are memory-mapped. Set MEMORY_BUDGET (in
+# bytes) to evict the least recently used datasets, and SHARED_DATA_DIR (e.g.
+# /dev/shm/shared-interest) to share one copy of each dataset across workers.
+case_studies = DatasetRegistry(
+    os.environ.get('DATA_DIR', './data/examples'),
+    memory_budget=int(os.environ['MEMORY_BUDGET'])
+    if 'MEMORY_BUDGET' in os.environ else None,
+    on_change=query_cache.invalidate,
+    shared_directory=os.environ.get('SHARED_DATA_DIR'))
+
+metrics.collect(lambda: cache_metrics(query_cache.stats(), metrics.prefix))
+metrics.collect(lambda: dataset_metrics(case_studies.info(), metrics.prefix))
+
+
+@app.get("/api/case-studies", response_model=List[CaseStudyInfo])
+async def get_case_studies():
+    """Lists the case studies that can be served and which are loaded."""
+    return respond(case_studies.info(), 'case-studies')
+
+
+async def query_images(case_study: str, sort_by: int, prediction_fn: str,
+                       score_fn: str, label_filter: str) -> List[str]:
+    """The sorted and filtered image IDs of get-images, through the cache."""
+
+    def query():
+        dataset = case_studies[case_study]
+        with metrics.stage('get-images', 'filter'):
+            mask = dataset.filter_mask(prediction_fn, label_filter)
+        with metrics.stage('get-images', 'sort'):
+            rows = dataset.sort_rows(mask, score_fn, ascending=sort_by == 1)
+        return dataset.ids[rows].tolist()
+
+    key = make_key('get-images', case_study, sort_by=sort_by,
+                   prediction_fn=prediction_fn, score_fn=score_fn,
+                   label_filter=label_filter)
+    return await cached_query(key, query)
 
 
 @app.get("/api/get-images", response_model=List[str])
@@ -108,45 +273,164 @@ async def get_images(case_study: str, sort_by: int, prediction_fn: str,
         A list of image IDs from case_study filtered given the prediction_fn and
          label_filter and sorted by the score_fn in sort_by order.
     """
-    df = dataframes[case_study]
-    if prediction_fn == "all_images":
-        pred_inds = np.ones(len(df))
-    elif prediction_fn == "correct_only":
-        pred_inds = df.label == df.prediction
-    elif prediction_fn == "incorrect_only":
-        pred_inds = df.label != df.prediction
-    else:  # Assume predictionFn is a label
-        pred_inds = df.prediction == prediction_fn
-
-    if label_filter == '':
-        label_inds = np.ones(len(df))
-    else:
-        label_inds = df.label == label_filter
+    image_ids = await query_images(case_study, sort_by, prediction_fn,
+                                   score_fn, label_filter)
+    return respond(image_ids, 'get-images')
+
+
+@app.get("/api/get-images-page", response_model=ImagesPage)
+async def get_images_page(case_study: str, sort_by: int, prediction_fn: str,
+                          score_fn: str, label_filter: str, offset: int = 0,
+                          limit: int = 100):
+    """ Get one page of the images returned by get-images.
+
+    Args:
+        case_study: The name of the case study dataset.
+        sort_by: 1 if ascending, -1 if descending.
+        prediction_fn: The prediction function. It can be 'all_images',
+                       'correct_only', 'incorrect_only', or any label.
+        score_fn: The score function name to apply.
+        label_filter: The label filter to apply. It can be any label name or ''
+                      for all labels.
+        offset: The position of the first image ID of the page.
+        limit: The maximum number of image IDs in the page.
+
+    Returns:
+        The page of image IDs, the total number of matching images, and the
+        offset of the next page, or None if this is the last page.
+    """
+    image_ids = await query_images(case_study, sort_by, prediction_fn,
+                                   score_fn, label_filter)
+    offset = max(offset, 0)
+    end = offset + max(limit, 0)
+    page = {'image_ids': image_ids[offset:end],
+            'total': len(image_ids),
+            'next_offset': end if end < len(image_ids) else None}
+    return respond(page, 'get-images-page')
 
-    mask = np.logical_and(pred_inds, label_inds)
-    filtered_df = df.loc[mask].sort_values(score_fn, kind="mergesort",
-                                           ascending=sort_by == 1)
-    image_ids = list(filtered_df.index)
-    return image_ids
+
+@app.get("/api/get-image-count", response_model=int)
+async def get_image_count(case_study: str, prediction_fn: str,
+                          label_filter: str):
+    """ Counts the images matching the current filters without listing them.
+
+    Args:
+        case_study: The name of the case study dataset.
+        prediction_fn: The prediction function. It can be 'all_images',
+                       'correct_only', 'incorrect_only', or any label.
+        label_filter: The label filter to apply. It can be any label name or ''
+                      for all labels.
+
+    Returns:
+        The number of images in case_study passing prediction_fn and
+        label_filter.
+    """
+    return await run_in_threadpool(
+        lambda: case_studies[case_study].count(prediction_fn, label_filter))
+
+
+def saliency_records(dataset: CaseStudy, rows: np.ndarray, score_fn: str,
+                     image_format: str, polygon_format: str = 'text',
+                     lod: int = 0) -> List[dict]:
+    """Saliency image records of rows, with the image in image_format.
+
+    Args:
+        dataset: The case study.
+        rows: The row positions of the images.
+        score_fn: The score function to set as the 'score' key.
+        image_format: 'base64' to inline the JPEG or 'url' to replace it with
+                      its content-addressed URL relative to the API root.
+        polygon_format: 'text' for lists of 'x,y x,y ...' polygon strings or
+                        'binary' for the base64 encoding of the polygons
+                        described in polygons.py.
+        lod: The level of detail of the polygons, from 0 (every vertex) to 3
+             (coarsest, for thumbnails).
+    """
+    with metrics.stage('saliency-records', 'records'):
+        records = dataset.records(rows, score_fn, polygon_format, lod)
+        for record in records:  # SaliencyImage declares the score as a str
+            record['score'] = str(record['score'])
+    if image_format == 'url':
+        with metrics.stage('saliency-records', 'image_urls'):
+            for row, record in zip(rows, records):
+                record['image'] = 'image/%s/%s?v=%s' % (
+                    quote(dataset.name, safe=''),
+                    quote(dataset.ids[row], safe=''), dataset.image_hash(row))
+    return records
 
 
 @app.get("/api/get-saliency-image", response_model=SaliencyImage)
-async def get_saliency_image(case_study: str, image_id: str, score_fn: str):
+async def get_saliency_image(case_study: str, image_id: str, score_fn: str,
+                             request: Request, image_format: str = 'base64',
+                             polygon_format: str = 'text', lod: int = 0):
     """Gets a single saliency image.
 
     Args:
         case_study: The name of the case study dataset.
         image_id: The id of the image to return.
         score_fn: The score function to return.
+        image_format: 'base64' to inline the JPEG or 'url' to return the URL of
+                      the image, relative to the API root.
+        polygon_format: 'text' or 'binary' (see `saliency_records`).
+        lod: The level of detail of the polygons, 0 for every vertex.
 
     Returns:
         A dictionary of the image data for image_id from case_study. The 'score'
          key is set to the score_fn value.
     """
-    df = dataframes[case_study]
-    filtered_df = df.loc[image_id]
-    filtered_df['score'] = filtered_df[score_fn]
-    return filtered_df.to_dict()
+    def query():
+        dataset = case_studies[case_study]
+        return saliency_records(dataset, dataset.rows([image_id]), score_fn,
+                                image_format, polygon_format, lod)[0]
+
+    key = make_key('get-saliency-image', case_study, image_id=image_id,
+                   score_fn=score_fn, image_format=image_format,
+                   polygon_format=polygon_format, lod=lod)
+    return await precompressed_query(key, query, request, SaliencyImage)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches etag.
+
+    The header is '*' or a comma-separated list of entity tags, and tags are
+    compared with the weak comparison of RFC 7232: 'W/"abc"' matches '"abc"'.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag[2:] if etag.startswith('W/') else etag
+    return opaque_tag in re.findall(r'(?:W/)?("[^"]*")', if_none_match)
+
+
+@app.get("/api/image/{case_study}/{image_id}")
+async def get_image(case_study: str, image_id: str, request: Request):
+    """Gets the JPEG of an image as a cacheable binary resource.
+
+    The ETag is a hash of the image content, which saliency records in 'url'
+    format also carry in the query string, so the response can be cached
+    indefinitely.
+
+    Args:
+        case_study: The name of the case study dataset.
+        image_id: The id of the image to return.
+
+    Returns:
+        The image/jpeg bytes, or 304 Not Modified if the request's
+        If-None-Match header matches the image's ETag.
+    """
+    def query():
+        dataset = case_studies[case_study]
+        row = dataset.rows([image_id])[0]
+        headers = {'ETag': '"%s"' % dataset.image_hash(row),
+                   'Cache-Control': 'public, max-age=31536000, immutable'}
+        if etag_matches(request.headers.get('if-none-match'),
+                        headers['ETag']):
+            return Response(status_code=304, headers=headers)
+        return Response(dataset.image_bytes(row), media_type='image/jpeg',
+                        headers=headers)
+
+    return await run_in_threadpool(query)
 
 
 @app.post("/api/get-saliency-images", response_model=List[SaliencyImage])
@@ -163,33 +447,90 @@ async def get_saliency_images(payload: api.ImagesPayload):
             the payload.
         """
     payload = api.ImagesPayload(**payload)
-    df = dataframes[payload.case_study]
-    filtered_df = df.loc[payload.image_ids]
-    filtered_df['score'] = filtered_df[payload.score_fn]
-    return filtered_df.to_dict('records')
+
+    def query():
+        dataset = case_studies[payload.case_study]
+        return saliency_records(dataset, dataset.rows(payload.image_ids),
+                                payload.score_fn, payload.image_format,
+                                payload.polygon_format, payload.lod)
+
+    return respond(await run_in_threadpool(query), 'get-saliency-images')
+
+
+@app.post("/api/stream-saliency-images")
+async def stream_saliency_images(payload: api.ImagesPayload,
+                                 chunk_size: int = 64):
+    """Streams saliency images as newline-delimited JSON.
+
+    Records are serialized chunk_size at a time, so the client can render the
+    first images while the rest are still being produced.
+
+    Args:
+        payload: The payload containing the name of the case study, image
+                 IDs, and the score function.
+        chunk_size: The number of records serialized per chunk.
+
+    Returns:
+        An application/x-ndjson response with one SaliencyImage per line, in
+        the order of the image IDs in the payload.
+    """
+    payload = api.ImagesPayload(**payload)
+
+    def query():
+        dataset = case_studies[payload.case_study]
+        return dataset, dataset.rows(payload.image_ids)
+
+    dataset, rows = await run_in_threadpool(query)
+    chunk_size = max(chunk_size, 1)
+
+    # Starlette iterates the generator in its threadpool as well.
+    def lines():
+        for start in range(0, len(rows), chunk_size):
+            records = saliency_records(dataset,
+                                       rows[start:start + chunk_size],
+                                       payload.score_fn, payload.image_format,
+                                       payload.polygon_format, payload.lod)
+            if FAST_JSON:
+                yield b''.join(dumps(record) + b'\n' for record in records)
+            else:
+                yield ''.join(SaliencyImage(**record).json() + '\n'
+                              for record in records)
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
 
 
 @app.get("/api/get-labels", response_model=List[str])
-async def get_labels(case_study: str):
+async def get_labels(case_study: str, request: Request):
     """Gets the label values given the case study."""
-    df = dataframes[case_study]
-    return list(df.label.unique())
+    key = make_key('get-labels', case_study)
+    return await precompressed_query(
+        key, lambda: case_studies[case_study].labels(), request, List[str])
 
 
 @app.get("/api/get-predictions", response_model=List[str])
-async def get_predictions(case_study: str):
+async def get_predictions(case_study: str, request: Request):
     """Gets the possible prediction values given the case study."""
-    df = dataframes[case_study]
-    return list(df.prediction.unique())
+    key = make_key('get-predictions', case_study)
+    return await precompressed_query(
+        key, lambda: case_studies[case_study].predictions(), request,
+        List[str])
+
+
+def bin_objects(hist: np.ndarray, bin_edges: np.ndarray) -> List[dict]:
+    """Converts histogram counts and edges to Bins dictionaries."""
+    return [{'x0': bin_edges[i], 'x1': bin_edges[i + 1], 'num': num}
+            for i, num in enumerate(list(hist))]
 
 
 @app.post("/api/bin-scores", response_model=List[Bins])
-async def bin_scores(payload: api.ImagesPayload, min_range: int = 0,
+async def bin_scores(payload: api.BinScoresPayload, min_range: int = 0,
                      max_range: int = 1, num_bins: int = 11):
     """Bins the scores of the images.
 
     Args:
-        payload: The payload containing the case study, images, and score fn.
+        payload: The payload containing the case study and score fn, and either
+                 the image IDs or the prediction_fn and label_filter of
+                 get-images selecting the images.
         min_range: The start of the bin range, inclusive. Defaults to 0.
         max_range: The end of the bin range, inclusive. Defaults to 1.
         num_bins: The number of bins to create. Defaults to 11.
@@ -198,15 +539,64 @@ async def bin_scores(payload: api.ImagesPayload, min_range: int = 0,
         A list of dictionary objects containing the start, end, and number of
         scores in each bin.
     """
-    payload = api.ImagesPayload(**payload)
-    df = dataframes[payload.case_study]
-    filtered_df = df.loc[payload.image_ids]
-    scores = filtered_df[payload.score_fn].tolist()
-    bins = np.linspace(min_range, max_range, num_bins)
-    hist, bin_edges = np.histogram(scores, bins)
-    bin_object = [{'x0': bin_edges[i], 'x1': bin_edges[i + 1], 'num': num}
-                  for i, num in enumerate(list(hist))]
-    return bin_object
+    payload = api.BinScoresPayload(**payload)
+
+    def query():
+        dataset = case_studies[payload.case_study]
+        if payload.image_ids is None:
+            selection = dataset.filter_mask(payload.prediction_fn,
+                                            payload.label_filter)
+        else:
+            selection = dataset.rows(payload.image_ids)
+        bins = np.linspace(min_range, max_range, num_bins)
+        hist = dataset.histograms(selection, [payload.score_fn],
+                                  bins)[payload.score_fn]
+        return bin_objects(hist, bins)
+
+    if payload.image_ids is None:
+        selection = {'prediction_fn': payload.prediction_fn,
+                     'label_filter': payload.label_filter}
+    else:
+        selection = {'image_ids': hashlib.sha1(
+            '\n'.join(payload.image_ids).encode()).hexdigest()}
+    key = make_key('bin-scores', payload.case_study,
+                   score_fn=payload.score_fn, min_range=min_range,
+                   max_range=max_range, num_bins=num_bins, **selection)
+    bin_object = await cached_query(key, query)
+    return respond(bin_object, 'bin-scores')
+
+
+@app.get("/api/bin-all-scores", response_model=Dict[str, List[Bins]])
+async def bin_all_scores(case_study: str, prediction_fn: str,
+                         label_filter: str, min_range: int = 0,
+                         max_range: int = 1, num_bins: int = 11):
+    """Bins the scores of every score function in one pass.
+
+    Args:
+        case_study: The name of the case study dataset.
+        prediction_fn: The prediction function. It can be 'all_images',
+                       'correct_only', 'incorrect_only', or any label.
+        label_filter: The label filter to apply. It can be any label name or ''
+                      for all labels.
+        min_range: The start of the bin range, inclusive. Defaults to 0.
+        max_range: The end of the bin range, inclusive. Defaults to 1.
+        num_bins: The number of bins to create. Defaults to 11.
+
+    Returns:
+        A dictionary from score function name to its list of bins.
+    """
+    def query():
+        dataset = case_studies[case_study]
+        mask = dataset.filter_mask(prediction_fn, label_filter)
+        bins = np.linspace(min_range, max_range, num_bins)
+        return {score_fn: bin_objects(hist, bins) for score_fn, hist in
+                dataset.histograms(mask, list(dataset.scores), bins).items()}
+
+    key = make_key('bin-all-scores', case_study, prediction_fn=prediction_fn,
+                   label_filter=label_filter, min_range=min_range,
+                   max_range=max_range, num_bins=num_bins)
+    bin_objects_by_score = await cached_query(key, query)
+    return respond(bin_objects_by_score, 'bin-all-scores')
 
 
 @app.get("/api/confusion-matrix", response_model=List[ConfusionMatrix])
@@ -224,28 +614,262 @@ async def get_confusion_matrix_values(case_study: str, label_filter: str,
     Returns:
         The confusion matrix of the top n confused labels.
     """
-    df = dataframes[case_study]
-    if label_filter == '':
-        filtered_df = df.loc[df.label != df.prediction]
-    else:
-        filtered_df = df.loc[
-            (df.label == label_filter) & (df.label != df.prediction)]
-    confused_labels = filtered_df.groupby('label').agg('count') \
-                          .sort_values('image',
-                                       ascending=False).index.values.tolist()[
-                      :n]
-    top_predictions = df.loc[df.label.isin(confused_labels)].groupby(
-        'prediction').agg('count') \
-                          .sort_values('image',
-                                       ascending=False).index.values.tolist()[
-                      :n]
-    matrix_labels = list(set(top_predictions + confused_labels))
-    confusion_df = df.loc[
-        (df.label.isin(matrix_labels)) & (df.prediction.isin(matrix_labels))]
-    confusion_matrix = confusion_df.groupby(['label', 'prediction']) \
-        .agg(['count', 'mean'])[score_fn] \
-        .reset_index().to_dict('records')
-    return confusion_matrix
+    def query():
+        dataset = case_studies[case_study]
+        return dataset.confusion_matrix(label_filter, score_fn, n)
+
+    key = make_key('confusion-matrix', case_study, label_filter=label_filter,
+                   score_fn=score_fn, n=n)
+    confusion_matrix = await cached_query(key, query)
+    return respond(confusion_matrix, 'confusion-matrix')
+
+
+@app.get("/api/dashboard", response_model=Dashboard)
+async def get_dashboard(case_study: str, sort_by: int, prediction_fn: str,
+                        score_fn: str, label_filter: str, offset: int = 0,
+                        limit: int = None, num_bins: int = 11, n: int = 10):
+    """Gets everything the page shows for the current filters at once.
+
+    Combines get-images(-page), bin-scores, confusion-matrix, get-labels and
+    get-predictions, so a filter change costs the client one round trip, and
+    the filter mask shared by the image IDs and the histogram is computed
+    once.
+
+    Args:
+        case_study: The name of the case study dataset.
+        sort_by: 1 if ascending, -1 if descending.
+        prediction_fn: The prediction function. It can be 'all_images',
+                       'correct_only', 'incorrect_only', or any label.
+        score_fn: The score function to sort, bin and average by.
+        label_filter: The label filter to apply. It can be any label name or ''
+                      for all labels.
+        offset: The position of the first image ID to return.
+        limit: The maximum number of image IDs to return. Defaults to all.
+        num_bins: The number of histogram bin edges between 0 and 1, as in
+                  bin-scores.
+        n: The nxn size of the confusion matrix.
+
+    Returns:
+        The page of sorted image IDs, the total number of matching images and
+        the offset of the next page (None if this is the last page), the bins
+        of the score_fn scores of the matching images, the confusion matrix,
+        and the label and prediction values of the case study.
+    """
+    def query():
+        dataset = case_studies[case_study]
+        with metrics.stage('dashboard', 'filter'):
+            mask = dataset.filter_mask(prediction_fn, label_filter)
+        with metrics.stage('dashboard', 'sort'):
+            rows = dataset.sort_rows(mask, score_fn, ascending=sort_by == 1)
+        bins = np.linspace(0, 1, num_bins)
+        hist = dataset.histograms(mask, [score_fn], bins)[score_fn]
+        return {'image_ids': dataset.ids[rows].tolist(),
+                'bins': bin_objects(hist, bins),
+                'confusion_matrix': dataset.confusion_matrix(label_filter,
+                                                             score_fn, n),
+                'labels': dataset.labels(),
+                'predictions': dataset.predictions()}
+
+    key = make_key('dashboard', case_study, sort_by=sort_by,
+                   prediction_fn=prediction_fn, score_fn=score_fn,
+                   label_filter=label_filter, num_bins=num_bins, n=n)
+    dashboard = dict(await cached_query(key, query))
+    image_ids = dashboard['image_ids']
+    offset = max(offset, 0)
+    end = len(image_ids) if limit is None else offset + max(limit, 0)
+    dashboard.update(image_ids=image_ids[offset:end], total=len(image_ids),
+                     next_offset=end if end < len(image_ids) else None)
+    return respond(dashboard, 'dashboard')
+
+
+def score_records(dataset: CaseStudy, scores: Dict[str, np.ndarray],
+                  score_fn: str, sort_by: int, prediction_fn: str,
+                  label_filter: str, limit: Optional[int]) -> List[dict]:
+    """Ranks the images passing the filters by scores computed on request.
+
+    Args:
+        dataset: The case study the scores belong to.
+        scores: Mapping from score function name to one score per image.
+        score_fn: The score to sort by.
+        sort_by: 1 for ascending, -1 for descending. NaN scores sort last.
+        prediction_fn: The prediction filter, as in get-images.
+        label_filter: The label filter, as in get-images.
+        limit: The maximum number of images to return, or None for all.
+
+    Returns:
+        The image ID and scores of each image, with None for NaN scores.
+    """
+    rows = np.flatnonzero(dataset.filter_mask(prediction_fn, label_filter))
+    rows = rows[sort_order(scores[score_fn][rows], ascending=sort_by == 1)]
+    rows = rows[:limit]
+    columns = {}
+    for name, values in scores.items():
+        values = values[rows]
+        columns[name] = np.where(np.isnan(values), None,
+                                 values.astype(object)).tolist()
+    return [dict({name: values[i] for name, values in columns.items()},
+                 image_id=image_id)
+            for i, image_id in enumerate(dataset.ids[rows].tolist())]
+
+
+# Seconds a rescore request waits for the saliency masks of a case study to
+# be rasterized before it gets a 503 asking the client to retry after
+# MASK_BUILD_RETRY_AFTER seconds.
+MASK_BUILD_TIMEOUT = 10
+MASK_BUILD_RETRY_AFTER = 5
+
+
+@app.post("/api/rescore-region", response_model=List[ImageScores])
+async def rescore_region(payload: api.RegionPayload, limit: int = None):
+    """Scores every image's saliency against a user-drawn ground truth region.
+
+    Saliency regions are compared at the resolution of the case study's
+    rasterized saliency masks, so scores approximate those computed offline
+    at full resolution.
+
+    Args:
+        payload: The payload containing the case study, the query region as
+                 polygons or a mask, and the sort and filters to apply as in
+                 get-images.
+        limit: The maximum number of images to return. Defaults to all.
+
+    Returns:
+        The image ID and region scores of the images passing the filters,
+        sorted by score_fn in sort_by order.
+    """
+    # The body is only validated here (see HashableBaseModel.validate), so a
+    # payload without exactly one region is a 422 like any invalid request.
+    try:
+        payload = api.RegionPayload(**payload)
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors)
+
+    def query():
+        dataset = case_studies[payload.case_study]
+        masks = dataset.saliency_masks(timeout=MASK_BUILD_TIMEOUT)
+        if masks is None:
+            raise HTTPException(
+                status_code=503,
+                detail='The saliency masks of %s are being rasterized; retry '
+                       'shortly.' % dataset.name,
+                headers={'Retry-After': str(MASK_BUILD_RETRY_AFTER)})
+        scores = masks.scores(masks.region_bits(payload.region, payload.mask))
+        return score_records(dataset, scores, payload.score_fn,
+                             payload.sort_by, payload.prediction_fn,
+                             payload.label_filter, limit)
+
+    return respond(await run_in_threadpool(query), 'rescore-region')
+
+
+def threshold_histograms(dataset: CaseStudy, method: str):
+    """The threshold histograms of the case study's explanation method ('' for
+    the first), or a 404 if it has none."""
+    if method not in dataset.threshold_histograms:
+        raise HTTPException(
+            status_code=404,
+            detail='%s has no saliency histograms%s; regenerate it with '
+                   'generate_datasets.py to score at other thresholds.'
+                   % (dataset.name, ' of ' + method if method else ''))
+    return dataset.threshold_histograms[method]
+
+
+@app.get("/api/threshold-scores", response_model=List[ImageScores])
+async def get_threshold_scores(case_study: str, threshold: float,
+                               score_fn: str = 'iou', sort_by: int = -1,
+                               prediction_fn: str = 'all_images',
+                               label_filter: str = '', limit: int = None):
+    """Scores every image's saliency thresholded at threshold.
+
+    Args:
+        case_study: The name of the case study dataset.
+        threshold: The normalized saliency threshold, from 0 to 1. It is
+                   rounded down to the nearest histogram threshold.
+        score_fn: The score function to sort by. A method suffix, as in
+                  'iou.grad_cam', scores that explanation method's saliency.
+        sort_by: 1 if ascending, -1 if descending.
+        prediction_fn: The prediction function. It can be 'all_images',
+                       'correct_only', 'incorrect_only', or any label.
+        label_filter: The label filter to apply. It can be any label name or ''
+                      for all labels.
+        limit: The maximum number of images to return. Defaults to all.
+
+    Returns:
+        The image ID and scores of the images passing the filters, sorted by
+        score_fn in sort_by order.
+    """
+    score, _, method = score_fn.partition(METHOD_SEPARATOR)
+
+    def query():
+        dataset = case_studies[case_study]
+        scores = threshold_histograms(dataset, method).scores(threshold)
+        return score_records(dataset, scores, score, sort_by,
+                             prediction_fn, label_filter, limit)
+
+    key = make_key('threshold-scores', case_study, threshold=threshold,
+                   score_fn=score_fn, sort_by=sort_by,
+                   prediction_fn=prediction_fn, label_filter=label_filter,
+                   limit=limit)
+    return respond(await cached_query(key, query), 'threshold-scores')
+
+
+@app.get("/api/threshold-curve", response_model=ThresholdCurve)
+async def get_threshold_curve(case_study: str, image_id: str = None,
+                              prediction_fn: str = 'all_images',
+                              label_filter: str = '', method: str = ''):
+    """Scores at every saliency threshold of an image or a set of images.
+
+    Args:
+        case_study: The name of the case study dataset.
+        image_id: The image to score. If omitted, the curves are averaged over
+                  the images passing prediction_fn and label_filter, ignoring
+                  images whose score is undefined at a threshold.
+        prediction_fn: The prediction function. It can be 'all_images',
+                       'correct_only', 'incorrect_only', or any label.
+        label_filter: The label filter to apply. It can be any label name or ''
+                      for all labels.
+        method: The explanation method whose saliency is scored, as in the
+                suffix of its score functions, e.g. 'grad_cam'. Defaults to
+                the first.
+
+    Returns:
+        The thresholds and the score of each score function at each of them,
+        with None where a score is undefined.
+    """
+
+    def query():
+        dataset = case_studies[case_study]
+        histograms = threshold_histograms(dataset, method)
+        if image_id is not None:
+            rows = dataset.rows([image_id])
+        else:
+            rows = np.flatnonzero(dataset.filter_mask(prediction_fn,
+                                                      label_filter))
+        curves = {'thresholds': histograms.thresholds.tolist()}
+        for name, values in histograms.curves(rows).items():
+            with np.errstate(invalid='ignore'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                mean = np.nanmean(values, axis=0)
+            curves[name] = np.where(np.isnan(mean), None,
+                                    mean.astype(object)).tolist()
+        return curves
+
+    key = make_key('threshold-curve', case_study, image_id=image_id,
+                   prediction_fn=prediction_fn, label_filter=label_filter,
+                   method=method)
+    return respond(await cached_query(key, query), 'threshold-curve')
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Serves the request, cache and dataset metrics to Prometheus."""
+    text = await run_in_threadpool(metrics.render)
+    return Response(text, media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get("/api/cache-stats")
+async def get_cache_stats():
+    """Gets the hit/miss statistics and size of the query cache."""
+    return query_cache.stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+"""Rasterized, bit-packed saliency masks for interactive re-scoring.
+
+The `bbox` and `saliency` polygons written by `data/generate_datasets.py` are
+in the pixel coordinates of a POLYGON_EXTENT x POLYGON_EXTENT image. A
+`SaliencyMaskStore` rasterizes every saliency region onto a coarser square grid
+and packs each mask into 64-bit words, so the shared interest scores of a
+user-drawn region against every image are a vectorized AND and popcount.
+
+`ThresholdHistograms` holds, per image, the cumulative counts of continuous
+saliency inside and outside the ground truth region, so the scores of the
+saliency thresholded at any level are a lookup rather than a rerun of the
+explanation method.
+"""
+
+from typing import Dict, Optional, Sequence, Union
+
+import numpy as np
+
+from backend.server.bitmap import WORD_BITS, row_popcount
+
+# The size of the masks polygons were traced from (see `_resize_image` in
+# data/generate_datasets.py).
+POLYGON_EXTENT = 175
+DEFAULT_RESOLUTION = 64
+
+
+def coverage_scores(intersection: np.ndarray, explanation_area: np.ndarray,
+                    ground_truth_area: np.ndarray) -> Dict[str, np.ndarray]:
+    """The shared interest scores from pixel counts.
+
+    Returns:
+        Mapping from score function name to a float64 array. Scores are NaN
+        where their denominator is zero.
+    """
+    union = explanation_area + ground_truth_area - intersection
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'iou': intersection / union,
+                'ground_truth_coverage': intersection / ground_truth_area,
+                'explanation_coverage': intersection / explanation_area}
+
+
+def parse_polygon(polygon: str) -> np.ndarray:
+    """Parses a 'x,y x,y ...' polygon string into an (m, 2) float array."""
+    return np.array([[float(c) for c in point.split(',')]
+                     for point in polygon.split()]).reshape(-1, 2)
+
+
+def rasterize(polygons: Sequence[Union[str, np.ndarray]],
+              resolution: int = DEFAULT_RESOLUTION) -> np.ndarray:
+    """Rasterizes the union of polygons onto a resolution x resolution grid.
+
+    Polygons are 'x,y x,y ...' strings or (m, 2) vertex arrays.
+
+    A cell is set when its center is inside any polygon (even-odd rule). Rows
+    are scanned with every polygon edge at once, so the cost is proportional
+    to edges x resolution rather than to the number of cells.
+    """
+    mask = np.zeros((resolution, resolution), dtype=bool)
+    scale = resolution / POLYGON_EXTENT
+    centers = np.arange(resolution) + 0.5
+    for polygon in polygons:
+        if isinstance(polygon, str):
+            polygon = parse_polygon(polygon)
+        points = np.asarray(polygon, dtype=np.float64) * scale
+        if len(points) < 3:
+            continue
+        x1, y1 = points[:, 0], points[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        # crosses[e, r]: edge e crosses the horizontal line through row r.
+        crosses = (y1[:, None] > centers) != (y2[:, None] > centers)
+        edges, rows = np.nonzero(crosses)
+        x_cross = x1[edges] + (centers[rows] - y1[edges]) * (
+                x2[edges] - x1[edges]) / (y2[edges] - y1[edges])
+        # A cell is inside if an odd number of crossings lie to its right,
+        # i.e. each crossing toggles the cells [0, left) of its row.
+        left = np.clip(np.ceil(x_cross - 0.5), 0, resolution).astype(np.int64)
+        toggles = np.zeros((resolution, resolution + 1), dtype=np.int64)
+        np.add.at(toggles, (rows, 0), 1)
+        np.add.at(toggles, (rows, left), -1)
+        mask |= np.cumsum(toggles, axis=1)[:, :resolution] % 2 == 1
+    return mask
+
+
+def pack_mask(mask: np.ndarray) -> np.ndarray:
+    """Packs a 2D boolean mask into little-endian 64-bit words."""
+    num_words = -(-mask.size // WORD_BITS)
+    packed = np.zeros(num_words * 8, dtype=np.uint8)
+    packed[:-(-mask.size // 8)] = np.packbits(mask.ravel(), bitorder='little')
+    return packed.view('<u8').astype(np.uint64, copy=False)
+
+
+def resize_mask(mask: np.ndarray, resolution: int) -> np.ndarray:
+    """Nearest-neighbor resizes a 2D mask to resolution x resolution."""
+    rows = (np.arange(resolution) + 0.5) * mask.shape[0] // resolution
+    columns = (np.arange(resolution) + 0.5) * mask.shape[1] // resolution
+    return mask[np.ix_(rows.astype(int), columns.astype(int))].astype(bool)
+
+
+class SaliencyMaskStore:
+    """The packed saliency mask of every image in a case study.
+
+    Attributes:
+        resolution: The side of the square grid the masks are rasterized on.
+        bits: (num_images, num_words) packed masks.
+        areas: The number of cells set in each mask.
+    """
+
+    def __init__(self, bits: np.ndarray, resolution: int,
+                 areas: Optional[np.ndarray] = None):
+        self.bits = bits
+        self.resolution = resolution
+        self.areas = areas if areas is not None else row_popcount(bits)
+
+    @classmethod
+    def from_polygons(cls, saliency: Sequence[Sequence[Union[str,
+                                                             np.ndarray]]],
+                      resolution: int = DEFAULT_RESOLUTION
+                      ) -> 'SaliencyMaskStore':
+        """Rasterizes the saliency polygons of every image."""
+        num_words = -(-resolution * resolution // WORD_BITS)
+        bits = np.zeros((len(saliency), num_words), dtype=np.uint64)
+        for row in range(len(saliency)):
+            bits[row] = pack_mask(rasterize(saliency[row], resolution))
+        return cls(bits, resolution)
+
+    def region_bits(self, polygons: Optional[Sequence[str]] = None,
+                    mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Packs a query region given as polygons or as a 2D mask."""
+        if mask is not None:
+            return pack_mask(resize_mask(np.asarray(mask), self.resolution))
+        return pack_mask(rasterize(polygons or [], self.resolution))
+
+    def scores(self, region: np.ndarray) -> dict:
+        """The shared interest scores of region against every saliency mask.
+
+        The region plays the part of the ground truth: ground truth coverage
+        is the proportion of the region covered by the saliency and
+        explanation coverage the proportion of the saliency inside the region.
+
+        Args:
+            region: A packed region from `region_bits`.
+
+        Returns:
+            Mapping from score function name to one score per image (see
+            `coverage_scores`).
+        """
+        return coverage_scores(row_popcount(self.bits & region), self.areas,
+                               row_popcount(region[None, :])[0])
+
+
+class ThresholdHistograms:
+    """Cumulative saliency histograms for scoring at any saliency threshold.
+
+    Saliency is normalized to [0, 1] per image, and the explanation at
+    threshold t is the set of pixels with saliency >= t. `inside[i, k]` and
+    `outside[i, k]` count the pixels of image i with saliency >= thresholds[k]
+    inside and outside its ground truth region, so the first column holds the
+    ground truth area and the number of remaining pixels.
+
+    Attributes:
+        inside: (num_images, num_bins + 1) cumulative counts inside the ground
+                truth.
+        outside: (num_images, num_bins + 1) cumulative counts outside it.
+        num_bins: The number of intervals between the thresholds.
+        thresholds: The num_bins + 1 evenly spaced thresholds from 0 to 1.
+    """
+
+    def __init__(self, inside: np.ndarray, outside: np.ndarray):
+        self.inside = inside
+        self.outside = outside
+        self.num_bins = inside.shape[1] - 1
+        self.thresholds = np.arange(self.num_bins + 1) / self.num_bins
+
+    def threshold_index(self, threshold: float) -> int:
+        """The index of the largest histogram threshold <= threshold."""
+        # The tolerance keeps a threshold of exactly k / num_bins at index k:
+        # with 100 bins, 0.29 * 100 is 28.999999999999996.
+        index = int(np.floor(threshold * self.num_bins + 1e-9))
+        return min(max(index, 0), self.num_bins)
+
+    def scores(self, threshold: float,
+               rows: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """The shared interest scores of the saliency thresholded at threshold.
+
+        The threshold is rounded down to the nearest histogram threshold.
+
+        Args:
+            threshold: The saliency threshold, from 0 to 1.
+            rows: The images to score. Defaults to all.
+
+        Returns:
+            Mapping from score function name to one score per image (see
+            `coverage_scores`).
+        """
+        curves = self.curves(rows, [self.threshold_index(threshold)])
+        return {name: values[:, 0] for name, values in curves.items()}
+
+    def curves(self, rows: Optional[np.ndarray] = None,
+               indices: Optional[Sequence[int]] = None
+               ) -> Dict[str, np.ndarray]:
+        """The shared interest scores of each image at every threshold.
+
+        Args:
+            rows: The images to score. Defaults to all.
+            indices: The thresholds to score at, as indices into thresholds.
+                     Defaults to all.
+
+        Returns:
+            Mapping from score function name to a (len(rows), len(indices))
+            float64 array.
+        """
+        rows = slice(None) if rows is None else rows
+        indices = slice(None) if indices is None else indices
+        inside = self.inside[rows]
+        intersection = inside[:, indices]
+        return coverage_scores(intersection,
+                               intersection + self.outside[rows][:, indices],
+                               inside[:, :1])
@@ -0,0 +1,313 @@
+"""Request, cache and dataset metrics in the Prometheus text format.
+
+`MetricsMiddleware` records the latency and request and response sizes of
+every request, labeled with the route it matched (its path template, so the
+number of series stays bounded). Collectors registered with `Metrics.collect`
+sample gauges such as the query cache statistics and the loaded datasets when
+`/metrics` is scraped.
+
+Handlers can time their stages with `Metrics.stage`:
+
+    with metrics.stage('get-images', 'filter'):
+        mask = dataset.filter_mask(prediction_fn, label_filter)
+
+Stage timers are only recorded when enabled, so the default costs nothing.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Starlette appends the charset to text/ media types.
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8)
+# A sample of a metric: its labels and value.
+Sample = Tuple[Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in labels.items())
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_family(name: str, help_text: str, metric_type: str,
+                  samples: Iterable[Sample], suffix: str = '') -> List[str]:
+    """The exposition lines of a metric family.
+
+    Args:
+        name: The metric name.
+        help_text: The HELP description.
+        metric_type: 'counter', 'gauge' or 'histogram'.
+        samples: The labels and value of each series.
+        suffix: Appended to name in the sample lines, e.g. '_total'.
+    """
+    lines = ['# HELP %s %s' % (name, help_text),
+             '# TYPE %s %s' % (name, metric_type)]
+    lines += ['%s%s%s %s' % (name, suffix, _format_labels(labels),
+                             _format_value(value))
+              for labels, value in samples]
+    return lines
+
+
+class Counter:
+    """A monotonically increasing count per label combination."""
+
+    def __init__(self, name: str, help_text: str,
+                 label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return format_family(
+            self.name, self.help_text, 'counter',
+            [(dict(zip(self.label_names, key)), value)
+             for key, value in values], suffix='_total')
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label combination."""
+
+    def __init__(self, name: str, help_text: str,
+                 label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # Label values -> [count per bucket (and +Inf), sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1),
+                                              0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s histogram' % self.name]
+        for key, (counts, total) in values:
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _format_labels(dict(labels, le=_format_value(
+                        float(bound)))), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(labels),
+                                          repr(total)))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(labels),
+                                            cumulative))
+        return lines
+
+
+class Metrics:
+    """The metrics of the API server.
+
+    Attributes:
+        prefix: Prepended to every metric name.
+        stage_timers: Whether `stage` records anything.
+        requests: Counter of requests by route, method and status.
+        latency: Histogram of request latencies in seconds by route.
+        request_bytes: Histogram of request body sizes by route.
+        response_bytes: Histogram of response body sizes by route, after
+                        compression if the middleware wraps it.
+        stages: Histogram of handler stage durations by endpoint and stage.
+    """
+
+    def __init__(self, prefix: str = 'shared_interest',
+                 stage_timers: bool = False):
+        self.prefix = prefix
+        self.stage_timers = stage_timers
+        self.requests = Counter(prefix + '_http_requests',
+                                'HTTP requests handled.',
+                                ['route', 'method', 'status'])
+        self.latency = Histogram(prefix + '_http_request_duration_seconds',
+                                 'Time from request to last response byte.',
+                                 ['route'])
+        self.request_bytes = Histogram(prefix + '_http_request_bytes',
+                                       'Size of request bodies.', ['route'],
+                                       SIZE_BUCKETS)
+        self.response_bytes = Histogram(prefix + '_http_response_bytes',
+                                        'Size of response bodies as sent.',
+                                        ['route'], SIZE_BUCKETS)
+        self.stages = Histogram(prefix + '_stage_duration_seconds',
+                                'Time spent in each stage of a handler.',
+                                ['endpoint', 'stage'])
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def collect(self, collector: Callable[[], List[str]]):
+        """Registers a function returning exposition lines at scrape time."""
+        self._collectors.append(collector)
+
+    @contextmanager
+    def stage(self, endpoint: str, stage: str):
+        """Times the enclosed block as a stage of endpoint, if enabled."""
+        if not self.stage_timers:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.observe(time.perf_counter() - start,
+                                endpoint=endpoint, stage=stage)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in [self.requests, self.latency, self.request_bytes,
+                       self.response_bytes, self.stages]:
+            lines += metric.render()
+        for collector in self._collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+
+def cache_metrics(stats: dict, prefix: str = 'shared_interest') -> List[str]:
+    """Exposition lines of `QueryCache.stats()`."""
+    name = prefix + '_query_cache'
+    lines = []
+    for stat, help_text in [('hits', 'Lookups answered from the cache.'),
+                            ('misses', 'Lookups that computed their result.'),
+                            ('coalesced', 'Lookups that waited on an '
+                                          'identical computation.'),
+                            ('evictions', 'Results evicted to stay within '
+                                          'the byte budget.')]:
+        lines += format_family('%s_%s' % (name, stat), help_text, 'counter',
+                               [({}, stats[stat])], suffix='_total')
+    for stat, help_text in [('entries', 'Cached results.'),
+                            ('bytes', 'Estimated size of the cached results.'),
+                            ('max_bytes', 'Byte budget of the cache.'),
+                            ('hit_rate', 'Proportion of lookups that did not '
+                                         'compute their result.')]:
+        lines += format_family('%s_%s' % (name, stat), help_text, 'gauge',
+                               [({}, stats[stat])])
+    return lines
+
+
+def dataset_metrics(info: List[dict],
+                    prefix: str = 'shared_interest') -> List[str]:
+    """Exposition lines of `DatasetRegistry.info()`."""
+    loaded = [dataset for dataset in info if dataset['loaded']]
+    lines = format_family(
+        prefix + '_dataset_loaded', 'Whether the case study is loaded.',
+        'gauge', [({'case_study': dataset['name']}, int(dataset['loaded']))
+                  for dataset in info])
+    for stat, name, help_text in [
+            ('num_images', 'images', 'Images in the loaded case study.'),
+            ('nbytes', 'bytes', 'Estimated memory held by the case study.'),
+            ('load_seconds', 'load_seconds',
+             'Time the last load of the case study took.')]:
+        lines += format_family(
+            '%s_dataset_%s' % (prefix, name), help_text, 'gauge',
+            [({'case_study': dataset['name']}, dataset[stat])
+             for dataset in loaded])
+    return lines
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the requests to an app in `Metrics`.
+
+    Add it last, so it wraps the other middleware and measures the time and
+    bytes actually seen by the client.
+    """
+
+    def __init__(self, app: ASGIApp, metrics: Metrics,
+                 routes: Optional[Callable[[], Iterable]] = None):
+        """
+        Args:
+            app: The wrapped app.
+            metrics: Where the requests are recorded.
+            routes: Returns the app's routes, to label requests with the path
+                    template of the route whose endpoint handled them.
+        """
+        self.app = app
+        self.metrics = metrics
+        self.routes = routes
+        self._route_paths: Dict[Callable, str] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        request_bytes = 0
+        response_bytes = 0
+        status = 500
+
+        async def counting_receive() -> Message:
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message: Message):
+            nonlocal response_bytes, status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                response_bytes += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            # The router adds the matched endpoint to the scope.
+            route = self._route_path(scope.get('endpoint'))
+            self.metrics.latency.observe(time.perf_counter() - start,
+                                         route=route)
+            self.metrics.requests.inc(route=route, method=scope['method'],
+                                      status=status)
+            self.metrics.request_bytes.observe(request_bytes, route=route)
+            self.metrics.response_bytes.observe(response_bytes, route=route)
+
+    def _route_path(self, endpoint: Optional[Callable]) -> str:
+        if endpoint is None:
+            return 'unmatched'
+        path = self._route_paths.get(endpoint)
+        if path is None and self.routes is not None:
+            for route in self.routes():
+                if getattr(route, 'endpoint', None) is endpoint:
+                    path = self._route_paths[endpoint] = route.path
+                    break
+        return path or getattr(endpoint, '__name__', 'unknown')
@@ -0,0 +1,455 @@
+"""Compact binary encoding and simplification of bbox and saliency polygons.
+
+`generate_datasets.py` writes each image's polygons as 'x,y x,y ...' strings
+of float-formatted pixel coordinates. A `PolygonColumn` stores them instead as
+one byte buffer indexed by row offsets. Each row is a sequence of unsigned
+LEB128 varints:
+
+    num_polygons, then for each polygon: num_points, x0, y0, dx1, dy1, ...
+
+Coordinates are rounded to integer pixels, which is lossless for polygons
+traced from pixel masks, and every point but the first of a polygon is stored
+as a zigzag-encoded delta from the previous one. Outline steps are a few
+pixels long, so most coordinates take a single byte instead of about five
+characters.
+
+Rows are decoded to the original strings for the 'text' polygon format, or
+sent as base64 for the 'binary' format, which the client decodes itself.
+Higher levels of detail (`lod`) simplify the outlines with the
+Ramer-Douglas-Peucker algorithm, for thumbnails that do not need every vertex.
+"""
+
+import base64
+import threading
+from collections import OrderedDict
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+POLYGON_FORMATS = ['text', 'binary']
+# The simplification tolerance in pixels of each level of detail. Level 0 is
+# the full outline.
+LOD_TOLERANCES = (0.0, 1.0, 2.0, 4.0)
+# Points with both coordinates below this are formatted by looking up a
+# table of 'x.0,y.0' strings, built up to the largest coordinate seen.
+POINT_TABLE_EXTENT = 256
+# The number of formatted rows each column keeps, across polygon formats and
+# levels of detail, so pages that are requested again are not reformatted.
+VALUE_CACHE_ROWS = 10000
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    """Maps signed integers to unsigned ones, small magnitudes first."""
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _unzigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    return (values >> 1) ^ -(values & 1)
+
+
+def encode_varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """LEB128-encodes unsigned integers.
+
+    Returns:
+        The uint8 encoding of all values and the number of bytes of each.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    remaining = values >> np.uint64(7)
+    while remaining.any():
+        lengths += remaining > 0
+        remaining >>= np.uint64(7)
+    starts = np.cumsum(lengths) - lengths
+    encoded = np.empty(lengths.sum(), dtype=np.uint8)
+    for k in range(int(lengths.max(initial=0))):
+        selected = lengths > k
+        groups = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (lengths[selected] > k + 1).astype(np.uint64) << np.uint64(7)
+        encoded[starts[selected] + k] = groups | more
+    return encoded, lengths
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+    """Decodes a buffer of LEB128 varints into a uint64 array."""
+    encoded = np.frombuffer(encoded, dtype=np.uint8) if isinstance(
+        encoded, bytes) else np.asarray(encoded, dtype=np.uint8)
+    last = encoded < 0x80
+    # The index of the value each byte belongs to, and its position in it.
+    value_index = np.concatenate([[0], np.cumsum(last[:-1])]).astype(np.int64)
+    starts = np.concatenate([[0], np.flatnonzero(last)[:-1] + 1])
+    positions = np.arange(len(encoded)) - starts[value_index]
+    values = np.zeros(int(last.sum()), dtype=np.uint64)
+    np.add.at(values, value_index,
+              (encoded & 0x7f).astype(np.uint64) <<
+              (7 * positions).astype(np.uint64))
+    return values
+
+
+def encode_rows(points: np.ndarray, points_per_polygon: np.ndarray,
+                polygons_per_row: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Encodes the polygons of several rows at once.
+
+    Args:
+        points: The (m, 2) integer vertices of every polygon, concatenated.
+        points_per_polygon: The number of vertices of each polygon.
+        polygons_per_row: The number of polygons of each row.
+
+    Returns:
+        The uint8 buffer of the encoded rows and the len(rows) + 1 byte
+        offsets delimiting them.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    points_per_polygon = np.asarray(points_per_polygon, dtype=np.int64)
+    polygons_per_row = np.asarray(polygons_per_row, dtype=np.int64)
+    polygon_starts = np.cumsum(points_per_polygon) - points_per_polygon
+    deltas = np.diff(points, axis=0, prepend=np.zeros((1, 2), np.int64))
+    deltas[polygon_starts[points_per_polygon > 0]] = points[
+        polygon_starts[points_per_polygon > 0]]
+    tokens = _zigzag(deltas.reshape(-1))
+
+    # Insert the point counts before each polygon's coordinates, then the
+    # polygon counts before each row's first polygon.
+    tokens = np.insert(tokens, 2 * polygon_starts, points_per_polygon.astype(
+        np.uint64))
+    first_polygons = np.cumsum(polygons_per_row) - polygons_per_row
+    points_before = np.concatenate([[0], np.cumsum(points_per_polygon)])[
+        first_polygons]
+    row_starts = 2 * points_before + first_polygons
+    tokens = np.insert(tokens, row_starts, polygons_per_row.astype(np.uint64))
+
+    encoded, lengths = encode_varints(tokens)
+    byte_starts = np.concatenate([[0], np.cumsum(lengths)])
+    offsets = np.append(
+        byte_starts[row_starts + np.arange(len(polygons_per_row))],
+        len(encoded)).astype(np.int64)
+    return encoded, offsets
+
+
+def decode_rows(blob: np.ndarray, offsets: np.ndarray, rows: np.ndarray
+                ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Decodes the polygons of several rows at once, the inverse of
+    `encode_rows`.
+
+    The varints of every row are decoded in a single pass. Only the row and
+    polygon headers are walked in Python, not the coordinates.
+
+    Args:
+        blob: The uint8 buffer of the encoded rows.
+        offsets: The byte offsets delimiting each row in blob.
+        rows: The rows to decode.
+
+    Returns:
+        The (m, 2) int64 vertices of every polygon of rows, concatenated, the
+        number of vertices of each polygon and the number of polygons of each
+        row.
+    """
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    # The position in blob of every byte of the selected rows.
+    positions = np.arange(lengths.sum()) + np.repeat(
+        starts - (np.cumsum(lengths) - lengths), lengths)
+    tokens = decode_varints(np.asarray(blob, dtype=np.uint8)[positions])
+
+    token = tokens.item
+    headers = []
+    polygons_per_row = []
+    points_per_polygon = []
+    index = 0
+    for _ in range(len(rows)):
+        num_polygons = token(index)
+        headers.append(index)
+        polygons_per_row.append(num_polygons)
+        index += 1
+        for _ in range(num_polygons):
+            num_points = token(index)
+            headers.append(index)
+            points_per_polygon.append(num_points)
+            index += 1 + 2 * num_points
+
+    is_coordinate = np.ones(len(tokens), dtype=bool)
+    is_coordinate[headers] = False
+    deltas = _unzigzag(tokens[is_coordinate]).reshape(-1, 2)
+    points_per_polygon = np.array(points_per_polygon, dtype=np.int64)
+    # Undo the delta encoding with one cumulative sum, subtracting the sum of
+    # the previous polygons from each polygon's points.
+    totals = np.cumsum(deltas, axis=0)
+    polygon_starts = np.cumsum(points_per_polygon) - points_per_polygon
+    previous = np.zeros((len(points_per_polygon), 2), dtype=np.int64)
+    after_first = polygon_starts > 0
+    previous[after_first] = totals[polygon_starts[after_first] - 1]
+    points = totals - np.repeat(previous, points_per_polygon, axis=0)
+    return (points, points_per_polygon,
+            np.array(polygons_per_row, dtype=np.int64))
+
+
+def decode_row(encoded: np.ndarray) -> List[np.ndarray]:
+    """The (n, 2) int64 vertices of each polygon of an encoded row."""
+    encoded = np.frombuffer(encoded, dtype=np.uint8) if isinstance(
+        encoded, bytes) else np.asarray(encoded, dtype=np.uint8)
+    points, points_per_polygon, _ = decode_rows(encoded, [0, len(encoded)],
+                                                [0])
+    return _split(points, points_per_polygon)
+
+
+def _split(values: np.ndarray, counts: np.ndarray) -> list:
+    """Splits values into consecutive runs of counts elements."""
+    return np.split(values, np.cumsum(counts)[:-1]) if len(counts) else []
+
+
+def encode_polygons(polygons: Sequence[np.ndarray]) -> bytes:
+    """Encodes the polygons of a single row."""
+    polygons = [np.asarray(polygon).reshape(-1, 2) for polygon in polygons]
+    points = np.concatenate(polygons) if polygons else np.zeros((0, 2))
+    encoded, _ = encode_rows(np.rint(points), [len(p) for p in polygons],
+                             [len(polygons)])
+    return encoded.tobytes()
+
+
+def format_polygon(points: np.ndarray) -> str:
+    """Formats vertices like `_mask_to_polygon`, e.g. '0.0,0.0 0.0,5.0'."""
+    return ' '.join(['%d.0,%d.0' % (x, y) for x, y in points.tolist()])
+
+
+def simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Simplifies a polyline or closed ring with Ramer-Douglas-Peucker.
+
+    Keeps the first and last vertex, and recursively the vertex farthest from
+    the segment between the kept ones while it is farther than tolerance.
+    Rings that would collapse to fewer than three distinct vertices are
+    returned unchanged.
+    """
+    if tolerance <= 0:
+        return points
+    return points[simplify_mask(points, [len(points)], tolerance)]
+
+
+def simplify_mask(points: np.ndarray, points_per_polygon: Sequence[int],
+                  tolerance: float) -> np.ndarray:
+    """The vertices `simplify` keeps of each of several polygons.
+
+    The recursion is unrolled into rounds: each round finds the farthest
+    vertex of every unresolved segment of every polygon at once, so the
+    number of NumPy calls grows with the depth of the recursion rather than
+    the number of polygons.
+
+    Args:
+        points: The (m, 2) vertices of every polygon, concatenated.
+        points_per_polygon: The number of vertices of each polygon.
+        tolerance: The simplification tolerance in pixels.
+
+    Returns:
+        A boolean mask of the kept vertices.
+    """
+    points_per_polygon = np.asarray(points_per_polygon, dtype=np.int64)
+    num_points = len(points)
+    keep = np.ones(num_points, dtype=bool)
+    if tolerance <= 0 or not num_points:
+        return keep
+    polygon_ids = np.repeat(np.arange(len(points_per_polygon)),
+                            points_per_polygon)
+    ends = np.cumsum(points_per_polygon)
+    starts = ends - points_per_polygon
+    # Polygons with fewer than 4 vertices are kept whole.
+    simplified = (points_per_polygon >= 4)[polygon_ids]
+    keep[simplified] = False
+    nonempty = points_per_polygon > 0
+    keep[starts[nonempty]] = True
+    keep[ends[nonempty] - 1] = True
+    # Vertices between two kept ones whose segment is not yet resolved.
+    unresolved = ~keep
+    points_f = points.astype(np.float64)
+    indices = np.arange(num_points)
+    while unresolved.any():
+        previous = np.maximum.accumulate(np.where(keep, indices, 0))
+        following = np.minimum.accumulate(
+            np.where(keep, indices, num_points)[::-1])[::-1]
+        candidates = np.flatnonzero(unresolved)
+        a = points_f[previous[candidates]]
+        b = points_f[following[candidates]]
+        between = points_f[candidates]
+        segment = b - a
+        length = np.hypot(segment[:, 0], segment[:, 1])
+        cross = np.abs(segment[:, 0] * (between[:, 1] - a[:, 1]) -
+                       segment[:, 1] * (between[:, 0] - a[:, 0]))
+        # The segment of a closed ring is a point.
+        point_distances = np.hypot(between[:, 0] - a[:, 0],
+                                   between[:, 1] - a[:, 1])
+        distances = np.where(length == 0, point_distances,
+                             cross / np.where(length == 0, 1, length))
+
+        # Candidates of a segment are contiguous, so reduceat finds the
+        # farthest distance of each and the first vertex reaching it.
+        segments = previous[candidates]
+        segment_starts = np.flatnonzero(np.diff(segments, prepend=-1))
+        segment_ids = np.cumsum(np.diff(segments, prepend=-1) != 0) - 1
+        farthest = np.maximum.reduceat(distances, segment_starts)
+        split = farthest > tolerance
+        is_farthest = np.flatnonzero(distances == farthest[segment_ids])
+        _, first = np.unique(segment_ids[is_farthest], return_index=True)
+        chosen = candidates[is_farthest[first][split]]
+        keep[chosen] = True
+        unresolved[candidates[~split[segment_ids]]] = False
+        unresolved[chosen] = False
+
+    # Rings that collapsed keep every vertex. Only polygons with few kept
+    # vertices can have collapsed.
+    kept_counts = np.bincount(polygon_ids, weights=keep,
+                              minlength=len(points_per_polygon))
+    for polygon in np.flatnonzero(simplified[starts.clip(
+            max=num_points - 1)] & (kept_counts < 4) & nonempty):
+        start, end = starts[polygon], ends[polygon]
+        if len(np.unique(points[start:end][keep[start:end]], axis=0)) < 3:
+            keep[start:end] = True
+    return keep
+
+
+def lod_tolerance(lod: int) -> float:
+    """The simplification tolerance of a level of detail, clipped to the
+    supported levels."""
+    return LOD_TOLERANCES[min(max(lod, 0), len(LOD_TOLERANCES) - 1)]
+
+
+class PolygonColumn:
+    """The bbox or saliency polygons of every image, encoded in one buffer.
+
+    Like `storage.BlobColumn`, indexing with an integer returns the polygon
+    strings of a row and indexing with an array of rows returns an object
+    array of them. The buffer and offsets can be memory-mapped.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self._point_table = np.empty(0, dtype=object)
+        # (polygon_format, lod, row) -> value, least recently used first.
+        self._value_cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_strings(cls, values: Sequence[List[str]]) -> 'PolygonColumn':
+        """Encodes lists of 'x,y x,y ...' polygon strings."""
+        polygons = [polygon for value in values for polygon in value]
+        coordinates = ' '.join(polygons).replace(',', ' ').split()
+        points = np.rint(np.array(coordinates, dtype=np.float64)).astype(
+            np.int64)
+        blob, offsets = encode_rows(
+            points, [polygon.count(',') for polygon in polygons],
+            [len(value) for value in values])
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def __getitem__(self, rows):
+        if np.ndim(rows) == 0:
+            return [format_polygon(points) for points in self.points(rows)]
+        values = np.empty(len(rows), dtype=object)
+        for i, row in enumerate(rows):
+            values[i] = self[int(row)]
+        return values
+
+    def encoded(self, row: int) -> np.ndarray:
+        """The encoded bytes of a row."""
+        return self.blob[self.offsets[row]:self.offsets[row + 1]]
+
+    def points(self, row: int, lod: int = 0) -> List[np.ndarray]:
+        """The vertices of each polygon of a row at a level of detail."""
+        points, points_per_polygon, _ = self.decode([row], lod)
+        return _split(points, points_per_polygon)
+
+    def decode(self, rows: np.ndarray, lod: int = 0
+               ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The polygons of rows at a level of detail, as returned by
+        `decode_rows`."""
+        points, points_per_polygon, polygons_per_row = decode_rows(
+            self.blob, self.offsets, rows)
+        tolerance = lod_tolerance(lod)
+        if tolerance > 0:
+            keep = simplify_mask(points, points_per_polygon, tolerance)
+            points = points[keep]
+            points_per_polygon = np.bincount(
+                np.repeat(np.arange(len(points_per_polygon)),
+                          points_per_polygon), weights=keep,
+                minlength=len(points_per_polygon)).astype(np.int64)
+        return points, points_per_polygon, polygons_per_row
+
+    def values(self, rows: np.ndarray, polygon_format: str = 'text',
+               lod: int = 0) -> list:
+        """The polygons of rows as sent by the API.
+
+        The rows missing from the value cache are decoded, simplified and
+        formatted at once rather than one by one.
+
+        Args:
+            rows: The row positions.
+            polygon_format: 'text' for lists of polygon strings or 'binary'
+                            for the base64 encoding of each row.
+            lod: The level of detail, from 0 (every vertex) to
+                 len(LOD_TOLERANCES) - 1 (coarsest).
+        """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        if polygon_format == 'binary' and lod_tolerance(lod) == 0:
+            return [base64.b64encode(self.encoded(row).tobytes()).decode(
+                'ascii') for row in rows.tolist()]
+
+        keys = [(polygon_format, lod, row) for row in rows.tolist()]
+        with self._lock:
+            values = [self._value_cache.get(key) for key in keys]
+            for key, value in zip(keys, values):
+                if value is not None:
+                    self._value_cache.move_to_end(key)
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            computed = self._compute_values(rows[missing], polygon_format, lod)
+            with self._lock:
+                for i, value in zip(missing, computed):
+                    values[i] = self._value_cache[keys[i]] = value
+                while len(self._value_cache) > VALUE_CACHE_ROWS:
+                    self._value_cache.popitem(last=False)
+        return values
+
+    def clear_cache(self):
+        """Forgets the formatted rows."""
+        with self._lock:
+            self._value_cache.clear()
+
+    def _compute_values(self, rows: np.ndarray, polygon_format: str,
+                        lod: int) -> list:
+        points, points_per_polygon, polygons_per_row = self.decode(rows, lod)
+        if polygon_format == 'binary':
+            blob, offsets = encode_rows(points, points_per_polygon,
+                                        polygons_per_row)
+            return [base64.b64encode(blob[start:end].tobytes()).decode('ascii')
+                    for start, end in zip(offsets[:-1].tolist(),
+                                          offsets[1:].tolist())]
+        point_strings = self._format_points(points)
+        polygon_ends = np.cumsum(points_per_polygon).tolist()
+        polygons = [' '.join(point_strings[end - count:end])
+                    for end, count in zip(polygon_ends,
+                                          points_per_polygon.tolist())]
+        row_ends = np.cumsum(polygons_per_row).tolist()
+        return [polygons[end - count:end]
+                for end, count in zip(row_ends, polygons_per_row.tolist())]
+
+    def _format_points(self, points: np.ndarray) -> List[str]:
+        """The 'x.0,y.0' string of each of the (m, 2) points."""
+        if not len(points):
+            return []
+        extent = int(points.max()) + 1
+        if points.min() < 0 or extent > POINT_TABLE_EXTENT:
+            return ['%d.0,%d.0' % (x, y) for x, y in points.tolist()]
+        if extent ** 2 > len(self._point_table):
+            coordinates = range(extent)
+            self._point_table = np.array(
+                ['%d.0,%d.0' % (x, y) for x in coordinates
+                 for y in coordinates], dtype=object)
+        table_extent = int(round(np.sqrt(len(self._point_table))))
+        return self._point_table[points[:, 0] * table_extent +
+                                 points[:, 1]].tolist()
@@ -0,0 +1,167 @@
+"""Registry of the case studies served by the API.
+
+The registry discovers case studies from the files in a directory, loads each
+one on first access, reloads it when its file changes and evicts the least
+recently used case studies when a memory budget is exceeded.
+"""
+
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import backend.server.storage as storage
+from backend.server.dataset import CaseStudy
+
+
+class _Entry:
+    """A loaded case study and the version of the files it was loaded from."""
+
+    def __init__(self, dataset: CaseStudy, version: str, load_seconds: float):
+        self.dataset = dataset
+        self.version = version
+        self.load_seconds = load_seconds
+        self.nbytes = dataset.nbytes()
+        self.checked = time.monotonic()
+
+
+class DatasetRegistry:
+    """Mapping from case study name to `CaseStudy`.
+
+    Attributes:
+        directory: The directory containing the case study files, as
+                   `name.json` or converted `name.si` directories.
+        memory_budget: The maximum estimated bytes of loaded case studies, or
+                       None for no limit. The case study being accessed is
+                       never evicted, even if it alone exceeds the budget.
+        check_interval: Seconds between checks of a loaded case study's files
+                        for changes.
+        on_change: Called with the name of a case study after it is loaded,
+                   reloaded or evicted, to invalidate anything derived from it.
+        shared_directory: If set, case studies are loaded through
+                          `storage.share_case_study` so processes share them.
+    """
+
+    def __init__(self, directory: str, memory_budget: Optional[int] = None,
+                 check_interval: float = 1.0,
+                 on_change: Optional[Callable[[str], None]] = None,
+                 shared_directory: Optional[str] = None):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.check_interval = check_interval
+        self.on_change = on_change
+        self.shared_directory = shared_directory
+        self._entries: Dict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def names(self) -> List[str]:
+        """The names of the case studies in the directory."""
+        return storage.discover_case_studies(self.directory)
+
+    def info(self) -> List[dict]:
+        """The name of each case study and the size and load time of the
+        loaded ones."""
+        with self._lock:
+            entries = dict(self._entries)
+        return [{'name': name,
+                 'loaded': name in entries,
+                 'num_images': len(entries[name].dataset)
+                 if name in entries else None,
+                 'nbytes': entries[name].nbytes if name in entries else None,
+                 'load_seconds': entries[name].load_seconds
+                 if name in entries else None}
+                for name in self.names()]
+
+    def __getitem__(self, name: str) -> CaseStudy:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                if time.monotonic() - entry.checked < self.check_interval:
+                    return entry.dataset
+                entry.checked = time.monotonic()
+
+        if entry is None and name not in self.names():
+            raise KeyError(name)
+        try:
+            version = storage.source_version(self.directory, name)
+        except FileNotFoundError:
+            self.evict(name)
+            raise KeyError(name)
+        if entry is not None and entry.version == version:
+            return entry.dataset
+        return self._load(name, version, previous=entry)
+
+    def __contains__(self, name: str):
+        return name in self.names()
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.names())
+
+    def reload(self, name: str) -> CaseStudy:
+        """Loads the current files of name, replacing any loaded version."""
+        return self._load(name, storage.source_version(self.directory, name))
+
+    def evict(self, name: str):
+        """Unloads name. It is loaded again on its next access."""
+        with self._lock:
+            evicted = self._entries.pop(name, None)
+        if evicted is not None and self.on_change is not None:
+            self.on_change(name)
+
+    def loaded_bytes(self) -> int:
+        """The estimated bytes held by the loaded case studies."""
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def _load(self, name: str, version: str,
+              previous: Optional[_Entry] = None) -> CaseStudy:
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                current = self._entries.get(name)
+            if current is not None and current.version == version:
+                return current.dataset  # Loaded by a concurrent request
+
+            start = time.perf_counter()
+            try:
+                if self.shared_directory:
+                    dataset = storage.share_case_study(
+                        self.directory, self.shared_directory, name, version)
+                else:
+                    dataset = storage.load_case_study(self.directory, name)
+            except Exception:
+                if previous is None:
+                    raise
+                # The file may be half-written; keep serving the old version
+                # and try again after check_interval.
+                traceback.print_exc()
+                return previous.dataset
+            entry = _Entry(dataset, version, time.perf_counter() - start)
+
+            # Swap in the new version atomically; requests already holding the
+            # old CaseStudy finish against it.
+            with self._lock:
+                self._entries[name] = entry
+                self._entries.move_to_end(name)
+            if self.on_change is not None:
+                self.on_change(name)
+            self._enforce_budget(keep=name)
+            return dataset
+
+    def _enforce_budget(self, keep: str):
+        if self.memory_budget is None:
+            return
+        while True:
+            with self._lock:
+                total = sum(entry.nbytes for entry in self._entries.values())
+                candidates = [name for name in self._entries if name != keep]
+            if total <= self.memory_budget or not candidates:
+                return
+            self.evict(candidates[0])
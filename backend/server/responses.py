@@ -0,0 +1,48 @@
+"""JSON responses that bypass FastAPI's response_model validation.
+
+An endpoint returning a `Response` is sent as is: FastAPI neither validates
+the content against the endpoint's response_model nor serializes it with
+`jsonable_encoder`, while the response_model still documents the endpoint in
+the OpenAPI schema. `FastJSONResponse` serializes the content with orjson when
+it is installed, which encodes NumPy arrays and scalars natively, and with the
+standard library encoder otherwise.
+
+The content must already match the response_model, e.g. with None in place of
+NaN and str values where the model declares str.
+"""
+
+import json
+from typing import Any
+
+import numpy as np
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    """Converts the NumPy values the standard library encoder rejects."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('Object of type %s is not JSON serializable' %
+                    type(value).__name__)
+
+
+def dumps(content: Any) -> bytes:
+    """Serializes content, which may contain NumPy values, to UTF-8 JSON."""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False,
+                      separators=(',', ':'), default=_default).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    """A JSONResponse serialized by `dumps`."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,321 @@
+"""Columnar binary on-disk format for case studies.
+
+A case study `name` is stored in a versioned directory that the symlink
+`name.si` points to, replaced atomically when the case study is converted
+again:
+
+    meta.json               Format version, categories, score and column names.
+    ids.npy                 Fixed-width image IDs.
+    ids.order.npy           Row permutation sorting the image IDs.
+    ids.sorted.npy          The image IDs in sorted order, for lookups.
+    correct.npy             Whether each image's prediction is its label.
+    label_codes.npy         Category code of each image's label.
+    prediction_codes.npy    Category code of each image's prediction.
+    score.<score_fn>.npy    One float64 array per score function.
+    order.<score_fn>.npy    Stable (ascending, descending) row permutations.
+    bitmap.<filter>.npy     The label, prediction and correct bitsets.
+    saliency_masks.npy      The rasterized saliency masks (see masks.py).
+    saliency_<side>[.<method>].npy
+                            Optional cumulative saliency histograms of each
+                            explanation method inside and outside the ground
+                            truth (see masks.py).
+    <column>.blob           UTF-8 image values, and the binary-encoded bbox
+                            and saliency polygons (see polygons.py),
+    <column>.offsets.npy    concatenated and indexed by n + 1 byte offsets.
+
+Arrays are memory-mapped on load and blob values are only decoded when a
+record is requested, so loading a case study does not parse its images or
+polygons. Convert the JSON files written by `data/generate_datasets.py` with:
+
+    python -m backend.server.storage data/examples/data_dogs.json
+
+Since every array and index is memory-mapped read-only, processes that load
+the same files share a single copy of them. `share_case_study` places the
+files in a shared directory (e.g. on the /dev/shm tmpfs) so that all uvicorn
+workers attach to the same in-memory dataset.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from backend.server.bitmap import BitmapIndex
+from backend.server.dataset import (CaseStudy, histogram_columns,
+                                    is_polygon_column)
+from backend.server.masks import SaliencyMaskStore, ThresholdHistograms
+from backend.server.polygons import PolygonColumn
+
+FORMAT_VERSION = 6
+BITSETS = ['labels', 'predictions', 'correct']
+SUFFIX = '.si'
+
+
+class BlobColumn:
+    """A memory-mapped column of strings.
+
+    Indexing with an integer returns a single value; indexing with an array of
+    rows returns an object array of values, like the in-memory columns.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, rows):
+        if np.ndim(rows) == 0:
+            return self._value(int(rows))
+        values = np.empty(len(rows), dtype=object)
+        for i, row in enumerate(rows):
+            values[i] = self._value(int(row))
+        return values
+
+    def _value(self, row: int):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.blob[start:end].tobytes().decode('utf-8')
+
+
+def write_case_study(dataset: CaseStudy, path: str):
+    """Writes dataset to path in the binary format.
+
+    The files are written to a new versioned directory `path.<version>`, and
+    path is a symlink that is then atomically replaced to point at it, so a
+    server watching path always finds a complete case study: the previous
+    version or the new one. The previous version's directory is kept, so
+    readers that resolved the link just before the swap can finish loading
+    it; older ones are deleted.
+    """
+    final_path = path
+    path = '%s.%d-%d' % (final_path, time.time_ns(), os.getpid())
+    os.makedirs(path)
+    np.save(os.path.join(path, 'ids.npy'),
+            np.array(dataset.ids.tolist(), dtype=str))
+    np.save(os.path.join(path, 'ids.order.npy'), dataset.id_order)
+    np.save(os.path.join(path, 'ids.sorted.npy'),
+            np.array(dataset.sorted_ids.tolist(), dtype=str))
+    np.save(os.path.join(path, 'correct.npy'), dataset.correct)
+    np.save(os.path.join(path, 'label_codes.npy'), dataset.label_codes)
+    np.save(os.path.join(path, 'prediction_codes.npy'),
+            dataset.prediction_codes)
+    for score_fn, values in dataset.scores.items():
+        np.save(os.path.join(path, 'score.%s.npy' % score_fn), values)
+        np.save(os.path.join(path, 'order.%s.npy' % score_fn),
+                np.stack(dataset.sort_orders[score_fn]))
+    for bitset in BITSETS:
+        np.save(os.path.join(path, 'bitmap.%s.npy' % bitset),
+                getattr(dataset.bitmaps, bitset))
+
+    masks = dataset.saliency_masks()
+    np.save(os.path.join(path, 'saliency_masks.npy'), masks.bits)
+    for method, histograms in dataset.threshold_histograms.items():
+        for column, counts in zip(histogram_columns(method),
+                                  [histograms.inside, histograms.outside]):
+            np.save(os.path.join(path, column + '.npy'), counts)
+
+    for column, values in dataset.columns.items():
+        if is_polygon_column(column):
+            _write_polygons(path, column, values)
+        else:
+            _write_blob(path, column, values)
+
+    meta = {'version': FORMAT_VERSION,
+            'name': dataset.name,
+            'size': len(dataset),
+            'categories': dataset.categories.tolist(),
+            'scores': list(dataset.scores),
+            'columns': list(dataset.columns),
+            'mask_resolution': masks.resolution,
+            'threshold_histograms': list(dataset.threshold_histograms)}
+    # Written last, so a directory with meta.json is complete.
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    _swap_link(final_path, path)
+
+
+def _swap_link(link_path: str, target: str):
+    """Atomically points the symlink link_path at target, then deletes the
+    versions of link_path older than the one it replaced."""
+    previous = os.path.realpath(link_path) if os.path.exists(link_path) \
+        else None
+    if os.path.isdir(link_path) and not os.path.islink(link_path):
+        # A directory written before versions were linked can only be moved
+        # aside: there is a moment without a case study, but no partial one.
+        previous = '%s.%d-%d' % (link_path, time.time_ns(), os.getpid())
+        os.rename(link_path, previous)
+    temporary_link = target + '.link'
+    os.symlink(os.path.basename(target), temporary_link)
+    os.replace(temporary_link, link_path)
+
+    directory, name = os.path.split(os.path.abspath(link_path))
+    keep = {os.path.realpath(target), previous and os.path.realpath(previous)}
+    for filename in os.listdir(directory):
+        version_path = os.path.join(directory, filename)
+        # Only complete versions: another writer may be filling a new one.
+        if filename.startswith(name + '.') and \
+                os.path.realpath(version_path) not in keep and \
+                os.path.isfile(os.path.join(version_path, 'meta.json')):
+            shutil.rmtree(version_path, ignore_errors=True)
+
+
+def read_case_study(path: str, name: Optional[str] = None) -> CaseStudy:
+    """Memory-maps a case study written by `write_case_study`."""
+    # Every file is read from the version the link points at now, even if it
+    # is swapped while they are loaded.
+    path = os.path.realpath(path)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != FORMAT_VERSION:
+        raise ValueError('Unsupported case study format version %s in %s' %
+                         (meta['version'], path))
+
+    def load(filename):
+        return np.load(os.path.join(path, filename), mmap_mode='r')
+
+    scores = {score_fn: load('score.%s.npy' % score_fn)
+              for score_fn in meta['scores']}
+    sort_orders = {score_fn: tuple(load('order.%s.npy' % score_fn))
+                   for score_fn in meta['scores']}
+    columns = {column: (PolygonColumn if is_polygon_column(column)
+                        else BlobColumn)(*_read_blob(path, column))
+               for column in meta['columns']}
+    bitmaps = BitmapIndex.from_bitsets(
+        meta['size'], *[load('bitmap.%s.npy' % bitset) for bitset in BITSETS])
+    masks = SaliencyMaskStore(load('saliency_masks.npy'),
+                              meta['mask_resolution'])
+    histograms = {method: ThresholdHistograms(
+        *[load(column + '.npy') for column in histogram_columns(method)])
+        for method in meta['threshold_histograms']}
+    return CaseStudy(name or meta['name'], load('ids.npy'),
+                     np.array(meta['categories'], dtype=object),
+                     load('label_codes.npy'), load('prediction_codes.npy'),
+                     scores, columns, sort_orders, bitmaps,
+                     load('ids.order.npy'), masks, histograms,
+                     load('ids.sorted.npy'), load('correct.npy'))
+
+
+def discover_case_studies(directory: str) -> List[str]:
+    """The names of the JSON and binary case studies in directory."""
+    names = set()
+    for filename in os.listdir(directory):
+        name, extension = os.path.splitext(filename)
+        if extension == '.json' or (extension == SUFFIX and os.path.isfile(
+                os.path.join(directory, filename, 'meta.json'))):
+            names.add(name)
+    return sorted(names)
+
+
+def source_path(directory: str, name: str) -> str:
+    """The file the case study name is loaded from.
+
+    The binary `name.si` directory takes precedence over the `name.json` file
+    written by `generate_datasets.py`.
+    """
+    meta_path = os.path.join(directory, name + SUFFIX, 'meta.json')
+    if os.path.isfile(meta_path):
+        return meta_path
+    return os.path.join(directory, name + '.json')
+
+
+def source_version(directory: str, name: str) -> str:
+    """Identifies the current version of the case study name's files.
+
+    Raises:
+        FileNotFoundError: If the case study does not exist.
+    """
+    stat = os.stat(source_path(directory, name))
+    return '%d-%d' % (stat.st_mtime_ns, stat.st_size)
+
+
+def load_case_study(directory: str, name: str) -> CaseStudy:
+    """Loads the case study name from directory (see `source_path`)."""
+    path = source_path(directory, name)
+    if path.endswith('meta.json'):
+        return read_case_study(os.path.dirname(path), name)
+    return CaseStudy.from_json(name, path)
+
+
+def share_case_study(directory: str, shared_directory: str, name: str,
+                     version: str) -> CaseStudy:
+    """Loads version of the case study name from shared_directory.
+
+    The first process to load a version converts it from directory into
+    shared_directory while holding a file lock; concurrent processes wait for
+    the conversion and then memory-map the same files. Older versions are
+    removed once the new one is written; processes still mapping them keep
+    their open files.
+    """
+    path = os.path.join(shared_directory, '%s-%s%s' % (name, version, SUFFIX))
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.isfile(meta_path):
+        os.makedirs(shared_directory, exist_ok=True)
+        with open(os.path.join(shared_directory, name + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(meta_path):
+                write_case_study(load_case_study(directory, name), path)
+                # Other versions' links and the directories they point to:
+                # <name>-<version>.si[.<write version>], where the version is
+                # a source_version, so case studies whose names start with
+                # name and a hyphen never match.
+                versions = re.compile(re.escape(name) + r'-\d+-\d+' +
+                                      re.escape(SUFFIX) + r'(\..*)?')
+                for filename in os.listdir(shared_directory):
+                    old_path = os.path.join(shared_directory, filename)
+                    if versions.fullmatch(filename) and not \
+                            filename.startswith(os.path.basename(path)):
+                        if os.path.islink(old_path):
+                            os.unlink(old_path)
+                        else:
+                            shutil.rmtree(old_path, ignore_errors=True)
+    return read_case_study(path, name)
+
+
+def _write_blob(path: str, column: str, values: Iterable[str]):
+    offsets: List[int] = [0]
+    with open(os.path.join(path, column + '.blob'), 'wb') as f:
+        for value in values:
+            offsets.append(offsets[-1] + f.write(value.encode('utf-8')))
+    np.save(os.path.join(path, column + '.offsets.npy'),
+            np.array(offsets, dtype=np.int64))
+
+
+def _write_polygons(path: str, column: str, values: PolygonColumn):
+    with open(os.path.join(path, column + '.blob'), 'wb') as f:
+        f.write(np.asarray(values.blob).tobytes())
+    np.save(os.path.join(path, column + '.offsets.npy'),
+            np.asarray(values.offsets, dtype=np.int64))
+
+
+def _read_blob(path: str, column: str) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.load(os.path.join(path, column + '.offsets.npy'),
+                      mmap_mode='r')
+    blob_path = os.path.join(path, column + '.blob')
+    if os.path.getsize(blob_path):
+        blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+    else:  # Empty files cannot be memory-mapped
+        blob = np.zeros(0, dtype=np.uint8)
+    return blob, offsets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Convert case study JSON files to the binary format.')
+    parser.add_argument('json_files', nargs='+',
+                        help='data files written by generate_datasets.py')
+    parser.add_argument('-o', '--output_dir', type=str,
+                        help='directory to store the converted case studies. '
+                             'Defaults to the directory of each JSON file.')
+    args = parser.parse_args()
+    for json_file in args.json_files:
+        name = os.path.splitext(os.path.basename(json_file))[0]
+        output_dir = args.output_dir or os.path.dirname(json_file)
+        write_case_study(CaseStudy.from_json(name, json_file),
+                         os.path.join(output_dir, name + SUFFIX))
@@ -0,0 +1,302 @@
+"""Benchmarks every API endpoint on synthetic case studies.
+
+Case studies of each size are generated with `data/synthetic_datasets.py` and
+each endpoint is driven in-process through the ASGI app, so the numbers
+include routing, validation, serialization and compression but no network:
+
+    python -m benchmarks.bench_api --sizes 1000 100000 -o baseline.json
+    python -m benchmarks.bench_api --sizes 1000 100000 --compare baseline.json
+
+Each endpoint is measured with cold caches (the query cache and the formatted
+polygons invalidated before every request) and warm ones. Latencies are reported as p50/p99, throughput as
+sequential requests per second, and memory as the tracemalloc peak of one
+extra request, measured separately so tracing does not skew the latencies.
+With --compare, endpoints whose p50 or p99 regressed by more than --tolerance
+are listed and the exit status is 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+import numpy as np
+from starlette.testclient import TestClient
+
+import backend.server.main as main
+import backend.server.storage as storage
+from backend.server.dataset import CaseStudy
+from backend.server.polygons import PolygonColumn
+from backend.server.registry import DatasetRegistry
+from data.synthetic_datasets import generate, write
+
+CASE_STUDY = 'data_synthetic'
+# (name, method, url, payload) of a request.
+Request = Tuple[str, str, str, Optional[dict]]
+
+
+def endpoint_requests(dataset: CaseStudy, num_ids: int = 100) -> List[Request]:
+    """A representative request to each /api endpoint of dataset."""
+    label = dataset.labels()[0]
+    image_id = dataset.ids[0]
+    image_ids = dataset.ids[:num_ids].tolist()
+    images = {'case_study': CASE_STUDY, 'image_ids': image_ids,
+              'score_fn': 'iou'}
+    filters = {'case_study': CASE_STUDY, 'sort_by': -1,
+               'prediction_fn': 'all_images', 'score_fn': 'iou',
+               'label_filter': ''}
+
+    def get(name, path, **params):
+        return name, 'get', '/api/%s?%s' % (path, urlencode(params)), None
+
+    def post(name, path, payload, **params):
+        return name, 'post', '/api/%s?%s' % (path, urlencode(params)), payload
+
+    return [
+        get('case-studies', 'case-studies'),
+        get('get-images', 'get-images', **filters),
+        get('get-images-label', 'get-images',
+            **dict(filters, label_filter=label)),
+        get('get-images-page', 'get-images-page', **filters, limit=100),
+        get('dashboard', 'dashboard', **filters),
+        get('get-image-count', 'get-image-count', case_study=CASE_STUDY,
+            prediction_fn='incorrect_only', label_filter=label),
+        get('get-saliency-image', 'get-saliency-image', case_study=CASE_STUDY,
+            image_id=image_id, score_fn='iou'),
+        get('image', 'image/%s/%s' % (CASE_STUDY, quote(image_id, safe=''))),
+        post('get-saliency-images', 'get-saliency-images', images),
+        post('get-saliency-images-url', 'get-saliency-images',
+             dict(images, image_format='url')),
+        post('get-saliency-images-thumbnails', 'get-saliency-images',
+             dict(images, image_format='url', polygon_format='binary',
+                  lod=1)),
+        post('stream-saliency-images', 'stream-saliency-images', images),
+        get('get-labels', 'get-labels', case_study=CASE_STUDY),
+        get('get-predictions', 'get-predictions', case_study=CASE_STUDY),
+        post('bin-scores', 'bin-scores',
+             {'case_study': CASE_STUDY, 'score_fn': 'iou',
+              'prediction_fn': 'correct_only'}),
+        post('bin-scores-ids', 'bin-scores', images),
+        get('bin-all-scores', 'bin-all-scores', case_study=CASE_STUDY,
+            prediction_fn='all_images', label_filter=''),
+        get('confusion-matrix', 'confusion-matrix', case_study=CASE_STUDY,
+            label_filter='', score_fn='iou'),
+        post('rescore-region', 'rescore-region',
+             {'case_study': CASE_STUDY,
+              'region': ['0,0 87,0 87,87 0,87']}, limit=100),
+        get('threshold-scores', 'threshold-scores', case_study=CASE_STUDY,
+            threshold=0.5, limit=100),
+        get('threshold-curve', 'threshold-curve', case_study=CASE_STUDY),
+        get('cache-stats', 'cache-stats'),
+    ]
+
+
+def send(client: TestClient, request: Request) -> int:
+    """Sends request and returns the size of its (encoded) response body."""
+    name, method, url, payload = request
+    response = client.request(method, url, json=payload, stream=True)
+    body = response.raw.read(decode_content=False)
+    if response.status_code != 200:
+        raise RuntimeError('%s returned %d: %s' % (
+            name, response.status_code, body[:200]))
+    return len(body)
+
+
+def measure(client: TestClient, request: Request, repeat: int, warmup: int,
+            cold: bool) -> Dict[str, float]:
+    """Latency, throughput and memory statistics of request."""
+
+    def run():
+        if cold:
+            main.query_cache.invalidate(CASE_STUDY)
+            for column in main.case_studies[CASE_STUDY].columns.values():
+                if isinstance(column, PolygonColumn):
+                    column.clear_cache()
+        start = time.perf_counter()
+        num_bytes = send(client, request)
+        return time.perf_counter() - start, num_bytes
+
+    for _ in range(warmup):
+        run()
+    latencies = []
+    for _ in range(repeat):
+        latency, num_bytes = run()
+        latencies.append(latency)
+
+    tracemalloc.start()
+    run()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'mean_ms': float(latencies.mean()),
+            'throughput_rps': float(1000 * len(latencies) / latencies.sum()),
+            'response_bytes': num_bytes,
+            'peak_bytes': peak_bytes}
+
+
+def benchmark_size(size: int, args: argparse.Namespace,
+                   directory: str) -> Tuple[dict, List[dict]]:
+    """Generates a case study of size images and benchmarks every endpoint."""
+    start = time.perf_counter()
+    path = write(generate(size, args.num_labels, num_polygons=args.num_polygons,
+                          polygon_points=args.polygon_points,
+                          image_bytes=args.image_bytes, seed=args.seed),
+                 directory, CASE_STUDY[len('data_'):])
+    generate_seconds = time.perf_counter() - start
+    if args.format == 'si':
+        storage.write_case_study(CaseStudy.from_json(CASE_STUDY, path),
+                                 os.path.join(directory, CASE_STUDY +
+                                              storage.SUFFIX))
+
+    main.case_studies = DatasetRegistry(directory)
+    main.query_cache.invalidate()
+    client = TestClient(main.app)
+    client.headers['Accept-Encoding'] = args.accept_encoding
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    dataset = main.case_studies[CASE_STUDY]
+    load_seconds = time.perf_counter() - start
+    load_peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    dataset_stats = {'size': size,
+                     'generate_seconds': generate_seconds,
+                     'load_seconds': load_seconds,
+                     'load_peak_bytes': load_peak_bytes,
+                     'nbytes': dataset.nbytes()}
+    print('%d images: loaded in %.2fs, %.1f MB' % (
+        size, load_seconds, dataset.nbytes() / 1e6), file=sys.stderr)
+
+    # Rescore requests get a 503 until the masks rasterized in the background
+    # since the load are ready.
+    dataset.saliency_masks()
+    results = []
+    for request in endpoint_requests(dataset):
+        if args.endpoints and request[0] not in args.endpoints:
+            continue
+        start = time.perf_counter()
+        send(client, request)  # Builds lazy indexes, e.g. saliency masks
+        first_ms = (time.perf_counter() - start) * 1000
+        for cache in args.cache:
+            stats = measure(client, request, args.repeat, args.warmup,
+                            cold=cache == 'cold')
+            results.append(dict({'size': size, 'endpoint': request[0],
+                                 'cache': cache, 'first_ms': first_ms},
+                                **stats))
+            print_result(results[-1])
+    return dataset_stats, results
+
+
+def print_result(result: dict):
+    print('%8d %-26s %-5s p50 %9.2fms  p99 %9.2fms  %9.1f req/s  '
+          '%10d B  peak %8.2f MB' % (
+              result['size'], result['endpoint'], result['cache'],
+              result['p50_ms'], result['p99_ms'], result['throughput_rps'],
+              result['response_bytes'], result['peak_bytes'] / 1e6))
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float,
+            min_ms: float) -> List[str]:
+    """Descriptions of the results that are slower than in baseline.
+
+    A latency regresses if it grew by more than tolerance (relative) and more
+    than min_ms (absolute), which filters out noise on fast endpoints.
+    """
+    baseline = {(r['size'], r['endpoint'], r['cache']): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get((result['size'], result['endpoint'],
+                            result['cache']))
+        if old is None:
+            continue
+        for stat in ['p50_ms', 'p99_ms']:
+            if result[stat] > old[stat] * (1 + tolerance) and \
+                    result[stat] - old[stat] > min_ms:
+                regressions.append('%d %s %s %s: %.2fms -> %.2fms (%+.0f%%)' % (
+                    result['size'], result['endpoint'], result['cache'], stat,
+                    old[stat], result[stat],
+                    100 * (result[stat] / old[stat] - 1)))
+    return regressions
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the API on synthetic case studies.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000],
+                        help='numbers of images of the case studies')
+    parser.add_argument('--num_labels', default=10, type=int,
+                        help='number of distinct labels')
+    parser.add_argument('--num_polygons', default=2, type=int,
+                        help='maximum number of saliency polygons per image')
+    parser.add_argument('--polygon_points', default=12, type=int,
+                        help='number of vertices per polygon')
+    parser.add_argument('--image_bytes', default=6000, type=int,
+                        help='size of each placeholder image in bytes')
+    parser.add_argument('--seed', default=0, type=int, help='random seed')
+    parser.add_argument('--format', default='json', choices=['json', 'si'],
+                        help='serve the JSON data file or the converted '
+                             'binary case study')
+    parser.add_argument('--repeat', default=20, type=int,
+                        help='measured requests per endpoint')
+    parser.add_argument('--warmup', default=2, type=int,
+                        help='unmeasured requests per endpoint')
+    parser.add_argument('--cache', nargs='+', default=['cold', 'warm'],
+                        choices=['cold', 'warm'],
+                        help='query cache states to measure')
+    parser.add_argument('--endpoints', nargs='+',
+                        help='only benchmark these endpoints')
+    parser.add_argument('--accept_encoding', default='gzip, br', type=str,
+                        help='Accept-Encoding header of the requests')
+    parser.add_argument('--fast_json', action='store_true',
+                        help='send responses with FAST_JSON')
+    parser.add_argument('-o', '--output', type=str,
+                        help='file to store the results as JSON')
+    parser.add_argument('--compare', type=str,
+                        help='results file to compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--min_ms', default=0.5, type=float,
+                        help='absolute slowdown reported as a regression')
+    args = parser.parse_args(argv)
+    main.FAST_JSON = args.fast_json
+
+    datasets, results = [], []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            dataset_stats, size_results = benchmark_size(size, args, directory)
+        datasets.append(dataset_stats)
+        results += size_results
+
+    report = {'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'platform': platform.platform(),
+                              'processor': platform.processor(),
+                              'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'config': vars(args),
+              'datasets': datasets,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance, args.min_ms)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,7 +1,8 @@
 import * as d3 from 'd3';
 import { makeUrl, toPayload } from '../etc/apiHelpers'
 import { URLHandler } from '../etc/URLHandler';
-import { SaliencyImg, Bins, ConfusionMatrixI } from '../types';
+import { decodePolygons } from '../etc/polygons';
+import { SaliencyImg, Bins, ConfusionMatrixI, Dashboard } from '../types';
 
 
 const baseurl = URLHandler.basicURL()
@@ -41,16 +42,26 @@ export class API {
      * @param {string} caseStudy - the name of the case study
      * @param {string[]} imageID - a list of string image ids
      * @param {string} scoreFn - the score function name
+     * @param {number} lod - the level of detail of the polygons, from 0 (every vertex) to 3 (coarsest)
      * @return {Promise<SaliencyImg>} a SaliencyImg object for the imageID in the caseStudy.
      */
-    getSaliencyImage(caseStudy: string, imageID: string, scoreFn: string): Promise<SaliencyImg> {
+    getSaliencyImage(caseStudy: string, imageID: string, scoreFn: string, lod: number = 0): Promise<SaliencyImg> {
         const imagesToSend = {
             case_study: caseStudy,
             image_id: imageID,
-            score_fn: scoreFn
+            score_fn: scoreFn,
+            image_format: 'url',
+            polygon_format: 'binary',
+            lod: lod
         }
         const url = makeUrl(this.baseURL + "/get-saliency-image", imagesToSend)
-        return d3.json(url)
+        return d3.json(url).then((salImg: any) => {
+            // The image is served separately so the browser can cache it.
+            salImg.image = this.baseURL + "/" + salImg.image
+            salImg.bbox = decodePolygons(salImg.bbox)
+            salImg.saliency = decodePolygons(salImg.saliency)
+            return <SaliencyImg>salImg
+        })
     }
 
 
@@ -76,6 +87,29 @@ export class API {
         return d3.json(url)
     }
 
+    /**
+     * Get the imageIDs, histogram bins, confusion matrix, labels, and predictions for the filter parameters
+     * in a single request.
+     *
+     * @param {string} caseStudy - the name of the case study
+     * @param {number} sortBy - 1 if sort ascending, -1 if sort descending
+     * @param {string} predictionFn - the name of the prediction filter
+     * @param {string} scoreFn - the score function name
+     * @param {string} labelFilter - the name of the label filter
+     * @return {Promise<Dashboard>} the data of every view for the filter parameters
+     */
+    getDashboard(caseStudy: string, sortBy: number, predictionFn: string, scoreFn: string, labelFilter: string): Promise<Dashboard> {
+        const toSend = {
+            case_study: caseStudy,
+            sort_by: sortBy,
+            prediction_fn: predictionFn,
+            score_fn: scoreFn,
+            label_filter: labelFilter,
+        }
+        const url = makeUrl(this.baseURL + "/dashboard", toSend)
+        return d3.json(url)
+    }
+
     /**
      * Get all dataset predictions.
      *
@@ -105,17 +139,19 @@ export class API {
     }
 
     /**
-     * Get the histogram bins for the scoreFn scores of the imageIDs.
+     * Get the histogram bins for the scoreFn scores of the images fitting the filter parameters.
      *
      * @param {string} caseStudy - the name of the case study
-     * @param {string[]} imageIDs - a list of string image ids
+     * @param {string} predictionFn - the name of the prediction filter
+     * @param {string} labelFilter - the name of the label filter
      * @param {string} scoreFn - the score function name
-     * @return {Promise<Bins[]>} a list of Bins for the binned scores of the image IDs
+     * @return {Promise<Bins[]>} a list of Bins for the binned scores of the filtered images
      */
-    binScores(caseStudy: string, imageIDs: string[], scoreFn: string): Promise<Bins[]> {
+    binScores(caseStudy: string, predictionFn: string, labelFilter: string, scoreFn: string): Promise<Bins[]> {
         const imagesToSend = {
             case_study: caseStudy,
-            image_ids: imageIDs,
+            prediction_fn: predictionFn,
+            label_filter: labelFilter,
             score_fn: scoreFn
         }
         const url = makeUrl(this.baseURL + "/bin-scores")
@@ -0,0 +1,44 @@
+/**
+ * Decode the binary polygon format of the API (see backend/server/polygons.py).
+ *
+ * @param {string} encoded - the base64 encoding of an image's polygons
+ * @return {string[]} the polygons as "x,y x,y ..." strings for SVG points attributes
+ */
+export function decodePolygons(encoded: string): string[] {
+    const bytes = Uint8Array.from(atob(encoded), c => c.charCodeAt(0))
+    let position = 0
+
+    // Unsigned LEB128 varint
+    const next = (): number => {
+        let value = 0
+        let shift = 0
+        let byte: number
+        do {
+            byte = bytes[position++]
+            value += (byte & 0x7f) * Math.pow(2, shift)
+            shift += 7
+        } while (byte & 0x80)
+        return value
+    }
+    // Zigzag-encoded signed delta
+    const nextDelta = (): number => {
+        const value = next()
+        return value % 2 ? -(value + 1) / 2 : value / 2
+    }
+
+    const polygons: string[] = []
+    const numPolygons = bytes.length ? next() : 0
+    for (let i = 0; i < numPolygons; i++) {
+        const numPoints = next()
+        const points: string[] = []
+        let x = 0
+        let y = 0
+        for (let j = 0; j < numPoints; j++) {
+            x += nextDelta()
+            y += nextDelta()
+            points.push(x + ',' + y)
+        }
+        polygons.push(points.join(' '))
+    }
+    return polygons
+}
@@ -10,6 +10,9 @@ import { State, URLParameters } from './state'
 import { caseStudyOptions, sortByOptions, predictionFnOptions, scoreFnOptions, labelFilterOptions } from './etc/selectionOptions'
 import { SaliencyImg } from './types';
 
+// Level of detail of the polygons in the image grid, see API.getSaliencyImage
+const THUMBNAIL_LOD = 1
+
 /**
  * Render static elements needed for interface
  */
@@ -166,28 +169,25 @@ export function main(el: Element, ignoreUrl: boolean = false, stateParams: Parti
         },
 
         /**
-        * Update the image panel, histogram, and confusion matrix.
+        * Update the image panel, histogram, confusion matrix, and drop down values with a single request.
         * @param {State} state - the current state of the application.
         */
         updatePage: (state: State) => {
             vizs.saliencyImages.clear()
-            const imageIDs = api.getImages(state.caseStudy(), state.sortBy(), state.predictionFn(), state.scoreFn(),
+            const dashboard = api.getDashboard(state.caseStudy(), state.sortBy(), state.predictionFn(), state.scoreFn(),
                 state.labelFilter())
             selectors.body.style('cursor', 'progress')
-            imageIDs.then(IDs => {
+            dashboard.then(data => {
                 // Update image panel
-                vizs.saliencyImages.update({ caseStudy: state.caseStudy(), imgIDs: IDs, scoreFn: state.scoreFn() })
+                vizs.saliencyImages.update({ caseStudy: state.caseStudy(), imgIDs: data.image_ids, scoreFn: state.scoreFn() })
 
-                // Update histogram
-                api.binScores(state.caseStudy(), IDs, state.scoreFn()).then(bins => {
-                    noSidebar || vizs.histogram.update(bins)
-                })
+                // Update histogram and confusion matrix
+                noSidebar || vizs.histogram.update(data.bins)
+                noSidebar || vizs.confusionMatrix.update(data.confusion_matrix)
 
-                // Update confusion matrix
-                const confusionMatrix = api.getConfusionMatrix(state.caseStudy(), state.labelFilter(), state.scoreFn())
-                confusionMatrix.then(matrix => {
-                    noSidebar ||vizs.confusionMatrix.update(matrix)
-                })
+                // Update label and prediction drop downs
+                eventHelpers.updateLabels(state, data.labels)
+                eventHelpers.updatePredictions(state, data.predictions)
 
                 // Finished async calls
                 selectors.body.style('cursor', 'default')
@@ -198,39 +198,37 @@ export function main(el: Element, ignoreUrl: boolean = false, stateParams: Parti
         /**
         * Update the label drop down values.
         * @param {State} state - the current state of the application.
+        * @param {string[]} labels - the labels of the case study.
         */
-        updateLabels: (state: State) => {
-            api.getLabels(state.caseStudy()).then(labels => {
-                const labelValues = labels.slice();
-                labels.splice.apply(labels, [0, 0 as string | number].concat(labelFilterOptions.map(option => option.name)));
-                labelValues.splice.apply(labelValues, [0, 0 as string | number].concat(labelFilterOptions.map(option => option.value)));
-                selectors.labelFilter.selectAll('option')
-                    .data(labels)
-                    .join('option')
-                    .attr('value', (label, i) => labelValues[i])
-                    .attr('disabled', state.isFrozen('labelFilter'))
-                    .text(label => label)
-                selectors.labelFilter.property('value', state.labelFilter())
-            })
+        updateLabels: (state: State, labels: string[]) => {
+            const labelValues = labels.slice();
+            labels.splice.apply(labels, [0, 0 as string | number].concat(labelFilterOptions.map(option => option.name)));
+            labelValues.splice.apply(labelValues, [0, 0 as string | number].concat(labelFilterOptions.map(option => option.value)));
+            selectors.labelFilter.selectAll('option')
+                .data(labels)
+                .join('option')
+                .attr('value', (label, i) => labelValues[i])
+                .attr('disabled', state.isFrozen('labelFilter'))
+                .text(label => label)
+            selectors.labelFilter.property('value', state.labelFilter())
         },
 
         /**
         * Update the prediction drop down values.
         * @param {State} state - the current state of the application.
+        * @param {string[]} predictions - the predictions of the case study.
         */
-        updatePredictions: (state: State) => {
-            api.getPredictions(state.caseStudy()).then(predictions => {
-                const predictionValues = predictions.slice();
-                predictions.splice.apply(predictions, [0, 0 as string | number].concat(predictionFnOptions.map(option => option.name)));
-                predictionValues.splice.apply(predictionValues, [0, 0 as string | number].concat(predictionFnOptions.map(option => option.value)));
-                selectors.predictionFn.selectAll('option')
-                    .data(predictions)
-                    .join('option')
-                    .attr('value', (prediction, i) => predictionValues[i])
-                    .attr('disabled', state.isFrozen('predictionFn'))
-                    .text(prediction => prediction)
-                selectors.predictionFn.property('value', state.predictionFn())
-            })
+        updatePredictions: (state: State, predictions: string[]) => {
+            const predictionValues = predictions.slice();
+            predictions.splice.apply(predictions, [0, 0 as string | number].concat(predictionFnOptions.map(option => option.name)));
+            predictionValues.splice.apply(predictionValues, [0, 0 as string | number].concat(predictionFnOptions.map(option => option.value)));
+            selectors.predictionFn.selectAll('option')
+                .data(predictions)
+                .join('option')
+                .attr('value', (prediction, i) => predictionValues[i])
+                .attr('disabled', state.isFrozen('predictionFn'))
+                .text(prediction => prediction)
+            selectors.predictionFn.property('value', state.predictionFn())
         }
     }
 
@@ -239,16 +237,12 @@ export function main(el: Element, ignoreUrl: boolean = false, stateParams: Parti
      * @param {State} state - the state of the application.
      */
     async function initializeFromState(state: State) {
-        // Fill in label and prediction options
-        eventHelpers.updateLabels(state)
-        eventHelpers.updatePredictions(state)
-
         // Set frontend via state parameters
         selectors.caseStudy.property('value', state.caseStudy())
         selectors.sortBy.property('value', state.sortBy())
         selectors.scoreFn.property('value', state.scoreFn())
 
-        // Get data from state parameters
+        // Get data and label and prediction options from state parameters
         eventHelpers.updatePage(state)
     }
 
@@ -259,9 +253,7 @@ export function main(el: Element, ignoreUrl: boolean = false, stateParams: Parti
         const caseStudy = selectors.caseStudy.property('value')
         state.caseStudy(caseStudy)
         state.labelFilter('')
-        eventHelpers.updateLabels(state)
         state.predictionFn('all_images')
-        eventHelpers.updatePredictions(state)
         eventHelpers.updatePage(state)
     });
 
@@ -296,7 +288,7 @@ export function main(el: Element, ignoreUrl: boolean = false, stateParams: Parti
     eventHandler.bind(LazySaliencyImages.events.onScreen, ({ el, id, scoreFn, caseStudy, caller }) => {
         /* Lazy load the saliency images. */
         const img = new SingleSaliencyImage(el, eventHandler)
-        api.getSaliencyImage(caseStudy, id, scoreFn).then(salImg => {
+        api.getSaliencyImage(caseStudy, id, scoreFn, THUMBNAIL_LOD).then(salImg => {
             img.update(salImg)
         })
     })
@@ -24,4 +24,15 @@ export interface ConfusionMatrixI {
     prediction: string,
     count: number,
     mean: number,
-}
\ No newline at end of file
+    variance: number,
+}
+
+export interface Dashboard {
+    image_ids: string[],
+    total: number,
+    next_offset: number,
+    bins: Bins[],
+    confusion_matrix: ConfusionMatrixI[],
+    labels: string[],
+    predictions: string[],
+}
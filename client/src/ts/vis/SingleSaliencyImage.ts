@@ -34,6 +34,9 @@ const Events: EventsI = {
 }
 
 function toImgStr(img: string) {
+    if (img.startsWith("http")) {
+        return img // The image is a URL to the image endpoint
+    }
     return "data:image/png;base64, " + img
 }
 
@@ -11,16 +11,23 @@ def get_args():
                          if name.islower() and not name.startswith("__")
                          and callable(models.__dict__[name]))
 
-    explanation_fns = [fn for fn in dir(explanation_methods)
-                       if not fn.startswith('__')]
+    explanation_fns = sorted(explanation_methods.EXPLANATION_METHODS)
 
     parser = argparse.ArgumentParser(description='Arguments for preprocessing.')
     parser.add_argument('-a', '--arch', default='resnet50', type=str,
                         choices=model_names, help='model architecture')
+    parser.add_argument('-b', '--batch_size', default=32, type=int,
+                        help='number of images predicted at once')
     parser.add_argument('-c', '--case_study', type=str, help='case study name')
-    parser.add_argument('-e', '--explanation_fn', type=str,
+    parser.add_argument('-e', '--explanation_fn', type=str, nargs='+',
                         choices=explanation_fns,
-                        help='explanation function name')
+                        help='explanation function names. The first one\'s '
+                             'columns are unsuffixed and the others\' end '
+                             'with .<name>')
+    parser.add_argument('-j', '--explanation_workers', default=1, type=int,
+                        help='number of processes computing explanations, '
+                             'each loading the model and using its share of '
+                             'the CPU threads')
     parser.add_argument('-g', '--ground_truth_dir', type=str,
                         help='path to ground truth annotations')
     parser.add_argument('-i', '--image_dir', type=str,
@@ -32,7 +39,32 @@ def get_args():
     parser.add_argument('-o', '--output_dir', default='./examples', type=str,
                         help='directory to store data files')
     parser.add_argument('-p', '--pretrain', action='store_true')
+    parser.add_argument('-r', '--restart', action='store_true',
+                        help='discard the records of a previous run instead '
+                             'of resuming it')
+    parser.add_argument('-s', '--shard_size', default=1000, type=int,
+                        help='number of records per output shard')
+    parser.add_argument('-t', '--threshold_bins', default=20, type=int,
+                        help='number of intervals between the saliency '
+                             'thresholds 0 and 1 that scores can be queried at')
+    parser.add_argument('-w', '--num_workers', default=4, type=int,
+                        help='number of processes loading the images and '
+                             'ground truth')
     parser.add_argument('-x', '--ground_truth_xml', action='store_true')
     parser.add_argument('--in9', action='store_true')
+    parser.add_argument('--lime_samples', default=1000, type=int,
+                        help='number of perturbed images LIME predicts')
+    parser.add_argument('--lime_batch_size', default=10, type=int,
+                        help='number of perturbed images LIME predicts at '
+                             'once')
+    parser.add_argument('--saliency_threshold', default=0.5, type=float,
+                        help='saliency at or above which the gradient '
+                             'methods include a pixel in the explanation mask')
+    parser.add_argument('--smoothgrad_samples', default=25, type=int,
+                        help='number of noisy copies of each image SmoothGrad '
+                             'averages the gradients of')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='random seed the per-image explanation seeds '
+                             'are derived from')
     args = parser.parse_args()
     return args
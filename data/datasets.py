@@ -1,5 +1,25 @@
-"""Dataset for images with ground truth annotations."""
+"""Dataset for images with ground truth annotations.
 
+Image sizes and ground truth annotations can be read once into an index file,
+so repeated runs over the same images neither reopen every image for its size
+nor reparse its annotation:
+
+    paths         The image paths relative to the image root, which must match
+                  the dataset's for the index to be used.
+    sizes         The (width, height) of each image.
+    has_ground_truth
+                  Whether each image has an annotation. Images without one get
+                  a mask of all 1s.
+    masks         The bit-packed masks of each image at the target resolution
+    resize, crop  and the geometry they were built for.
+
+The indexed masks are the ones the per-item ground_truth_transform of
+ToPILImage, Resize(resize), CenterCrop(crop) and ToTensor followed by a uint8
+cast gives: the full resolution mask is resized bilinearly and only the pixels
+that stay entirely inside the annotation are kept.
+"""
+
+import io
 import os
 import xml.etree.ElementTree as ET
 
@@ -13,11 +33,37 @@ class AnnotatedImageFolder(ImageFolder):
     """ImageFolder dataset with additional ground truth region data."""
 
     def __init__(self, image_root, ground_truth_root, transform=None,
-                 ground_truth_transform=None, ground_truth_is_xml=True):
+                 ground_truth_transform=None, ground_truth_is_xml=True,
+                 index_path=None, resize=None, crop=None):
+        """
+        Args:
+            image_root: The ImageFolder root of the images.
+            ground_truth_root: The directory of the ground truth annotations.
+            transform: The transform of the images.
+            ground_truth_transform: The transform of the full resolution
+                                    ground truth masks. Unused with an index.
+            ground_truth_is_xml: Whether the annotations are ImageNet bounding
+                                 box XML files rather than segmentation PNGs.
+            index_path: The index file of the image sizes and annotations,
+                        built if it is missing or out of date. None to read
+                        them for every item instead.
+            resize: With an index, the size of the smaller image edge the
+                    masks are resized to, as by transforms.Resize.
+            crop: With an index, the size of the center crop of the masks, as
+                  by transforms.CenterCrop.
+        """
         super().__init__(image_root, transform=transform)
         self.ground_truth_root = ground_truth_root
         self.ground_truth_transform = ground_truth_transform
         self.ground_truth_is_xml = ground_truth_is_xml
+        self.resize = resize
+        self.crop = crop
+        self.index = None
+        if index_path is not None:
+            if resize is None or crop is None:
+                raise ValueError('An index needs the resize and crop sizes '
+                                 'of the masks.')
+            self.index = self._load_index(index_path)
 
     def __len__(self, ):
         return super().__len__()
@@ -26,25 +72,26 @@ class AnnotatedImageFolder(ImageFolder):
         """Returns the image, the ground truth mask, and the image name."""
         image, _ = super().__getitem__(index)
         image_path, _ = self.imgs[index]
-        image_width, image_height = Image.open(image_path).size
+        image_name = _image_name(image_path)
+        if self.index is not None:
+            return image, torch.from_numpy(self._indexed_mask(index)), \
+                image_name
 
-        image_name = image_path.strip().split('/')[-1].split('.')[0]
-        if self.ground_truth_is_xml:
-            n_id, _ = image_name.split('_')
-            ground_truth_path = os.path.join(self.ground_truth_root,
-                                             n_id,
-                                             '%s.xml' % image_name)
-        else:
-            ground_truth_path = os.path.join(self.ground_truth_root,
-                                             '%s_Segmentation.png' % (
-                                                 image_name))
-        ground_truth_mask = self._get_ground_truth_mask(ground_truth_path,
-                                                        image_height,
-                                                        image_width)
+        image_width, image_height = Image.open(image_path).size
+        ground_truth_mask = self._get_ground_truth_mask(
+            self._ground_truth_path(image_name), image_height, image_width)
         ground_truth_mask = self.ground_truth_transform(
             ground_truth_mask).squeeze(0)
         return image, ground_truth_mask, image_name
 
+    def _ground_truth_path(self, image_name):
+        if self.ground_truth_is_xml:
+            n_id, _ = image_name.split('_')
+            return os.path.join(self.ground_truth_root, n_id,
+                                '%s.xml' % image_name)
+        return os.path.join(self.ground_truth_root,
+                            '%s_Segmentation.png' % image_name)
+
     def _get_ground_truth_mask(self, ground_truth_path, img_height, img_width):
         """Returns a mask the same size as the image with 1s for pixels in the
         ground truth region and 0 elsewhere."""
@@ -62,6 +109,89 @@ class AnnotatedImageFolder(ImageFolder):
             mask = torch.ones((img_height, img_width))
         return mask
 
+    def _indexed_mask(self, index):
+        """The uint8 (crop, crop) ground truth mask of the image at index."""
+        if not self.index['has_ground_truth'][index]:
+            return np.ones((self.crop, self.crop), dtype=np.uint8)
+        return np.unpackbits(self.index['masks'][index])[
+            :self.crop * self.crop].reshape(self.crop, self.crop)
+
+    def _load_index(self, index_path):
+        """Loads the index at index_path, rebuilding it if it does not match
+        the dataset's images, annotation type or mask geometry."""
+        paths = np.array([os.path.relpath(path, self.root)
+                          for path, _ in self.imgs])
+        if os.path.isfile(index_path):
+            with np.load(index_path) as f:
+                index = dict(f)
+            if np.array_equal(index['paths'], paths) and \
+                    bool(index['is_xml']) == self.ground_truth_is_xml and \
+                    'masks' in index and \
+                    (int(index['resize']), int(index['crop'])) == \
+                    (self.resize, self.crop):
+                return index
+        print('Indexing the ground truth of %d images in %s' % (
+            len(paths), index_path))
+        index = self._build_index(paths)
+        # Written to memory first, so an interrupted run leaves no partial
+        # index behind.
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **index)
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        with open(index_path + '.tmp', 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(index_path + '.tmp', index_path)
+        return index
+
+    def _build_index(self, paths):
+        """Reads the size and annotation of every image."""
+        sizes = np.zeros((len(paths), 2), dtype=np.int32)
+        has_ground_truth = np.zeros(len(paths), dtype=bool)
+        masks = np.zeros((len(paths), (self.crop * self.crop + 7) // 8),
+                         dtype=np.uint8)
+        for i, (image_path, _) in enumerate(self.imgs):
+            # Opening an image only reads its header.
+            sizes[i] = Image.open(image_path).size
+            width, height = sizes[i]
+            ground_truth_path = self._ground_truth_path(
+                _image_name(image_path))
+            try:
+                if self.ground_truth_is_xml:
+                    mask = np.zeros((height, width), dtype=np.uint8)
+                    for c in _parse_ground_truth_xml(ground_truth_path):
+                        mask[c['ymin']:c['ymax'], c['xmin']:c['xmax']] = 255
+                else:
+                    mask = np.array(Image.open(ground_truth_path))
+                has_ground_truth[i] = True
+            except IOError:
+                continue
+            masks[i] = np.packbits(
+                _transform_mask(mask, self.resize, self.crop))
+
+        return {'paths': paths, 'is_xml': self.ground_truth_is_xml,
+                'sizes': sizes, 'has_ground_truth': has_ground_truth,
+                'masks': masks, 'resize': self.resize, 'crop': self.crop}
+
+
+def _image_name(image_path):
+    return image_path.strip().split('/')[-1].split('.')[0]
+
+
+def _transform_mask(mask, resize, crop):
+    """The (crop, crop) boolean mask of the 2D uint8 mask after Resize(resize)
+    and CenterCrop(crop), which is 1 where the bilinearly resized mask is 255,
+    as the uint8 cast of the transformed tensor is."""
+    height, width = mask.shape
+    if width <= height:
+        new_width, new_height = resize, int(resize * height / width)
+    else:
+        new_width, new_height = int(resize * width / height), resize
+    top = int(round((new_height - crop) / 2.0))
+    left = int(round((new_width - crop) / 2.0))
+    image = Image.fromarray(mask).resize((new_width, new_height),
+                                         Image.BILINEAR)
+    return np.asarray(image.crop((left, top, left + crop, top + crop))) == 255
+
 
 def _parse_ground_truth_xml(ground_truth_path):
     """Parse ImageNet formatted bounding box XML file."""
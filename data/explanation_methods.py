@@ -1,53 +1,215 @@
 """Module contains functions that extract explanation regions from an image and
 a model. Additional functions can be added for additional explanation
-regions."""
+regions, and registered in EXPLANATION_METHODS.
+
+Every method returns binary masks of the pixels it considers salient and, with
+return_saliency, the continuous saliency in [0, 1] the masks threshold. `lime`
+explains a single image with many perturbed predictions. The gradient methods
+explain a whole batch in a few forward and backward passes, given the classes
+the model predicted for it.
+"""
 
 import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms as transforms
 from PIL import Image
 from lime import lime_image
 
 
-def lime(image, model):
-    """Get a explanation mask of the model's decision on the image."""
-    normalize = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                             std=[0.229, 0.224, 0.225])
-    ])
+_normalize = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                         std=[0.229, 0.224, 0.225])
+])
+
+_vector_to_image = transforms.Compose([
+    transforms.Lambda(lambda x: x[0]),
+    transforms.Normalize(mean=[0, 0, 0], std=[4.3668, 4.4643, 4.4444]),
+    transforms.Normalize(mean=[-0.485, -0.456, -0.406], std=[1, 1, 1]),
+])
+
+
+def lime(image, model, return_saliency=False, num_samples=1000,
+         batch_size=10, random_seed=None):
+    """Get a explanation mask of the model's decision on the image.
 
-    vector_to_image = transforms.Compose([
-        transforms.Lambda(lambda x: x[0]),
-        transforms.Normalize(mean=[0, 0, 0], std=[4.3668, 4.4643, 4.4444]),
-        transforms.Normalize(mean=[-0.485, -0.456, -0.406], std=[1, 1, 1]),
-    ])
+    If return_saliency is True, also returns the continuous saliency: the
+    positive LIME weight of each pixel's superpixel, normalized to [0, 1].
 
-    pil_image = vector_to_image(image)
+    The model must already be in eval mode on its device. num_samples
+    perturbed images are predicted batch_size at a time, and random_seed
+    makes the segmentation and the perturbations deterministic.
+    """
+    pil_image = _vector_to_image(image)
     pil_image = np.uint8(pil_image * 255)
     pil_image = Image.fromarray(pil_image.transpose(1, 2, 0))
 
-    explainer = lime_image.LimeImageExplainer()
+    explainer = lime_image.LimeImageExplainer(random_state=random_seed)
+    device = next(model.parameters()).device
 
     def batch_predict(images):
-        model.eval()
-        batch = torch.stack(tuple(normalize(img) for img in images), dim=0)
-
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model.to(device)
-        batch = batch.to(device)
-
-        logits = model(batch)
+        batch = torch.stack(tuple(_normalize(img) for img in images), dim=0)
+        with torch.no_grad():
+            logits = model(batch.to(device))
         probs = F.softmax(logits, dim=1)
-        return probs.detach().cpu().numpy()
+        return probs.cpu().numpy()
 
     explanation = explainer.explain_instance(np.array(pil_image),
                                              batch_predict,
                                              top_labels=1,
                                              hide_color=0,
-                                             num_samples=1000)
+                                             num_samples=num_samples,
+                                             batch_size=batch_size,
+                                             random_seed=random_seed,
+                                             progress_bar=False)
     _, mask = explanation.get_image_and_mask(explanation.top_labels[0],
                                              positive_only=True, num_features=5,
                                              hide_rest=False)
-    return mask
+    if not return_saliency:
+        return mask
+
+    weights = np.zeros(explanation.segments.max() + 1)
+    for segment, weight in explanation.local_exp[explanation.top_labels[0]]:
+        weights[segment] = max(weight, 0)
+    saliency = weights[explanation.segments]
+    if saliency.max() > 0:
+        saliency /= saliency.max()
+    return mask, saliency
+
+
+def vanilla_gradients(images, model, targets, return_saliency=False,
+                      threshold=0.5, kernel_size=7, random_seeds=None):
+    """Get explanation masks of the model's decisions on a batch of images
+    from the gradient of each predicted class score with respect to the image.
+    targets are the (N,) class indices the model predicted for the images.
+
+    A pixel's saliency is its largest absolute gradient over the color
+    channels, averaged over kernel_size windows so the masks are regions
+    rather than scattered pixels, and normalized to [0, 1] per image. Masks
+    are the pixels whose saliency is at least threshold.
+
+    Returns the (N, H, W) uint8 masks and, if return_saliency is True, the
+    (N, H, W) saliency. random_seeds is unused: the method is deterministic.
+    """
+    saliency = _input_gradients(images, model, targets).abs().amax(dim=1)
+    return _masks(_smooth(saliency, kernel_size), threshold, return_saliency)
+
+
+def smoothgrad(images, model, targets, return_saliency=False, threshold=0.5,
+               kernel_size=7, num_samples=25, noise_level=0.15,
+               random_seeds=None):
+    """Get explanation masks like `vanilla_gradients`, from the gradients
+    averaged over num_samples noisy copies of each image.
+
+    The Gaussian noise has a standard deviation of noise_level times the
+    image's value range. random_seeds, one per image, make the noise of each
+    image deterministic regardless of the batch it is explained in.
+    """
+    generators = [torch.Generator().manual_seed(seed)
+                  for seed in (random_seeds or [])]
+    value_range = images.flatten(1).max(dim=1)[0] - images.flatten(1).min(
+        dim=1)[0]
+    sigma = (noise_level * value_range).view(-1, 1, 1, 1)
+    total = torch.zeros_like(images)
+    for _ in range(num_samples):
+        if generators:
+            noise = torch.stack([torch.randn(images.shape[1:],
+                                             generator=generator)
+                                 for generator in generators])
+        else:
+            noise = torch.randn(images.shape)
+        total += _input_gradients(
+            images + sigma * noise.to(images.device), model, targets).abs()
+    saliency = (total / num_samples).amax(dim=1)
+    return _masks(_smooth(saliency, kernel_size), threshold, return_saliency)
+
+
+def grad_cam(images, model, targets, return_saliency=False, threshold=0.5,
+             random_seeds=None):
+    """Get explanation masks of the model's decisions on a batch of images
+    with Grad-CAM.
+
+    The activations of the model's last convolutional stage (see
+    `_grad_cam_layer`) are weighted by the mean gradient of the predicted
+    class score (of targets, as in `vanilla_gradients`) with respect to each
+    channel, summed, rectified and upsampled to the image size. Saliency is
+    normalized to [0, 1] per image and masks are the pixels whose saliency is
+    at least threshold. random_seeds is unused: the method is deterministic.
+    """
+    activations = []
+    handle = _grad_cam_layer(model).register_forward_hook(
+        lambda module, inputs, output: activations.append(output))
+    try:
+        with torch.enable_grad():
+            score = model(images).gather(1, targets[:, None]).sum()
+            gradients, = torch.autograd.grad(score, activations[0])
+    finally:
+        handle.remove()
+    weights = gradients.mean(dim=(2, 3), keepdim=True)
+    cam = F.relu((weights * activations[0].detach()).sum(dim=1, keepdim=True))
+    saliency = F.interpolate(cam, size=images.shape[-2:], mode='bilinear',
+                             align_corners=False)[:, 0]
+    return _masks(saliency, threshold, return_saliency)
+
+
+# The layer whose output Grad-CAM weights, by attribute name, for the
+# torchvision architectures. Other models use their last convolution.
+_GRAD_CAM_LAYERS = ['layer4', 'Mixed_7c', 'inception5b', 'conv5',
+                    'trunk_output', 'layers', 'features']
+
+
+def _grad_cam_layer(model):
+    """The last convolutional stage of a torchvision model."""
+    for name in _GRAD_CAM_LAYERS:
+        layer = getattr(model, name, None)
+        if isinstance(layer, nn.Module):
+            return layer
+    convolutions = [module for module in model.modules()
+                    if isinstance(module, nn.Conv2d)]
+    if not convolutions:
+        raise ValueError('Grad-CAM needs a convolutional model, got %s' %
+                         type(model).__name__)
+    return convolutions[-1]
+
+
+def _input_gradients(images, model, targets):
+    """The gradient of each image's target class score w.r.t. the image."""
+    with torch.enable_grad():
+        images = images.detach().requires_grad_()
+        score = model(images).gather(1, targets[:, None]).sum()
+        gradients, = torch.autograd.grad(score, images)
+    return gradients
+
+
+def _smooth(saliency, kernel_size):
+    """Averages (N, H, W) saliency over kernel_size windows."""
+    if kernel_size <= 1:
+        return saliency
+    return F.avg_pool2d(saliency[:, None], kernel_size, stride=1,
+                        padding=kernel_size // 2,
+                        count_include_pad=False)[:, 0]
+
+
+def _masks(saliency, threshold, return_saliency):
+    """Normalizes (N, H, W) saliency to [0, 1] per image and thresholds it
+    into uint8 masks, like the masks `lime` returns."""
+    saliency = saliency.detach()
+    peak = saliency.flatten(1).max(dim=1)[0].clamp(min=1e-12)
+    saliency = (saliency / peak.view(-1, 1, 1)).cpu().numpy()
+    masks = ((saliency >= threshold) & (saliency > 0)).astype(np.uint8)
+    if not return_saliency:
+        return masks
+    return masks, saliency
+
+
+# Explanation methods by name, as selected with generate_datasets.py -e.
+EXPLANATION_METHODS = {
+    'lime': lime,
+    'vanilla_gradients': vanilla_gradients,
+    'smoothgrad': smoothgrad,
+    'grad_cam': grad_cam,
+}
+# The methods that explain a batch of images per call rather than one image.
+BATCHED_METHODS = ['vanilla_gradients', 'smoothgrad', 'grad_cam']
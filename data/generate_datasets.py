@@ -2,8 +2,12 @@
 explanations, and ground truth regions that can be consumed by shared interest.
 """
 import base64
+import collections
 import json
+import multiprocessing
 import os
+import time
+import zlib
 from io import BytesIO
 
 import cv2
@@ -20,6 +24,7 @@ from PIL import Image
 from args import get_args
 from datasets import AnnotatedImageFolder
 from nltk.corpus import wordnet
+from shards import ShardWriter, merge_shards
 from tqdm import tqdm
 
 
@@ -29,15 +34,13 @@ def main():
     with open(args.label_map, 'r') as f:
         label_map = json.load(f)
 
+    # Start the explanation workers before torch runs anything, so they are
+    # forked from a process without threads.
+    pool = _explanation_pool(args)
+
     # Load the model
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    if args.pretrain:
-        model = models.__dict__[args.arch](pretrained=True)
-    else:
-        model = models.__dict__[args.arch](pretrained=False,
-                                           num_classes=args.num_classes)
-        model.load_state_dict(torch.load(args.model))
-    model.to(device).eval()
+    device = _device()
+    model = _load_model(args, device)
 
     # Load the dataset. Update transformations if new datasets are used.
     image_to_vector = transforms.Compose([
@@ -48,67 +51,262 @@ def main():
                              std=[0.229, 0.224, 0.225]),
     ])
 
-    bbox_to_vector = transforms.Compose([
-        transforms.ToPILImage(),
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor()
-    ])
-
     vector_to_image = transforms.Compose([
         transforms.Lambda(lambda x: x[0]),
         transforms.Normalize(mean=[0, 0, 0], std=[4.3668, 4.4643, 4.4444]),
         transforms.Normalize(mean=[-0.485, -0.456, -0.406], std=[1, 1, 1]),
     ])
 
+    # Image sizes and ground truth are read once into an index, and masks
+    # are built at the size of the transformed images.
     dataset = AnnotatedImageFolder(args.image_dir,
                                    args.ground_truth_dir,
                                    image_to_vector,
-                                   bbox_to_vector,
-                                   args.ground_truth_xml)
-
-    # Process the data
-    data = {'fname': {},
-            'image': {},
-            'bbox': {},
-            'saliency': {},
-            'label': {},
-            'prediction': {},
-            'ground_truth_coverage': {},
-            'explanation_coverage': {},
-            'iou': {}}
-
-    for i, (image, ground_truth_mask, image_name) in enumerate(tqdm(dataset)):
+                                   ground_truth_is_xml=args.ground_truth_xml,
+                                   index_path=os.path.join(
+                                       args.output_dir,
+                                       'ground_truth_%s.npz' % args.case_study),
+                                   resize=256, crop=224)
+
+    # Records are appended to shards as they are computed. A rerun after an
+    # interruption only processes the images without a record.
+    output_file = os.path.join(args.output_dir,
+                               'data_%s.json' % args.case_study)
+    writer = ShardWriter(os.path.join(args.output_dir,
+                                      'data_%s.shards' % args.case_study),
+                         _run_config(args), args.shard_size, args.restart)
+    remaining = [i for i in range(len(dataset)) if i not in writer.completed]
+
+    # Images are decoded, transformed and their ground truth parsed by
+    # num_workers processes, and predicted batch_size at a time.
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset,
+                                                                 remaining),
+                                         batch_size=args.batch_size,
+                                         num_workers=args.num_workers,
+                                         pin_memory=device.type == 'cuda')
+    # The first method's columns are unsuffixed, as in single-method data
+    # files, and those of the others end with .<method>, e.g. iou.lime.
+    # Batched methods explain each loaded batch at once; the others explain
+    # one image at a time, in the pool if there is one.
+    methods = args.explanation_fn
+    batched_methods, image_methods = _split_methods(methods)
+    image_options = [_explanation_options(args, method)
+                     for method in image_methods]
+    progress = tqdm(total=len(dataset), initial=len(writer.completed),
+                    unit='image')
+    start = time.perf_counter()
+    inference_seconds = 0
+
+    def predicted_images():
+        """Yields the index, image, ground truth, name, prediction and
+        batched method explanations of each remaining image in dataset
+        order."""
+        nonlocal inference_seconds
+        indices = iter(remaining)
+        for images, ground_truth_masks, image_names in loader:
+            inference_start = time.perf_counter()
+            predictions = _predict(model, images, device)
+            inference_seconds += time.perf_counter() - inference_start
+            seeds = [_image_seed(args.seed, name) for name in image_names]
+            batch_explanations = list(zip(*[
+                _explain_batch(method, model, images, predictions, device,
+                               seeds, _explanation_options(args, method))
+                for method in batched_methods])) or [()] * len(images)
+            # indices comes last, so zip stops before taking an extra one.
+            for item in zip(images, ground_truth_masks, image_names,
+                            predictions, batch_explanations, indices):
+                yield (item[-1],) + item[:-1]
+
+    def explained_images():
+        """Yields the index, image, ground truth, name and prediction of each
+        predicted image with the explanation mask and saliency of every
+        method, in the order of methods.
+
+        With a pool, up to 4 images per worker are explained concurrently
+        while the next batches are loaded and predicted.
+        """
+        def merged(item, image_explanations):
+            explanations = dict(zip(batched_methods, item[-1]))
+            explanations.update(zip(image_methods, image_explanations))
+            return item[:-1] + ([explanations[method]
+                                 for method in methods],)
+
+        if pool is None:
+            for item in predicted_images():
+                yield merged(item, _explain(
+                    image_methods, model, item[1],
+                    _image_seed(args.seed, item[3]), image_options))
+            return
+        pending = collections.deque()
+        for item in predicted_images():
+            pending.append((item, pool.apply_async(
+                _explain_in_worker,
+                (image_methods, item[1].numpy(),
+                 _image_seed(args.seed, item[3]), image_options))))
+            if len(pending) >= 4 * args.explanation_workers:
+                item, result = pending.popleft()
+                yield merged(item, result.get())
+        while pending:
+            item, result = pending.popleft()
+            yield merged(item, result.get())
+
+    num_images = 0
+    for (i, image, ground_truth_mask, image_name, prediction,
+         explanations) in explained_images():
         if args.in9:  # Use imagenet label for imagenet9 data.
             label = _get_imagenet_label(image_name)
         else:  # Otherwise use label from ImageFolder dataset.
             label = dataset.imgs[i][0].split('/')[-2]
-        data['label'][i] = label
-
-        data['fname'][i] = image_name
-        data['image'][i] = _image_to_string(
-            vector_to_image(image.unsqueeze(0)).numpy())
 
         ground_truth_mask = ground_truth_mask.numpy().astype('uint8')
-        data['bbox'][i] = _mask_to_polygon(_resize_image(ground_truth_mask))
+        record = {
+            'index': i,
+            'fname': image_name,
+            'image': _image_to_string(
+                vector_to_image(image.unsqueeze(0)).numpy()),
+            'bbox': _mask_to_polygon(_resize_image(ground_truth_mask)),
+            'label': label,
+            'prediction': label_map[str(prediction)],
+        }
+        scores = _get_scores(ground_truth_mask, np.stack(
+            [explanation_mask for explanation_mask, _ in explanations]))
+        for k, (method, (explanation_mask, saliency)) in enumerate(
+                zip(methods, explanations)):
+            suffix = '' if k == 0 else '.' + method
+            record['saliency' + suffix] = _mask_to_polygon(
+                _resize_image(explanation_mask))
+            for score_key, values in scores.items():
+                record[score_key + suffix] = values[k]
+            (record['saliency_inside' + suffix],
+             record['saliency_outside' + suffix]) = _get_threshold_histograms(
+                ground_truth_mask, saliency, args.threshold_bins)
+        writer.write(record)
+        num_images += 1
+        progress.update()
+    progress.close()
+    writer.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        explanation_fn = getattr(explanation_methods, args.explanation_fn)
-        explanation_mask = explanation_fn(image.unsqueeze(0), model)
-        explanation_mask = explanation_mask.astype('uint8')
-        data['saliency'][i] = _mask_to_polygon(_resize_image(explanation_mask))
+    seconds = time.perf_counter() - start
+    print('Processed %d images in %.1fs: %.2f images/s overall, %.1f images/s '
+          'inference' % (num_images, seconds, num_images / max(seconds, 1e-9),
+                         num_images / max(inference_seconds, 1e-9)))
 
-        scores = _get_scores(ground_truth_mask, explanation_mask)
-        for score_key, score in scores.items():
-            data[score_key][i] = score
+    # Write data to disk
+    print('Merged %d records into %s' % (
+        merge_shards(writer.directory, output_file), output_file))
 
-        outputs = model(image.unsqueeze(0).to(device))
-        prediction = label_map[str(int(outputs.argmax(dim=1)))]
-        data['prediction'][i] = prediction
 
-    # Write data to disk
-    output_file = os.path.join(args.output_dir, 'data_%s.json' % args.case_study)
-    with open(output_file, 'w') as f:
-        json.dump(data, f)
+def _run_config(args):
+    """The arguments the records depend on, which a resumed run must share."""
+    return {name: getattr(args, name) for name in [
+        'arch', 'model', 'num_classes', 'pretrain', 'image_dir',
+        'ground_truth_dir', 'ground_truth_xml', 'in9', 'label_map',
+        'explanation_fn', 'lime_samples', 'smoothgrad_samples',
+        'saliency_threshold', 'threshold_bins', 'seed']}
+
+
+def _device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def _load_model(args, device):
+    """Loads the model selected by args in eval mode on device."""
+    if args.pretrain:
+        model = models.__dict__[args.arch](pretrained=True)
+    else:
+        model = models.__dict__[args.arch](pretrained=False,
+                                           num_classes=args.num_classes)
+        model.load_state_dict(torch.load(args.model, map_location=device))
+    return model.to(device).eval()
+
+
+# The model of an explanation worker process, loaded once by
+# _init_explanation_worker.
+_worker_model = None
+
+
+def _explanation_pool(args):
+    """A pool of args.explanation_workers processes that each load the model
+    and use their share of the CPU threads, or None to explain in-process.
+
+    Batched methods always run in-process, so there is no pool if every method
+    is batched."""
+    if args.explanation_workers <= 1 or not _split_methods(
+            args.explanation_fn)[1]:
+        return None
+    num_threads = max(1, (os.cpu_count() or 1) // args.explanation_workers)
+    return multiprocessing.get_context('fork').Pool(
+        args.explanation_workers, initializer=_init_explanation_worker,
+        initargs=(args, num_threads))
+
+
+def _init_explanation_worker(args, num_threads):
+    global _worker_model
+    torch.set_num_threads(num_threads)
+    _worker_model = _load_model(args, _device())
+
+
+def _split_methods(methods):
+    """The batched and the single-image methods among methods."""
+    batched = [method for method in methods
+               if method in explanation_methods.BATCHED_METHODS]
+    return batched, [method for method in methods if method not in batched]
+
+
+def _explain_in_worker(methods, image, seed, options):
+    return _explain(methods, _worker_model, torch.from_numpy(image), seed,
+                    options)
+
+
+def _explain(methods, model, image, seed, options):
+    """The explanation mask and continuous saliency of image for each of the
+    single-image methods, called with the matching keyword arguments of
+    options."""
+    explanations = []
+    for method, method_options in zip(methods, options):
+        explanation_mask, saliency = explanation_methods.EXPLANATION_METHODS[
+            method](image.unsqueeze(0), model, return_saliency=True,
+                    random_seed=seed, **method_options)
+        explanations.append((explanation_mask.astype('uint8'), saliency))
+    return explanations
+
+
+def _explain_batch(method, model, images, predictions, device, seeds,
+                   options):
+    """The explanation mask and continuous saliency of each image of a batch
+    with a batched method, explaining the predictions already made for it."""
+    masks, saliency = explanation_methods.EXPLANATION_METHODS[method](
+        images.to(device, non_blocking=True), model,
+        torch.tensor(predictions, device=device), return_saliency=True,
+        random_seeds=seeds, **options)
+    return list(zip(masks, saliency))
+
+
+def _explanation_options(args, method):
+    """The keyword arguments of the explanation method from args."""
+    if method == 'lime':
+        return {'num_samples': args.lime_samples,
+                'batch_size': args.lime_batch_size}
+    options = {'threshold': args.saliency_threshold}
+    if method == 'smoothgrad':
+        options['num_samples'] = args.smoothgrad_samples
+    return options
+
+
+def _image_seed(seed, image_name):
+    """A random seed that only depends on seed and the image, so explanations
+    do not depend on the order or the process they are computed in."""
+    return zlib.crc32(('%d:%s' % (seed, image_name)).encode('utf-8'))
+
+
+def _predict(model, images, device):
+    """The class index the model predicts for each image of a batch."""
+    with torch.no_grad():
+        outputs = model(images.to(device, non_blocking=True))
+    return outputs.argmax(dim=1).tolist()
 
 
 def _mask_to_polygon(mask_array):
@@ -122,28 +320,54 @@ def _mask_to_polygon(mask_array):
     return polygon_strings
 
 
-def _get_scores(ground_truth, explanation):
-    def explanation_coverage(ground_truth_mask, explanation_mask):
-        """Proportion of explanation that overlaps with the ground truth ."""
-        return float(np.sum(ground_truth_mask & explanation_mask) / np.sum(
-            explanation_mask))
-
-    def ground_truth_coverage(ground_truth_mask, explanation_mask):
-        """Proportion of ground truth that overlaps with the explanation."""
-        return float(np.sum(ground_truth_mask & explanation_mask) / np.sum(
-            ground_truth_mask))
-
-    def iou(ground_truth_mask, explanation_mask):
-        """Intersection over union of the ground truth and explanation."""
-        intersection = np.sum(ground_truth_mask & explanation_mask)
-        union = np.sum(ground_truth_mask | explanation_mask)
-        return float(intersection / union)
-
-    return {
-        'explanation_coverage': explanation_coverage(ground_truth, explanation),
-        'ground_truth_coverage': ground_truth_coverage(ground_truth,
-                                                       explanation),
-        'iou': iou(ground_truth, explanation)}
+def _get_scores(ground_truth, explanations):
+    """The shared interest scores of several explanations of an image.
+
+    The pixel counts are computed once for all the explanations, and each
+    intersection once for all the scores.
+
+    Args:
+        ground_truth: The (H, W) ground truth mask.
+        explanations: The (M, H, W) explanation masks of M methods.
+
+    Returns:
+        Mapping from score name to the M scores of the explanations. Scores
+        whose denominator is 0 are NaN.
+    """
+    ground_truth = ground_truth.astype(bool)
+    explanations = explanations.astype(bool).reshape(
+        (-1,) + ground_truth.shape)
+    ground_truth_area = np.count_nonzero(ground_truth)
+    explanation_area = np.count_nonzero(explanations, axis=(1, 2))
+    intersection = np.count_nonzero(explanations & ground_truth, axis=(1, 2))
+    union = ground_truth_area + explanation_area - intersection
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {
+            # Proportion of explanation that overlaps with the ground truth.
+            'explanation_coverage': (intersection / explanation_area).tolist(),
+            # Proportion of ground truth that overlaps with the explanation.
+            'ground_truth_coverage': (intersection /
+                                      ground_truth_area).tolist(),
+            # Intersection over union of the ground truth and explanation.
+            'iou': (intersection / union).tolist()}
+
+
+def _get_threshold_histograms(ground_truth, saliency, num_bins):
+    """Cumulative histograms of saliency inside and outside the ground truth.
+
+    Element k of each histogram counts the pixels with saliency >= k / num_bins,
+    so the server can score the saliency thresholded at any of these levels
+    without rerunning the explanation method.
+    """
+    ground_truth = ground_truth.astype(bool).reshape(saliency.shape)
+    thresholds = np.linspace(0, 1, num_bins + 1)
+
+    def cumulative_counts(values):
+        values = np.sort(values, axis=None)
+        return (len(values) - np.searchsorted(values, thresholds)).tolist()
+
+    return (cumulative_counts(saliency[ground_truth]),
+            cumulative_counts(saliency[~ground_truth]))
 
 
 def _image_to_string(array):
@@ -0,0 +1,203 @@
+"""Sharded, resumable output for generate_datasets.py.
+
+Records are appended as JSON lines to numbered shard files in a directory,
+with a manifest describing the run:
+
+    data_<case_study>.shards/
+        manifest.json        The run's config and the records of each shard.
+        shard-00000.jsonl    One record per line: the image index and a value
+        shard-00001.jsonl    per column.
+
+Every record is flushed as soon as it is written, so an interrupted run loses
+at most the line being written. Restarting the run skips the images whose
+records exist, and `merge_shards` assembles the shards into the data file the
+server reads once every image is done. Shards can also be merged by hand:
+
+    python data/shards.py examples/data_dogs.shards -o examples/data_dogs.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+
+MANIFEST = 'manifest.json'
+SHARD_PATTERN = 'shard-%05d.jsonl'
+
+
+def read_shard(path, repair=False):
+    """Yields the records of a shard file.
+
+    A last line that is not valid JSON was cut off by an interrupted run. It
+    is skipped and, if repair is True, truncated from the file.
+    """
+    with open(path, 'rb+' if repair else 'rb') as f:
+        offset = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if repair:
+                    f.truncate(offset)
+                break
+            offset += len(line)
+            yield record
+
+
+def shard_paths(directory):
+    """The shard files of directory in the order they were written."""
+    return sorted(glob.glob(os.path.join(directory, 'shard-*.jsonl')))
+
+
+class ShardWriter:
+    """Appends records to the shards of a run, resuming a previous one.
+
+    Attributes:
+        directory: The directory of the shards and the manifest.
+        config: The settings the records depend on. A run with different
+                settings does not resume the shards of another.
+        shard_size: The maximum number of records per shard.
+        completed: The indices of the images with a record.
+    """
+
+    def __init__(self, directory, config, shard_size=1000, restart=False):
+        """
+        Args:
+            directory: The directory of the shards and the manifest.
+            config: A JSON serializable dict of the run's settings.
+            shard_size: The maximum number of records per shard.
+            restart: Whether to delete the records of a previous run.
+
+        Raises:
+            ValueError: If directory holds the records of a run with another
+                        config and restart is False.
+        """
+        self.directory = directory
+        self.config = config
+        self.shard_size = shard_size
+        if restart:
+            shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+        manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                previous_config = json.load(f)['config']
+            if previous_config != config:
+                raise ValueError(
+                    '%s holds records generated with %s; use --restart to '
+                    'discard them.' % (directory, previous_config))
+
+        # The shards themselves, not the manifest, record what is done: the
+        # manifest is only rewritten when a shard is finished.
+        self.completed = set()
+        self._shards = []
+        for path in shard_paths(directory):
+            indices = [record['index'] for record in read_shard(path, True)]
+            self.completed.update(indices)
+            self._shards.append({'file': os.path.basename(path),
+                                 'records': len(indices)})
+        self._file = None
+        self._write_manifest(complete=False)
+
+    def write(self, record):
+        """Appends a record, which must have the image's 'index'."""
+        if self._file is None or self._shards[-1]['records'] >= \
+                self.shard_size:
+            self._next_shard()
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        self._shards[-1]['records'] += 1
+        self.completed.add(record['index'])
+
+    def close(self, complete=True):
+        """Closes the current shard and records whether the run is done."""
+        if self._file is not None:
+            self._close_shard()
+        self._write_manifest(complete)
+
+    def _next_shard(self):
+        # Resumed runs start a new shard rather than appending to old ones.
+        if self._file is not None:
+            self._close_shard()
+            self._write_manifest(complete=False)
+        filename = SHARD_PATTERN % len(self._shards)
+        self._file = open(os.path.join(self.directory, filename), 'w')
+        self._shards.append({'file': filename, 'records': 0})
+
+    def _close_shard(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def _write_manifest(self, complete):
+        manifest = {'config': self.config,
+                    'shard_size': self.shard_size,
+                    'shards': self._shards,
+                    'records': sum(shard['records'] for shard in self._shards),
+                    'complete': complete}
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+def merge_shards(directory, output_file):
+    """Writes the records of directory's shards as a data file.
+
+    The data file maps each column to a dict from image index to value, the
+    format `generate_datasets.py` has always written. Columns are streamed to
+    temporary files first, so memory use does not grow with the number of
+    records.
+
+    Returns:
+        The number of records merged.
+    """
+    columns = None
+    column_files = {}
+    seen = set()
+    try:
+        for path in shard_paths(directory):
+            for record in read_shard(path):
+                index = record.pop('index')
+                if index in seen:
+                    continue
+                if columns is None:
+                    columns = list(record)
+                    column_files = {column: open(os.path.join(
+                        directory, 'merge.%d.tmp' % i), 'w+')
+                        for i, column in enumerate(columns)}
+                separator = ', ' if seen else ''
+                for column in columns:
+                    column_files[column].write('%s"%d": %s' % (
+                        separator, index, json.dumps(record[column])))
+                seen.add(index)
+
+        with open(output_file + '.tmp', 'w') as f:
+            f.write('{')
+            for i, column in enumerate(columns or []):
+                f.write('%s%s: {' % (', ' if i else '', json.dumps(column)))
+                column_files[column].seek(0)
+                shutil.copyfileobj(column_files[column], f)
+                f.write('}')
+            f.write('}')
+        os.replace(output_file + '.tmp', output_file)
+    finally:
+        for f in column_files.values():
+            f.close()
+            os.remove(f.name)
+    return len(seen)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Merge the shards of generate_datasets.py into a data '
+                    'file.')
+    parser.add_argument('directory', help='directory of the shards')
+    parser.add_argument('-o', '--output_file', required=True,
+                        help='data file to write')
+    args = parser.parse_args()
+    print('Merged %d records into %s' % (
+        merge_shards(args.directory, args.output_file), args.output_file))
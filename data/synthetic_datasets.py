@@ -0,0 +1,172 @@
+"""Generates synthetic case studies for benchmarking and local development.
+
+The data files follow the schema written by `generate_datasets.py`, so they are
+served like real case studies, but are generated from random numbers in
+seconds instead of from images, a model and an explanation method:
+
+    python data/synthetic_datasets.py -n 100000 --num_labels 100 -o examples
+
+Images are random bytes between JPEG markers: they have the size of the
+thumbnails of real case studies but are not decodable. Scores are drawn so
+that they are consistent with each other (e.g. iou <= ground truth coverage),
+not computed from the polygons.
+"""
+
+import argparse
+import base64
+import json
+import os
+
+import numpy as np
+
+# The size of the masks polygons are traced from, as in generate_datasets.py.
+POLYGON_EXTENT = 175
+
+
+def generate(num_images, num_labels=10, accuracy=0.8, num_polygons=2,
+             polygon_points=12, image_bytes=6000, threshold_bins=20,
+             seed=0):
+    """Generates a synthetic case study.
+
+    Args:
+        num_images: The number of images.
+        num_labels: The number of distinct labels. Predictions use the same
+                    vocabulary.
+        accuracy: The proportion of images whose prediction is their label.
+        num_polygons: The maximum number of saliency polygons per image. The
+                      ground truth is a single polygon.
+        polygon_points: The number of vertices of each polygon.
+        image_bytes: The size of each image before base64 encoding.
+        threshold_bins: The number of saliency threshold intervals of the
+                        cumulative saliency histograms, or 0 for none.
+        seed: The random seed.
+
+    Returns:
+        The data as a dict from column name to a dict from image index to
+        value, the format `generate_datasets.py` writes.
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.array(['label_%d' % i for i in range(num_labels)])
+    label_codes = rng.randint(num_labels, size=num_images)
+    correct = rng.rand(num_images) < accuracy
+    prediction_codes = np.where(correct, label_codes,
+                                rng.randint(num_labels, size=num_images))
+
+    ground_truth_coverage = rng.rand(num_images)
+    explanation_coverage = rng.rand(num_images)
+    # The intersection over union of regions with these coverages.
+    with np.errstate(divide='ignore'):
+        iou = 1 / (1 / ground_truth_coverage + 1 / explanation_coverage - 1)
+
+    images = np.frombuffer(rng.bytes(num_images * image_bytes),
+                           dtype=np.uint8).reshape(num_images, image_bytes)
+    bboxes = _polygon_strings(rng, num_images, polygon_points)
+    polygons_per_image = rng.randint(1, num_polygons + 1, size=num_images)
+    saliency = _polygon_strings(rng, polygons_per_image.sum(), polygon_points)
+    ends = np.cumsum(polygons_per_image).tolist()
+
+    data = {
+        'fname': ['synthetic_%d' % i for i in range(num_images)],
+        'image': [_image_string(image.tobytes()) for image in images],
+        'bbox': [[bbox] for bbox in bboxes],
+        'saliency': [saliency[end - count:end] for end, count in
+                     zip(ends, polygons_per_image.tolist())],
+        'label': labels[label_codes].tolist(),
+        'prediction': labels[prediction_codes].tolist(),
+        'ground_truth_coverage': ground_truth_coverage.tolist(),
+        'explanation_coverage': explanation_coverage.tolist(),
+        'iou': iou.tolist(),
+    }
+    if threshold_bins:
+        inside, outside = _threshold_histograms(rng, num_images,
+                                                threshold_bins)
+        data['saliency_inside'] = inside.tolist()
+        data['saliency_outside'] = outside.tolist()
+    return {column: dict(enumerate(values)) for column, values in data.items()}
+
+
+def write(data, output_dir, case_study):
+    """Writes data to output_dir/data_<case_study>.json and returns the path."""
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, 'data_%s.json' % case_study)
+    with open(output_file, 'w') as f:
+        json.dump(data, f)
+    return output_file
+
+
+def _image_string(body):
+    """Random bytes between JPEG start and end markers, base64 encoded."""
+    return base64.b64encode(b'\xff\xd8' + body[4:] + b'\xff\xd9').decode(
+        'utf-8')
+
+
+def _polygon_strings(rng, num_polygons, num_points):
+    """Random star-shaped polygons, closed like rasterio's polygons.
+
+    Vertices are rounded to integer coordinates, so their strings are looked
+    up rather than formatted one by one.
+    """
+    centers = rng.uniform(0.2, 0.8, size=(num_polygons, 1, 2)) * POLYGON_EXTENT
+    angles = np.sort(rng.uniform(0, 2 * np.pi,
+                                 size=(num_polygons, num_points)), axis=1)
+    radii = rng.uniform(0.05, 0.3,
+                        size=(num_polygons, num_points)) * POLYGON_EXTENT
+    points = centers + radii[..., None] * np.stack(
+        [np.cos(angles), np.sin(angles)], axis=-1)
+    points = np.round(np.clip(points, 0, POLYGON_EXTENT)).astype(np.int64)
+    points = np.concatenate([points, points[:, :1]], axis=1)
+
+    coordinates = np.arange(POLYGON_EXTENT + 1)
+    point_strings = np.array(['%d.0,%d.0' % (x, y) for x in coordinates
+                              for y in coordinates], dtype=object)
+    indices = points[..., 0] * (POLYGON_EXTENT + 1) + points[..., 1]
+    return [' '.join(polygon) for polygon in point_strings[indices].tolist()]
+
+
+def _threshold_histograms(rng, num_images, num_bins):
+    """Cumulative saliency histograms inside and outside the ground truth.
+
+    The number of pixels above a threshold t decays as (1 - t) ** exponent,
+    so the histograms are nonincreasing and reach 0 at t = 1.
+    """
+    thresholds = np.arange(num_bins + 1) / num_bins
+    num_pixels = 224 * 224
+    ground_truth_area = rng.randint(1, num_pixels, size=num_images)
+
+    def cumulative_counts(area):
+        exponents = rng.uniform(0.5, 3, size=(num_images, 1))
+        return np.round(area[:, None] * (1 - thresholds) ** exponents).astype(
+            np.int64)
+
+    return (cumulative_counts(ground_truth_area),
+            cumulative_counts(num_pixels - ground_truth_area))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic case study data file.')
+    parser.add_argument('-n', '--num_images', default=1000, type=int,
+                        help='number of images')
+    parser.add_argument('-c', '--case_study', default='synthetic', type=str,
+                        help='case study name')
+    parser.add_argument('-o', '--output_dir', default='./examples', type=str,
+                        help='directory to store the data file')
+    parser.add_argument('--num_labels', default=10, type=int,
+                        help='number of distinct labels')
+    parser.add_argument('--accuracy', default=0.8, type=float,
+                        help='proportion of correct predictions')
+    parser.add_argument('--num_polygons', default=2, type=int,
+                        help='maximum number of saliency polygons per image')
+    parser.add_argument('--polygon_points', default=12, type=int,
+                        help='number of vertices per polygon')
+    parser.add_argument('--image_bytes', default=6000, type=int,
+                        help='size of each placeholder image in bytes')
+    parser.add_argument('--threshold_bins', default=20, type=int,
+                        help='number of saliency threshold intervals, or 0 '
+                             'to omit the threshold histograms')
+    parser.add_argument('--seed', default=0, type=int, help='random seed')
+    args = parser.parse_args()
+    print(write(generate(args.num_images, args.num_labels, args.accuracy,
+                         args.num_polygons, args.polygon_points,
+                         args.image_bytes, args.threshold_bins, args.seed),
+                args.output_dir, args.case_study))
@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+from server.dataset import CaseStudy
+
+from benchmarks.bench_api import compare, main_cli
+from data.synthetic_datasets import generate, write
+
+
+def test_synthetic_case_study(tmp_path):
+    path = write(generate(300, num_labels=5, polygon_points=6,
+                          image_bytes=100, threshold_bins=10),
+                 str(tmp_path), 'synthetic')
+    dataset = CaseStudy.from_json('data_synthetic', path)
+    assert len(dataset) == 300
+    assert len(dataset.labels()) == 5
+    assert sorted(dataset.scores) == ['explanation_coverage',
+                                      'ground_truth_coverage', 'iou']
+    iou = dataset.scores['iou']
+    assert (iou <= dataset.scores['ground_truth_coverage']).all()
+    assert (iou <= dataset.scores['explanation_coverage']).all()
+    assert len(dataset.image_bytes(0)) == 100
+    assert len(dataset.columns['bbox'][0][0].split()) == 7
+    assert dataset.saliency_masks().areas.max() > 0
+    inside = dataset.threshold_histograms[''].inside
+    assert inside.shape == (300, 11)
+    assert (np.diff(inside, axis=1) <= 0).all() and (inside[:, -1] == 0).all()
+
+
+def test_benchmark_runs_every_endpoint(tmp_path):
+    output = tmp_path / 'results.json'
+    assert main_cli(['--sizes', '200', '--repeat', '2', '--warmup', '0',
+                     '--image_bytes', '100', '--cache', 'warm',
+                     '-o', str(output)]) == 0
+    results = json.loads(output.read_text())['results']
+    assert {'get-images', 'confusion-matrix', 'image'} <= {
+        result['endpoint'] for result in results}
+    assert compare(results, results, tolerance=0, min_ms=0) == []
+    slower = [dict(result, p50_ms=result['p50_ms'] * 2 + 1)
+              for result in results[:1]]
+    assert len(compare(slower, results, tolerance=0.1, min_ms=0.5)) == 1
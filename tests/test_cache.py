@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+from server.cache import QueryCache, make_key, sizeof
+
+
+def test_hits_and_misses():
+    cache = QueryCache(10 ** 6)
+    key = make_key('get-images', 'data_dogs', sort_by=1, score_fn='iou')
+    assert cache.get_or_compute(key, lambda: ['a', 'b']) == ['a', 'b']
+    same_key = make_key('get-images', 'data_dogs', score_fn='iou', sort_by=1)
+    assert cache.get_or_compute(same_key, lambda: ['c']) == ['a', 'b']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_evicts_least_recently_used():
+    value = ['x' * 100]
+    cache = QueryCache(int(sizeof(value) * 2.5))
+    keys = [make_key('get-images', 'data_dogs', n=i) for i in range(3)]
+    cache.get_or_compute(keys[0], lambda: value)
+    cache.get_or_compute(keys[1], lambda: value)
+    cache.get_or_compute(keys[0], lambda: value)  # keys[1] is now the LRU
+    cache.get_or_compute(keys[2], lambda: value)
+    assert cache.stats()['evictions'] == 1
+    assert cache.get_or_compute(keys[1], lambda: 'recomputed') == 'recomputed'
+    assert cache.get_or_compute(keys[0], lambda: 'recomputed') == value
+
+
+def test_invalidate_case_study():
+    cache = QueryCache(10 ** 6)
+    dogs = make_key('get-images', 'data_dogs')
+    vehicles = make_key('get-images', 'data_vehicle')
+    cache.get_or_compute(dogs, lambda: 'old')
+    cache.get_or_compute(vehicles, lambda: 'old')
+    cache.invalidate('data_dogs')
+    assert cache.get_or_compute(dogs, lambda: 'new') == 'new'
+    assert cache.get_or_compute(vehicles, lambda: 'new') == 'old'
+
+
+def test_coalesces_concurrent_misses():
+    cache = QueryCache(10 ** 6)
+    key = make_key('confusion-matrix', 'data_dogs')
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'matrix'
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.get_or_compute(key, compute)))
+        for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['matrix'] * 8
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 7
+
+
+def test_errors_are_not_cached():
+    cache = QueryCache(10 ** 6)
+    key = make_key('get-images', 'data_dogs')
+    with pytest.raises(KeyError):
+        cache.get_or_compute(key, lambda: {}['missing'])
+    assert cache.get_or_compute(key, lambda: 'ok') == 'ok'
@@ -0,0 +1,126 @@
+import gzip
+import zlib
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.testclient import TestClient
+
+import server.compression as compression
+from server.compression import (CompressionMiddleware, negotiate, precompress,
+                                precompressed_response)
+
+LARGE = {'image_ids': ['img_%d' % i for i in range(500)]}
+
+
+@pytest.fixture
+def client():
+    app = Starlette()
+    app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+    @app.route('/large')
+    async def large(request):
+        return JSONResponse(LARGE)
+
+    @app.route('/small')
+    async def small(request):
+        return JSONResponse(['beagle'])
+
+    @app.route('/jpeg')
+    async def jpeg(request):
+        return Response(b'\xff\xd8' * 1000, media_type='image/jpeg')
+
+    @app.route('/stream')
+    async def stream(request):
+        async def lines():
+            for i in range(3):
+                yield '{"line": %d}\n' % i * 50
+
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    @app.route('/precompressed')
+    async def precompressed(request):
+        return precompressed_response(precompress(b'["pug"]' * 100),
+                                      request.headers.get('accept-encoding'))
+
+    return TestClient(app)
+
+
+def test_negotiate():
+    assert negotiate(None) == 'identity'
+    assert negotiate('deflate') == 'identity'
+    assert negotiate('gzip, deflate') == 'gzip'
+    assert negotiate('*') == compression.ENCODINGS[0]
+    assert negotiate('gzip;q=0, *') == (
+        'br' if 'br' in compression.ENCODINGS else 'identity')
+    assert negotiate('br;q=0.5, gzip;q=0.8') == 'gzip'
+    if 'br' in compression.ENCODINGS:
+        assert negotiate('gzip, deflate, br') == 'br'
+    else:
+        assert negotiate('br') == 'identity'
+
+
+def test_compresses_large_json(client):
+    response = client.get('/large', headers={'Accept-Encoding': 'gzip'},
+                          stream=True)
+    body = response.raw.read(decode_content=False)
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.headers['vary'] == 'Accept-Encoding'
+    assert int(response.headers['content-length']) == len(body)
+    assert gzip.decompress(body).startswith(b'{"image_ids":["img_0",')
+
+
+@pytest.mark.parametrize('path', ['/small', '/jpeg'])
+def test_skips_small_and_incompressible(client, path):
+    response = client.get(path, headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in response.headers
+
+
+def test_identity_without_accept_encoding(client):
+    response = client.get('/large', headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in response.headers
+    assert response.json() == LARGE
+
+
+def test_compresses_stream(client):
+    response = client.get('/stream', headers={'Accept-Encoding': 'gzip'},
+                          stream=True)
+    assert response.headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in response.headers
+    body = gzip.decompress(response.raw.read(decode_content=False))
+    assert body.decode().splitlines()[-1] == '{"line": 2}'
+
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_stream_chunks_decode_as_they_arrive(encoding):
+    compressor = compression._StreamCompressor(encoding, 4)
+    if encoding == 'br':
+        decompressor = compression.brotli.Decompressor()
+        decompress = decompressor.process
+    else:
+        decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    chunks = [b'{"line": %d}\n' % i * 20 for i in range(3)]
+    for i, chunk in enumerate(chunks):
+        assert decompress(compressor.compress(
+            chunk, last=i == len(chunks) - 1)) == chunk
+
+
+def test_precompressed_response_is_not_recompressed(client):
+    for encoding in compression.ENCODINGS:
+        response = client.get('/precompressed',
+                              headers={'Accept-Encoding': encoding},
+                              stream=True)
+        assert response.headers['content-encoding'] == encoding
+        body = response.raw.read(decode_content=False)
+        assert body == compression.compress(b'["pug"]' * 100, encoding)
+    response = client.get('/precompressed',
+                          headers={'Accept-Encoding': 'identity'})
+    assert response.content == b'["pug"]' * 100
+
+
+def test_precompress_skips_encodings_that_grow_the_body():
+    bodies = precompress(b'["pug"]')
+    assert list(bodies) == ['identity']
+    response = precompressed_response(bodies, 'gzip')
+    assert 'content-encoding' not in response.headers
+    assert response.body == b'["pug"]'
@@ -0,0 +1,277 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from server.bitmap import BitmapIndex
+from server.dataset import CaseStudy, SaliencyMaskStore
+from server.storage import (load_case_study, share_case_study,
+                            write_case_study)
+
+LABELS = ['beagle', 'pug', 'collie', 'husky']
+
+
+@pytest.fixture
+def df():
+    rng = np.random.RandomState(0)
+    n = 200
+    data = pd.DataFrame({
+        'fname': ['img_%d' % i for i in range(n)],
+        'image': ['jpeg_%d' % i for i in range(n)],
+        'bbox': [['0,0 1,0 1,1 0,0']] * n,
+        'saliency': [['0,0 2,0 2,2 0,0']] * n,
+        'label': rng.choice(LABELS, n),
+        'prediction': rng.choice(LABELS + ['tabby'], n),
+        'iou': rng.randint(0, 5, n) / 4,
+        'ground_truth_coverage': rng.rand(n),
+        'explanation_coverage': rng.rand(n),
+    })
+    data.loc[3, 'explanation_coverage'] = np.nan
+    return data.set_index('fname')
+
+
+def pandas_images(df, sort_by, prediction_fn, score_fn, label_filter):
+    if prediction_fn == "all_images":
+        pred_inds = np.ones(len(df))
+    elif prediction_fn == "correct_only":
+        pred_inds = df.label == df.prediction
+    elif prediction_fn == "incorrect_only":
+        pred_inds = df.label != df.prediction
+    else:
+        pred_inds = df.prediction == prediction_fn
+    if label_filter == '':
+        label_inds = np.ones(len(df))
+    else:
+        label_inds = df.label == label_filter
+    mask = np.logical_and(pred_inds, label_inds)
+    return list(df.loc[mask].sort_values(score_fn, kind="mergesort",
+                                         ascending=sort_by == 1).index)
+
+
+def pandas_confusion_matrix(df, label_filter, score_fn, n):
+    if label_filter == '':
+        filtered_df = df.loc[df.label != df.prediction]
+    else:
+        filtered_df = df.loc[
+            (df.label == label_filter) & (df.label != df.prediction)]
+    confused_labels = filtered_df.groupby('label').agg('count').sort_values(
+        'image', ascending=False, kind='mergesort').index.tolist()[:n]
+    top_predictions = df.loc[df.label.isin(confused_labels)].groupby(
+        'prediction').agg('count').sort_values(
+        'image', ascending=False, kind='mergesort').index.tolist()[:n]
+    matrix_labels = list(set(top_predictions + confused_labels))
+    confusion_df = df.loc[
+        (df.label.isin(matrix_labels)) & (df.prediction.isin(matrix_labels))]
+    return confusion_df.groupby(['label', 'prediction'])[score_fn] \
+        .agg(['count', 'mean', lambda x: x.var(ddof=0)]) \
+        .set_axis(['count', 'mean', 'variance'], axis=1) \
+        .reset_index().to_dict('records')
+
+
+@pytest.mark.parametrize('prediction_fn', ['all_images', 'correct_only',
+                                           'incorrect_only', 'pug', 'tabby',
+                                           'unknown'])
+@pytest.mark.parametrize('label_filter', ['', 'beagle', 'unknown'])
+@pytest.mark.parametrize('score_fn', ['iou', 'explanation_coverage'])
+@pytest.mark.parametrize('sort_by', [1, -1])
+def test_sorted_images_match_pandas(df, prediction_fn, label_filter, score_fn,
+                                    sort_by):
+    dataset = CaseStudy.from_dataframe('test', df)
+    mask = dataset.filter_mask(prediction_fn, label_filter)
+    rows = dataset.sort_rows(mask, score_fn, ascending=sort_by == 1)
+    assert dataset.ids[rows].tolist() == pandas_images(
+        df, sort_by, prediction_fn, score_fn, label_filter)
+
+
+def test_vocabularies(df):
+    dataset = CaseStudy.from_dataframe('test', df)
+    assert dataset.labels() == list(df.label.unique())
+    assert dataset.predictions() == list(df.prediction.unique())
+
+
+@pytest.mark.parametrize('label_filter', ['', 'collie'])
+@pytest.mark.parametrize('n', [2, 10])
+def test_confusion_matrix_matches_pandas(df, label_filter, n):
+    dataset = CaseStudy.from_dataframe('test', df)
+    expected = pandas_confusion_matrix(df, label_filter,
+                                       'explanation_coverage', n)
+    actual = dataset.confusion_matrix(label_filter, 'explanation_coverage', n)
+    assert [(c['label'], c['prediction'], c['count']) for c in actual] == \
+           [(c['label'], c['prediction'], c['count']) for c in expected]
+    for key in ['mean', 'variance']:
+        np.testing.assert_allclose([c[key] for c in actual],
+                                   [c[key] for c in expected])
+
+
+def test_records(df):
+    dataset = CaseStudy.from_dataframe('test', df)
+    ids = ['img_5', 'img_1']
+    records = dataset.records(dataset.rows(ids), 'iou')
+    assert [r['image'] for r in records] == ['jpeg_5', 'jpeg_1']
+    assert [r['label'] for r in records] == df.loc[ids].label.tolist()
+    assert [r['score'] for r in records] == df.loc[ids].iou.tolist()
+    # Polygons are formatted like the float coordinates of rasterio shapes.
+    assert records[0]['saliency'] == ['0.0,0.0 2.0,0.0 2.0,2.0 0.0,0.0']
+
+
+@pytest.mark.parametrize('prediction_fn', ['all_images', 'correct_only',
+                                           'incorrect_only', 'pug', 'unknown'])
+@pytest.mark.parametrize('label_filter', ['', 'husky'])
+def test_filter_counts(df, prediction_fn, label_filter):
+    dataset = CaseStudy.from_dataframe('test', df)
+    assert dataset.count(prediction_fn, label_filter) == len(
+        pandas_images(df, 1, prediction_fn, 'iou', label_filter))
+
+
+@pytest.mark.parametrize('size', [0, 1, 63, 64, 65, 130])
+def test_bitmap_round_trip(size):
+    codes = np.arange(size, dtype=np.int32) % 3
+    bitmaps = BitmapIndex(codes, codes[::-1].copy(), 3)
+    mask = codes == 1
+    assert bitmaps.unpack(bitmaps.pack(mask)).tolist() == mask.tolist()
+    assert bitmaps.unpack(bitmaps.label(1)).tolist() == mask.tolist()
+    assert bitmaps.count(bitmaps.all()) == size
+    assert bitmaps.count(bitmaps.correct | bitmaps.incorrect) == size
+    assert bitmaps.count(bitmaps.label(None)) == 0
+
+
+def test_binary_round_trip(df, tmp_path):
+    dataset = CaseStudy.from_dataframe('test', df)
+    write_case_study(dataset, str(tmp_path / 'test.si'))
+    loaded = load_case_study(str(tmp_path), 'test')
+    assert loaded.labels() == dataset.labels()
+    assert loaded.ids.tolist() == dataset.ids.tolist()
+    rows = loaded.sort_rows(loaded.filter_mask('incorrect_only', ''),
+                            'explanation_coverage', ascending=False)
+    assert rows.tolist() == dataset.sort_rows(
+        dataset.filter_mask('incorrect_only', ''), 'explanation_coverage',
+        ascending=False).tolist()
+    assert loaded.records(rows[:5], 'iou') == dataset.records(rows[:5], 'iou')
+    assert loaded.records(rows[:5], 'iou', 'binary', 1) == dataset.records(
+        rows[:5], 'iou', 'binary', 1)
+    assert loaded.threshold_histograms == {}
+    # Derived arrays are memory-mapped rather than copied per process.
+    for array in [loaded.sorted_ids, loaded.correct]:
+        assert isinstance(array, np.memmap)
+    assert loaded.correct.tolist() == dataset.correct.tolist()
+    assert loaded.rows(['img_9', 'img_3']).tolist() == [9, 3]
+
+
+def test_threshold_histograms_round_trip(df, tmp_path):
+    df['saliency_inside'] = [[4, 3, 1]] * len(df)
+    df['saliency_outside'] = [[6, 1, 0]] * len(df)
+    dataset = CaseStudy.from_dataframe('test', df)
+    assert sorted(dataset.scores) == ['explanation_coverage',
+                                      'ground_truth_coverage', 'iou']
+    write_case_study(dataset, str(tmp_path / 'test.si'))
+    loaded = load_case_study(str(tmp_path), 'test')
+    scores = loaded.threshold_histograms[''].scores(0.5)
+    np.testing.assert_allclose(scores['iou'], 3 / 5)
+    np.testing.assert_allclose(scores['ground_truth_coverage'], 3 / 4)
+    np.testing.assert_allclose(scores['explanation_coverage'], 3 / 4)
+
+
+def test_threshold_histograms_of_each_method(df, tmp_path):
+    df['saliency_inside'] = [[4, 3, 1]] * len(df)
+    df['saliency_outside'] = [[6, 1, 0]] * len(df)
+    df['saliency_inside.grad_cam'] = [[2, 2, 0]] * len(df)
+    df['saliency_outside.grad_cam'] = [[8, 6, 0]] * len(df)
+    dataset = CaseStudy.from_dataframe('test', df)
+    assert sorted(dataset.threshold_histograms) == ['', 'grad_cam']
+    write_case_study(dataset, str(tmp_path / 'test.si'))
+    loaded = load_case_study(str(tmp_path), 'test')
+    assert sorted(loaded.threshold_histograms) == ['', 'grad_cam']
+    scores = loaded.threshold_histograms['grad_cam'].scores(0.5)
+    np.testing.assert_allclose(scores['iou'], 2 / 8)
+    np.testing.assert_allclose(scores['ground_truth_coverage'], 2 / 2)
+    np.testing.assert_allclose(scores['explanation_coverage'], 2 / 8)
+    np.testing.assert_allclose(
+        loaded.threshold_histograms[''].scores(0.5)['iou'], 3 / 5)
+
+
+def test_explanation_method_columns(df, tmp_path):
+    df['saliency.grad_cam'] = [['0,0 3,0 3,3 0,0']] * len(df)
+    df['iou.grad_cam'] = 1 - df['iou']
+    df['saliency_inside.grad_cam'] = [[4, 3, 1]] * len(df)
+    dataset = CaseStudy.from_dataframe('test', df)
+    assert 'iou.grad_cam' in dataset.scores
+    assert 'saliency_inside.grad_cam' not in dataset.scores
+    write_case_study(dataset, str(tmp_path / 'test.si'))
+    loaded = load_case_study(str(tmp_path), 'test')
+    for case_study in [dataset, loaded]:
+        rows = case_study.rows(['img_4'])
+        assert case_study.records(rows, 'iou')[0]['saliency'] == [
+            '0.0,0.0 2.0,0.0 2.0,2.0 0.0,0.0']
+        record = case_study.records(rows, 'iou.grad_cam')[0]
+        assert record['saliency'] == ['0.0,0.0 3.0,0.0 3.0,3.0 0.0,0.0']
+        assert record['score'] == 1 - df.loc['img_4', 'iou']
+
+
+def test_shared_case_study(df, tmp_path):
+    write_case_study(CaseStudy.from_dataframe('test', df),
+                     str(tmp_path / 'data' / 'test.si'))
+    shared = share_case_study(str(tmp_path / 'data'),
+                              str(tmp_path / 'shared'), 'test', '1-100')
+    assert (tmp_path / 'shared' / 'test-1-100.si' / 'meta.json').exists()
+    share_case_study(str(tmp_path / 'data'), str(tmp_path / 'shared'),
+                     'test', '2-100')
+    assert not (tmp_path / 'shared' / 'test-1-100.si').exists()
+    assert shared.rows(['img_7', 'img_2']).tolist() == [7, 2]
+    with pytest.raises(KeyError):
+        shared.rows(['missing'])
+
+
+def test_sharing_keeps_case_studies_with_longer_names(df, tmp_path):
+    for name in ['dogs', 'dogs-v2']:
+        write_case_study(CaseStudy.from_dataframe(name, df),
+                         str(tmp_path / 'data' / (name + '.si')))
+
+    def share(name, version):
+        return share_case_study(str(tmp_path / 'data'),
+                                str(tmp_path / 'shared'), name, version)
+
+    share('dogs-v2', '1-100')
+    share('dogs', '1-100')
+    share('dogs', '2-100')
+    assert sorted(path.name for path in (tmp_path / 'shared').iterdir()
+                  if path.is_symlink()) == ['dogs-2-100.si', 'dogs-v2-1-100.si']
+    assert share('dogs-v2', '1-100').rows(['img_7']).tolist() == [7]
+
+
+def test_histograms_match_numpy(df):
+    dataset = CaseStudy.from_dataframe('test', df)
+    mask = dataset.filter_mask('incorrect_only', '')
+    bins = np.linspace(0, 1, 11)
+    histograms = dataset.histograms(mask, list(dataset.scores), bins)
+    for score_fn, hist in histograms.items():
+        expected, _ = np.histogram(df[score_fn][mask], bins)
+        assert hist.tolist() == expected.tolist()
+
+
+def test_saliency_masks_are_built_once(df, monkeypatch):
+    dataset = CaseStudy.from_dataframe('test', df)
+    release = threading.Event()
+    builds = []
+    from_polygons = SaliencyMaskStore.from_polygons.__func__
+
+    def slow_from_polygons(cls, saliency, resolution):
+        builds.append(resolution)
+        release.wait(5)
+        return from_polygons(cls, saliency, resolution)
+
+    monkeypatch.setattr(SaliencyMaskStore, 'from_polygons',
+                        classmethod(slow_from_polygons))
+    assert dataset.saliency_masks(timeout=0) is None
+    stores = []
+    threads = [threading.Thread(
+        target=lambda: stores.append(dataset.saliency_masks()))
+        for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert dataset.saliency_masks(timeout=0.05) is None
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert len(stores) == 4 and all(store is stores[0] for store in stores)
+    assert dataset.saliency_masks(timeout=0) is stores[0]
@@ -0,0 +1,88 @@
+import numpy as np
+from server.masks import (SaliencyMaskStore, ThresholdHistograms, pack_mask,
+                          rasterize)
+
+
+def _brute_force(polygon, resolution):
+    """Tests each cell center against the polygon with the even-odd rule."""
+    points = [tuple(float(c) * resolution / 175 for c in point.split(','))
+              for point in polygon.split()]
+    mask = np.zeros((resolution, resolution), dtype=bool)
+    for row in range(resolution):
+        for column in range(resolution):
+            x, y = column + 0.5, row + 0.5
+            inside = False
+            for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+                if (y1 > y) != (y2 > y) and \
+                        x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+            mask[row, column] = inside
+    return mask
+
+
+def test_rasterize_matches_brute_force():
+    polygons = ['0,0 87.5,0 87.5,87.5 0,87.5',
+                '10,20 150,5 170,160 90,100 30,170',
+                '40,40 140,40 40,140 140,140']  # Self-intersecting
+    for polygon in polygons:
+        for resolution in (16, 64):
+            np.testing.assert_array_equal(rasterize([polygon], resolution),
+                                          _brute_force(polygon, resolution))
+
+
+def test_region_scores():
+    left = '0,0 87.5,0 87.5,175 0,175'
+    top = '0,0 175,0 175,87.5 0,87.5'
+    store = SaliencyMaskStore.from_polygons([[left], [top], []], 8)
+    np.testing.assert_array_equal(store.areas, [32, 32, 0])
+
+    scores = store.scores(store.region_bits([left]))
+    np.testing.assert_allclose(scores['iou'], [1, 16 / 48, 0])
+    np.testing.assert_allclose(scores['ground_truth_coverage'], [1, 0.5, 0])
+    np.testing.assert_allclose(scores['explanation_coverage'][:2], [1, 0.5])
+    assert np.isnan(scores['explanation_coverage'][2])
+
+    mask = np.zeros((4, 4), dtype=int)
+    mask[:, :2] = 1
+    np.testing.assert_array_equal(store.region_bits(mask=mask),
+                                  store.region_bits([left]))
+    np.testing.assert_array_equal(
+        store.region_bits([left]), pack_mask(rasterize([left], 8)))
+
+
+def test_threshold_scores_match_thresholded_masks():
+    rng = np.random.RandomState(0)
+    num_bins = 10
+    thresholds = np.arange(num_bins + 1) / num_bins
+    ground_truths = rng.rand(5, 12, 12) < 0.3
+    saliencies = np.round(rng.rand(5, 12, 12), 1)  # Values on the thresholds
+    saliencies[0] = 0  # No saliency
+
+    def cumulative_counts(values):
+        return len(values) - np.searchsorted(np.sort(values), thresholds)
+
+    histograms = ThresholdHistograms(
+        np.array([cumulative_counts(s[g])
+                  for g, s in zip(ground_truths, saliencies)]),
+        np.array([cumulative_counts(s[~g])
+                  for g, s in zip(ground_truths, saliencies)]))
+    curves = histograms.curves()
+    for k, threshold in enumerate(thresholds):
+        explanations = saliencies >= threshold
+        intersection = (explanations & ground_truths).sum(axis=(1, 2))
+        with np.errstate(invalid='ignore'):
+            expected = {
+                'iou': intersection / (explanations | ground_truths).sum(
+                    axis=(1, 2)),
+                'ground_truth_coverage': intersection / ground_truths.sum(
+                    axis=(1, 2)),
+                'explanation_coverage': intersection / explanations.sum(
+                    axis=(1, 2))}
+        scores = histograms.scores(threshold)
+        for name, values in expected.items():
+            np.testing.assert_allclose(scores[name], values)
+            np.testing.assert_allclose(curves[name][:, k], values)
+
+    np.testing.assert_allclose(
+        histograms.scores(0.25, rows=np.array([3, 1]))['iou'],
+        histograms.scores(0.2)['iou'][[3, 1]])
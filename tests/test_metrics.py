@@ -0,0 +1,104 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server.main as main
+from server.metrics import Counter, Histogram, Metrics, dataset_metrics
+from server.registry import DatasetRegistry
+
+
+def test_counter_render():
+    counter = Counter('requests', 'Requests.', ['route', 'status'])
+    counter.inc(route='/a', status=200)
+    counter.inc(2, route='/a', status=200)
+    counter.inc(route='/b"', status=404)
+    assert counter.render() == [
+        '# HELP requests Requests.',
+        '# TYPE requests counter',
+        'requests_total{route="/a",status="200"} 3',
+        'requests_total{route="/b\\"",status="404"} 1',
+    ]
+
+
+def test_histogram_render():
+    histogram = Histogram('latency', 'Latency.', ['route'], buckets=[1, 10])
+    for value in [0.5, 1, 5, 20]:
+        histogram.observe(value, route='/a')
+    assert histogram.render() == [
+        '# HELP latency Latency.',
+        '# TYPE latency histogram',
+        'latency_bucket{route="/a",le="1.0"} 2',
+        'latency_bucket{route="/a",le="10.0"} 3',
+        'latency_bucket{route="/a",le="+Inf"} 4',
+        'latency_sum{route="/a"} 26.5',
+        'latency_count{route="/a"} 4',
+    ]
+
+
+def test_stage_timers_are_opt_in():
+    metrics = Metrics()
+    with metrics.stage('get-images', 'filter'):
+        pass
+    assert 'stage_duration_seconds_count' not in metrics.render()
+    metrics.stage_timers = True
+    with metrics.stage('get-images', 'filter'):
+        pass
+    assert ('shared_interest_stage_duration_seconds_count{endpoint='
+            '"get-images",stage="filter"} 1') in metrics.render()
+
+
+def test_dataset_metrics_only_report_loaded_sizes():
+    lines = dataset_metrics([
+        {'name': 'a', 'loaded': True, 'num_images': 5, 'nbytes': 100,
+         'load_seconds': 0.5},
+        {'name': 'b', 'loaded': False}])
+    assert 'shared_interest_dataset_loaded{case_study="b"} 0' in lines
+    assert 'shared_interest_dataset_images{case_study="a"} 5' in lines
+    assert not any('images{case_study="b"}' in line for line in lines)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    data = {'fname': {}, 'image': {}, 'bbox': {}, 'saliency': {}, 'label': {},
+            'prediction': {}, 'iou': {}, 'ground_truth_coverage': {},
+            'explanation_coverage': {}}
+    for i in range(4):
+        data['fname'][i] = 'img_%d' % i
+        data['image'][i] = 'anBlZw=='
+        data['bbox'][i] = ['0,0 0,10 10,10 10,0']
+        data['saliency'][i] = ['0,0 0,5 5,5 5,0']
+        data['label'][i] = 'beagle'
+        data['prediction'][i] = 'pug' if i % 2 else 'beagle'
+        data['iou'][i] = i / 4
+        data['ground_truth_coverage'][i] = i / 4
+        data['explanation_coverage'][i] = i / 4
+    with open(tmp_path / 'test.json', 'w') as f:
+        json.dump(data, f)
+    monkeypatch.setattr(main, 'case_studies', DatasetRegistry(str(tmp_path)))
+    main.query_cache.invalidate()
+    return TestClient(main.app)
+
+
+def test_scrape(client):
+    client.get('/api/get-labels?case_study=test')
+    client.get('/api/get-labels?case_study=test')
+    client.get('/api/image/test/img_1')
+    client.get('/api/nonexistent')
+    response = client.get('/metrics')
+    assert response.headers['content-type'].startswith('text/plain')
+    lines = response.text.splitlines()
+    prefix = 'shared_interest_http_requests_total'
+    # Counted since the app was created, possibly by other tests.
+    counts = {line.rsplit(' ', 1)[0]: int(line.rsplit(' ', 1)[1])
+              for line in lines if line.startswith(prefix)}
+    assert counts[prefix + '{route="/api/get-labels",method="GET",'
+                           'status="200"}'] >= 2
+    assert counts[prefix + '{route="unmatched",method="GET",'
+                           'status="404"}'] >= 1
+    # Requests are labeled with the path template, not the path.
+    assert prefix + '{route="/api/image/{case_study}/{image_id}",' \
+                    'method="GET",status="200"}' in counts
+    assert not any('img_1' in line for line in lines)
+    assert 'shared_interest_query_cache_entries 1' in lines
+    assert 'shared_interest_dataset_images{case_study="test"} 4' in lines
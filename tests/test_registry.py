@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from server.dataset import CaseStudy, SaliencyMaskStore
+from server.registry import DatasetRegistry
+from server.storage import write_case_study
+
+
+def write_json(directory, name, labels):
+    n = len(labels)
+    pd.DataFrame({
+        'fname': ['%s_%d' % (name, i) for i in range(n)],
+        'image': ['jpeg'] * n,
+        'bbox': [['0,0 1,0 1,1 0,0']] * n,
+        'saliency': [['0,0 2,0 2,2 0,0']] * n,
+        'label': labels,
+        'prediction': labels[::-1],
+        'iou': np.linspace(0, 1, n),
+        'ground_truth_coverage': np.linspace(0, 1, n),
+        'explanation_coverage': np.linspace(0, 1, n),
+    }).to_json(os.path.join(directory, name + '.json'))
+
+
+def test_discovers_and_loads_lazily(tmp_path):
+    write_json(tmp_path, 'data_dogs', ['pug', 'beagle'])
+    write_json(tmp_path, 'data_cats', ['tabby'])
+    (tmp_path / 'notes.txt').write_text('not a case study')
+    registry = DatasetRegistry(str(tmp_path))
+    assert registry.names() == ['data_cats', 'data_dogs']
+    assert not any(info['loaded'] for info in registry.info())
+    assert registry['data_dogs'].labels() == ['pug', 'beagle']
+    assert [info['loaded'] for info in registry.info()] == [False, True]
+    with pytest.raises(KeyError):
+        registry['../data_dogs']
+
+
+def test_reloads_changed_files(tmp_path):
+    changed = []
+    write_json(tmp_path, 'data_dogs', ['pug', 'beagle'])
+    registry = DatasetRegistry(str(tmp_path), check_interval=0,
+                               on_change=changed.append)
+    old = registry['data_dogs']
+    assert registry['data_dogs'] is old
+    write_json(tmp_path, 'data_dogs', ['husky', 'pug', 'collie'])
+    os.utime(tmp_path / 'data_dogs.json', ns=(0, 1))
+    assert registry['data_dogs'].labels() == ['husky', 'pug', 'collie']
+    assert changed == ['data_dogs', 'data_dogs']
+
+
+def test_loading_leaves_masks_to_first_use(tmp_path, monkeypatch):
+    def fail(cls, *args):
+        raise ValueError('bad polygon')
+
+    monkeypatch.setattr(SaliencyMaskStore, 'from_polygons',
+                        classmethod(fail))
+    write_json(tmp_path, 'data_dogs', ['pug', 'beagle'])
+    dataset = DatasetRegistry(str(tmp_path))['data_dogs']
+    assert dataset.labels() == ['pug', 'beagle']
+    with pytest.raises(RuntimeError):
+        dataset.saliency_masks()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    for name in ['data_a', 'data_b', 'data_c']:
+        write_json(tmp_path, name, ['pug'] * 100)
+    registry = DatasetRegistry(str(tmp_path))
+    registry['data_a']
+    registry.memory_budget = int(registry.loaded_bytes() * 2.5)
+    registry['data_b']
+    registry['data_a']
+    registry['data_c']
+    assert [info['loaded'] for info in registry.info()] == [True, False, True]
+
+
+def test_converting_again_swaps_versions_atomically(tmp_path, monkeypatch):
+    sources = tmp_path / 'sources'
+    sources.mkdir()
+    write_json(tmp_path, 'data_dogs', ['json'])
+    path = str(tmp_path / 'data_dogs.si')
+
+    def convert(labels):
+        write_json(sources, 'data_dogs', labels)
+        write_case_study(CaseStudy.from_json(
+            'data_dogs', str(sources / 'data_dogs.json')), path)
+
+    # A directory converted before versions were linked is moved aside.
+    convert(['pug'])
+    version = os.path.realpath(path)
+    os.unlink(path)
+    os.rename(version, path)
+
+    registry = DatasetRegistry(str(tmp_path), check_interval=0)
+    assert registry['data_dogs'].labels() == ['pug']
+    seen = []
+    replace = os.replace
+
+    def checked_replace(source, destination):
+        if destination == path:
+            seen.append(registry['data_dogs'].labels())
+        replace(source, destination)
+        if destination == path:
+            seen.append(registry['data_dogs'].labels())
+
+    monkeypatch.setattr(os, 'replace', checked_replace)
+    convert(['beagle'])
+    convert(['husky'])
+    convert(['collie'])
+    # Only moving the unversioned directory aside exposes the JSON source.
+    assert seen == [['json'], ['beagle'], ['beagle'], ['husky'],
+                    ['husky'], ['collie']]
+    assert os.path.islink(path)
+    # The current and the previous version are kept.
+    assert len([name for name in os.listdir(str(tmp_path))
+                if name.startswith('data_dogs.si.')]) == 2
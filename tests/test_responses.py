@@ -0,0 +1,270 @@
+import asyncio
+import importlib
+import json
+import threading
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import server.main as main
+from server.dataset import SaliencyMaskStore
+from server.registry import DatasetRegistry
+
+# The module main serializes with, imported as backend.server.responses.
+responses = importlib.import_module(main.FastJSONResponse.__module__)
+
+LABELS = ['beagle', 'pug', 'collie', 'husky']
+
+QUERIES = [
+    ('get', '/api/get-images?case_study=test&sort_by=-1&'
+            'prediction_fn=all_images&score_fn=iou&label_filter='),
+    ('get', '/api/get-images-page?case_study=test&sort_by=1&'
+            'prediction_fn=correct_only&score_fn=iou&label_filter=&limit=7'),
+    ('get', '/api/get-saliency-image?case_study=test&image_id=img_3&'
+            'score_fn=explanation_coverage'),
+    ('post', '/api/get-saliency-images',
+     {'case_study': 'test', 'image_ids': ['img_1', 'img_4', 'img_2'],
+      'score_fn': 'iou', 'image_format': 'url'}),
+    ('get', '/api/get-saliency-image?case_study=test&image_id=img_7&'
+            'score_fn=iou&polygon_format=binary&lod=2'),
+    ('post', '/api/get-saliency-images',
+     {'case_study': 'test', 'image_ids': ['img_3', 'img_9'],
+      'score_fn': 'iou', 'polygon_format': 'binary', 'lod': 1}),
+    ('get', '/api/get-labels?case_study=test'),
+    ('get', '/api/get-predictions?case_study=test'),
+    ('post', '/api/bin-scores?num_bins=5',
+     {'case_study': 'test', 'score_fn': 'ground_truth_coverage',
+      'prediction_fn': 'incorrect_only'}),
+    ('get', '/api/bin-all-scores?case_study=test&prediction_fn=all_images&'
+            'label_filter=pug'),
+    ('get', '/api/confusion-matrix?case_study=test&label_filter=&'
+            'score_fn=iou'),
+    ('get', '/api/dashboard?case_study=test&sort_by=-1&'
+            'prediction_fn=incorrect_only&score_fn=iou&label_filter=pug&'
+            'limit=3'),
+    ('post', '/api/rescore-region?limit=5',
+     {'case_study': 'test', 'region': ['0,0 0,100 100,100 100,0']}),
+]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    n = 50
+    data = {'fname': {}, 'image': {}, 'bbox': {}, 'saliency': {}, 'label': {},
+            'prediction': {}, 'iou': {}, 'ground_truth_coverage': {},
+            'explanation_coverage': {}}
+    for i in range(n):
+        data['fname'][i] = 'img_%d' % i
+        data['image'][i] = 'anBlZw=='
+        data['bbox'][i] = ['0,0 0,%d %d,%d %d,0' % ((i + 10,) * 4)]
+        data['saliency'][i] = ['20,20 20,90 90,90 90,20']
+        data['label'][i] = LABELS[rng.randint(4)]
+        data['prediction'][i] = LABELS[rng.randint(4)]
+        data['iou'][i] = rng.randint(0, 5) / 4
+        data['ground_truth_coverage'][i] = rng.rand()
+        data['explanation_coverage'][i] = rng.rand()
+    with open(tmp_path / 'test.json', 'w') as f:
+        json.dump(data, f)
+    monkeypatch.setattr(main, 'case_studies', DatasetRegistry(str(tmp_path)))
+    main.query_cache.invalidate()
+    return TestClient(main.app)
+
+
+def request(client, method, url, payload=None):
+    response = client.post(url, json=payload) if method == 'post' else \
+        client.get(url)
+    assert response.status_code == 200
+    return response.json()
+
+
+def assert_identical(fast, validated):
+    """Asserts equality including the types of numbers (1 != 1.0)."""
+    assert type(fast) is type(validated)
+    if isinstance(fast, dict):
+        assert fast.keys() == validated.keys()
+        for key in fast:
+            assert_identical(fast[key], validated[key])
+    elif isinstance(fast, list):
+        assert len(fast) == len(validated)
+        for fast_value, value in zip(fast, validated):
+            assert_identical(fast_value, value)
+    else:
+        assert fast == validated
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+@pytest.mark.parametrize('query', QUERIES, ids=lambda query: query[1])
+def test_fast_json_matches_response_model(client, monkeypatch, query,
+                                          use_orjson):
+    if use_orjson and responses.orjson is None:
+        pytest.skip('orjson is not installed')
+    if not use_orjson:
+        monkeypatch.setattr(responses, 'orjson', None)
+    validated = request(client, *query)
+    monkeypatch.setattr(main, 'FAST_JSON', True)
+    assert_identical(request(client, *query), validated)
+
+
+def test_fast_json_stream(client, monkeypatch):
+    payload = {'case_study': 'test', 'image_ids': ['img_5', 'img_0'],
+               'score_fn': 'iou'}
+    url = '/api/stream-saliency-images?chunk_size=1'
+    validated = client.post(url, json=payload).text.splitlines()
+    monkeypatch.setattr(main, 'FAST_JSON', True)
+    fast = client.post(url, json=payload).text.splitlines()
+    assert [json.loads(line) for line in fast] == \
+        [json.loads(line) for line in validated]
+
+
+def test_precompressed_responses_are_validated(client, monkeypatch):
+    monkeypatch.setattr(main.case_studies['test'], 'labels', lambda: [1, 2])
+    url = '/api/get-labels?case_study=test'
+    assert request(client, 'get', url) == ['1', '2']
+    monkeypatch.setattr(main, 'FAST_JSON', True)
+    assert request(client, 'get', url) == [1, 2]
+
+
+@pytest.mark.parametrize('label_filter', ['', 'pug'])
+def test_dashboard_matches_individual_endpoints(client, label_filter):
+    filters = ('case_study=test&sort_by=1&prediction_fn=correct_only&'
+               'score_fn=ground_truth_coverage&label_filter=' + label_filter)
+    dashboard = request(client, 'get', '/api/dashboard?' + filters)
+    assert dashboard['image_ids'] == request(client, 'get',
+                                             '/api/get-images?' + filters)
+    assert dashboard['total'] == len(dashboard['image_ids'])
+    assert dashboard['next_offset'] is None
+    assert dashboard['bins'] == request(
+        client, 'post', '/api/bin-scores',
+        {'case_study': 'test', 'score_fn': 'ground_truth_coverage',
+         'prediction_fn': 'correct_only', 'label_filter': label_filter})
+    assert dashboard['confusion_matrix'] == request(
+        client, 'get', '/api/confusion-matrix?case_study=test&'
+                       'score_fn=ground_truth_coverage&label_filter=' +
+                       label_filter)
+    assert dashboard['labels'] == request(client, 'get',
+                                          '/api/get-labels?case_study=test')
+    assert dashboard['predictions'] == request(
+        client, 'get', '/api/get-predictions?case_study=test')
+
+    page = request(client, 'get', '/api/dashboard?%s&offset=1&limit=2'
+                   % filters)
+    assert page['image_ids'] == dashboard['image_ids'][1:3]
+    assert page['total'] == dashboard['total']
+
+
+def test_rescore_waits_for_one_mask_build(client, monkeypatch):
+    release = threading.Event()
+    from_polygons = SaliencyMaskStore.from_polygons.__func__
+    monkeypatch.setattr(SaliencyMaskStore, 'from_polygons', classmethod(
+        lambda cls, *args: release.wait(5) and from_polygons(cls, *args)))
+    monkeypatch.setattr(main, 'MASK_BUILD_TIMEOUT', 0.01)
+    payload = {'case_study': 'test', 'region': ['0,0 0,100 100,100 100,0']}
+    response = client.post('/api/rescore-region', json=payload)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(main.MASK_BUILD_RETRY_AFTER)
+    release.set()
+    monkeypatch.setattr(main, 'MASK_BUILD_TIMEOUT', 5)
+    response = client.post('/api/rescore-region', json=payload)
+    assert response.status_code == 200 and len(response.json()) == 50
+
+
+@pytest.mark.parametrize('region', [
+    {},
+    {'region': ['0,0 0,100 100,100 100,0'], 'mask': [[1]]},
+])
+def test_rescore_needs_one_region(client, region):
+    response = client.post('/api/rescore-region',
+                           json=dict(case_study='test', **region))
+    assert response.status_code == 422
+
+
+def test_image_etag_revalidation(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'case_studies',
+                        DatasetRegistry(str(tmp_path), check_interval=0))
+    response = client.get('/api/image/test/img_1')
+    assert response.status_code == 200
+    assert response.content == b'jpeg'
+    assert response.headers['Cache-Control'] == \
+        'public, max-age=31536000, immutable'
+    etag = response.headers['ETag']
+    assert etag.startswith('"') and etag.endswith('"')
+
+    def status(if_none_match):
+        return client.get('/api/image/test/img_1',
+                          headers={'If-None-Match': if_none_match})
+
+    for matching in [etag, 'W/' + etag, '"other", W/%s, "more"' % etag, '*']:
+        response = status(matching)
+        assert response.status_code == 304, matching
+        assert response.content == b''
+        assert response.headers['ETag'] == etag
+    assert status('"other"').status_code == 200
+    assert status(etag[:-1] + 'x"').status_code == 200
+
+    # A changed image gets a new ETag, so the old one no longer matches.
+    with open(tmp_path / 'test.json') as f:
+        data = json.load(f)
+    data['image']['1'] = 'b3RoZXIgaW1hZ2U='
+    with open(tmp_path / 'test.json', 'w') as f:
+        json.dump(data, f)
+    response = status(etag)
+    assert response.status_code == 200
+    assert response.content == b'other image'
+    assert response.headers['ETag'] != etag
+
+
+FILTERS = ('case_study=test&sort_by=-1&prediction_fn=all_images&'
+           'score_fn=ground_truth_coverage&label_filter=')
+
+
+@pytest.mark.parametrize('limit', [0, 1, 7, 100])
+def test_pages_partition_get_images(client, limit):
+    image_ids = request(client, 'get', '/api/get-images?' + FILTERS)
+    pages = []
+    offset = 0
+    while offset is not None and len(pages) < 60:
+        page = request(client, 'get', '/api/get-images-page?%s&offset=%d&'
+                                      'limit=%d' % (FILTERS, offset, limit))
+        assert page['total'] == len(image_ids)
+        assert page['image_ids'] == image_ids[offset:offset + limit]
+        pages.append(page['image_ids'])
+        offset = page['next_offset']
+        if limit == 0:
+            break
+    if limit:
+        assert sum(pages, []) == image_ids
+    else:
+        assert pages == [[]]
+
+
+def test_page_past_the_end(client):
+    page = request(client, 'get', '/api/get-images-page?%s&offset=1000&'
+                                  'limit=10' % FILTERS)
+    assert page == {'image_ids': [], 'total': 50, 'next_offset': None}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 64])
+def test_stream_chunks(client, chunk_size):
+    image_ids = ['img_%d' % i for i in [5, 0, 9, 3, 7]]
+    payload = {'case_study': 'test', 'image_ids': image_ids,
+               'score_fn': 'iou'}
+
+    async def chunks():
+        response = await main.stream_saliency_images(payload, chunk_size)
+        assert response.media_type == 'application/x-ndjson'
+        return [chunk async for chunk in response.body_iterator]
+
+    chunks = asyncio.run(chunks())
+    # Every chunk holds chunk_size whole records, the last one the rest.
+    assert [chunk.count('\n') for chunk in chunks] == [
+        min(chunk_size, len(image_ids) - start)
+        for start in range(0, len(image_ids), chunk_size)]
+    assert all(chunk.endswith('\n') for chunk in chunks)
+    records = [json.loads(line) for line in ''.join(chunks).splitlines()]
+    expected = request(client, 'post', '/api/get-saliency-images', payload)
+    assert records == expected
+    # In payload order: the bbox of img_i reaches i + 10.
+    assert [record['bbox'][0].split()[1] for record in records] == [
+        '0.0,%d.0' % (int(image_id[4:]) + 10) for image_id in image_ids]
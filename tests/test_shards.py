@@ -0,0 +1,56 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from data.shards import MANIFEST, ShardWriter, merge_shards, shard_paths
+
+CONFIG = {'explanation_fn': 'lime', 'seed': 0}
+
+
+def record(index):
+    return {'index': index, 'fname': 'img_%d' % index,
+            'bbox': ['0.0,0.0 0.0,%d.0 %d.0,0.0 0.0,0.0' % (index, index)],
+            'label': 'pug', 'iou': index / 10,
+            'saliency_inside': [index, 0]}
+
+
+def test_resume_after_interruption(tmp_path):
+    directory = str(tmp_path / 'data_test.shards')
+    writer = ShardWriter(directory, CONFIG, shard_size=3)
+    for index in range(5):
+        writer.write(record(index))
+    # Interrupted while writing the record of image 5.
+    writer._file.write(json.dumps(record(5))[:20])
+    writer._file.close()
+
+    writer = ShardWriter(directory, CONFIG, shard_size=3)
+    assert writer.completed == set(range(5))
+    for index in range(5, 8):
+        writer.write(record(index))
+    writer.close()
+    # The resumed run starts a new shard.
+    assert len(shard_paths(directory)) == 3
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    assert manifest['records'] == 8 and manifest['complete']
+
+    output_file = str(tmp_path / 'data_test.json')
+    assert merge_shards(directory, output_file) == 8
+    df = pd.read_json(output_file)
+    assert df.fname.tolist() == ['img_%d' % i for i in range(8)]
+    assert df.iou.tolist() == pytest.approx([i / 10 for i in range(8)])
+    assert df.bbox[7] == record(7)['bbox']
+    assert not any(name.endswith('.tmp') for name in os.listdir(directory))
+
+
+def test_refuses_to_resume_another_config(tmp_path):
+    directory = str(tmp_path / 'shards')
+    writer = ShardWriter(directory, CONFIG)
+    writer.write(record(0))
+    writer.close()
+    with pytest.raises(ValueError):
+        ShardWriter(directory, dict(CONFIG, seed=1))
+    assert ShardWriter(directory, dict(CONFIG, seed=1),
+                       restart=True).completed == set()